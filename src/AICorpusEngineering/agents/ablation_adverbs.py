@@ -1,9 +1,37 @@
-import requests, json, re
+import re
 from pathlib import Path
 from datetime import datetime
 from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
 from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
 from AICorpusEngineering.error_handler.error_handler import error_handler
+import importlib.resources as resources
+from AICorpusEngineering.llm_client.llm_client import LLMClient, answer_prefix_for
+
+# ----------
+# The ablation study matrix
+# Each study is one agent_type in the ablation jinja template.
+# knowledge_base: which KnowledgeBase is injected into the template
+#   "examples" - create_examples_knowledge_base, "broad" - create_broad_adverb_knowledge_base,
+#   None - no knowledge base (category names are hard-coded into the template)
+# n_predict: maximum number of tokens generated
+# has_CoT: whether the study asks for a chain of thought before the final answer
+# scoring: studies without reasoning are not generated. The prompt plus the study's "Final answer:" turn, written as in
+#   its examples (see answer_prefix_for), is evaluated once and the answer is read from the next-token distribution
+#   over the choice tokens, see LLMClient.score_answer
+# few_shot: studies whose few-shot examples are replaced by the most similar examples of the pool
+#   when the KnowledgeBase's dynamic few-shot mode is on (KnowledgeBase.create_example_pool)
+# With self-consistency on, the studies with CoT that are generated sample several reasoning chains
+# from one prompt evaluation and answer by majority vote (MCQProbHandler.aggregate_chains)
+# The first study gates the others: if it fails for a sentence, the sentence is skipped.
+# ----------
+ABLATION_STUDIES = [
+    {"agent_type": "base_study", "knowledge_base": "examples", "n_predict": 256, "has_CoT": True, "few_shot": True}, # Knowledge base + few-shot + CoT
+    {"agent_type": "kb_oneshot_cot", "knowledge_base": "examples", "n_predict": 128, "has_CoT": True}, # Ablation 1: Knowledge base + one-shot + CoT
+    {"agent_type": "kb_zeroshot", "knowledge_base": "examples", "n_predict": 128, "has_CoT": False, "scoring": True}, # Ablation 2: Knowledge base + zero shot
+    {"agent_type": "zeroshot", "knowledge_base": None, "n_predict": 128, "has_CoT": False, "scoring": True}, # Ablation 3: Zero shot
+    {"agent_type": "oneshot_cot", "knowledge_base": None, "n_predict": 128, "has_CoT": True}, # Ablation 4: One shot + CoT
+    {"agent_type": "fewshot_cot", "knowledge_base": None, "n_predict": 128, "has_CoT": True, "few_shot": True}, # Ablation 5: Few shot + CoT
+]
 
 class AdverbsAblationStudy:
     """
@@ -14,40 +42,47 @@ class AdverbsAblationStudy:
             self,
             server_url,
             prob_handler: MCQProbHandler,
-            knowledge_base: KnowledgeBase
+            knowledge_base: KnowledgeBase,
+            llm_client: LLMClient = None,
+            studies = None,
+            self_consistency: int = 1,
+            self_consistency_temperature: float = 0.7,
+            chat_template = None
         ):
+            """
+            self_consistency: number of reasoning chains sampled per request of the studies with CoT (1: one greedy chain)
+            self_consistency_temperature: sampling temperature of the chains
+            chat_template: the template the server renders, read for the answer prefix of the scored studies (default: ablation_adverbs_examples_kb.jinja)
+            """
             print("intialize the class")
             self.server_url = server_url
-            self.knowledge_base_cache = None
+            self.knowledge_base_cache = {} # knowledge base variant -> (knowledge base text, answer mappings)
             self.prob_handler = prob_handler
             self.knowledge_base = knowledge_base
-
-    def _send_request(self, payload, agent_type, knowledge_base, sentence, adverb, temperature=0.001, n_predict=128):
+            self.llm_client = llm_client or LLMClient(server_url) # Shared keep-alive connection to the server
+            self.studies = studies or ABLATION_STUDIES
+            self.self_consistency = max(1, self_consistency)
+            self.self_consistency_temperature = self_consistency_temperature
+            self.chat_template = chat_template or resources.files("AICorpusEngineering.agent-templates").joinpath("ablation_adverbs_examples_kb.jinja")
+
+    def _send_request(self, payload, agent_type, knowledge_base, sentence, adverb, temperature=0.001, n_predict=128, answer_prefix=None, examples=None, n_sequences=1, answer_letters=None):
+        chat_template_kwargs = {
+            "agent_type": agent_type, 
+            "knowledge_base": knowledge_base,
+            "sentence": sentence,
+            "adverb": adverb
+        }
+        if examples is not None:
+            chat_template_kwargs["examples"] = examples # Replaces the template's own few-shot examples
         try:
-            response = requests.post(
-                f"{self.server_url}/chat/completions",
-                headers={"Content-Type": "application/json"},
-                data = json.dumps({
-                        "messages": [],
-                        "chat_template_kwargs": {
-                            "agent_type": agent_type, 
-                            "knowledge_base": knowledge_base,
-                            "sentence": sentence,
-                            "adverb": adverb
-                        },
-                        "n_predict": n_predict,
-                        "temperature": temperature,
-                        "top_p": 0.85,
-                        "logprobs": 1000,
-                        "echo": False,
-                        "stop": ["<|user|>", "<|system|>"]
-                }),
-                timeout = 30,
+            return self.llm_client.chat(
+                chat_template_kwargs,
+                temperature = temperature,
+                n_predict = n_predict,
+                answer_prefix = answer_prefix,
+                n_sequences = n_sequences,
+                answer_letters = answer_letters
             )
-
-            if response.status_code != 200:
-                raise RuntimeError(f"Server error: {response.status_code} with body: {response.text[:200]}")
-            return response.json()
         except Exception as e:
             # Delegate all error handling to the error_handler
             return error_handler.handle(
@@ -59,104 +94,131 @@ class AdverbsAblationStudy:
                     "adverb": adverb
                 }
             )
-    
-    def base_study(self, sentence: str, adverb: str):
+
+    def get_study(self, agent_type: str):
         """
-        Knowledge base + few-shot + CoT
-        This is the baseline study.
-        We use a knowledge base, and examples for each category
-        which contain reasoning chains
+        Returns the study definition for an agent_type
         """
-        print(f"\n------ Ablation Study: Beginning Base Study for {adverb} ------")
+        for study in self.studies:
+            if study["agent_type"] == agent_type:
+                return study
+        raise KeyError(f"No ablation study is defined for agent_type '{agent_type}'")
 
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base
-        # ----------
-        if self.knowledge_base_cache is None:
-            print("Creating knowledge base")
-            self.knowledge_base.create_examples_knowledge_base()
-            self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
+    def _get_knowledge_base(self, variant):
+        """
+        Returns the knowledge base text and the answer mappings for a knowledge base variant.
+        Each variant is only created once.
+        Studies without a knowledge base still need the mappings from answer letters to categories,
+        so they use the mappings of the examples knowledge base.
+        """
+        key = variant or "examples"
+        if key not in self.knowledge_base_cache:
+            print(f"Creating knowledge base: {key}")
+            if key == "examples":
+                self.knowledge_base.create_examples_knowledge_base()
+            elif key == "broad":
+                self.knowledge_base.create_broad_adverb_knowledge_base()
+            else:
+                raise ValueError(f"Unknown knowledge base variant '{variant}'")
+            self.knowledge_base_cache[key] = (
+                self.knowledge_base.get_knowledge_base(),
+                dict(self.knowledge_base.get_knowledge_base_mappings())
+            )
+        knowledge_base_text, mappings = self.knowledge_base_cache[key]
+        if variant is None:
+            return "", mappings
+        return knowledge_base_text, mappings
 
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
+    def request_study(self, study: dict, sentence: str, adverb: str):
+        """
+        Sends one sentence and adverb to the LLM for one study.
+        Returns the raw server response, or None if the request failed (see error logs)
+        """
+        knowledge_base_text, mappings = self._get_knowledge_base(study["knowledge_base"])
+        prompt = "" # No extra instructions in the studies
+        sampled = self.self_consistency > 1 and study["has_CoT"] and not study.get("scoring")
+        return self._send_request(
             prompt,
-            "base_study",
-            knowledge_base = self.knowledge_base_cache,
+            study["agent_type"],
+            knowledge_base = knowledge_base_text,
             sentence = sentence,
             adverb = adverb,
-            temperature = 0.0,
-            n_predict = 256
+            temperature = self.self_consistency_temperature if sampled else 0.0,
+            n_predict = study["n_predict"],
+            answer_prefix = answer_prefix_for(str(self.chat_template), study["agent_type"]) if study.get("scoring") else None,
+            examples = self.knowledge_base.get_examples(sentence, adverb) if study.get("few_shot") else None,
+            n_sequences = self.self_consistency if sampled else 1,
+            answer_letters = tuple(mappings) if study.get("scoring") else None
         )
+
+    def parse_study(self, study: dict, data, sentence: str, adverb: str):
+        """
+        Turns the server response of one study into the parsed record returned to the pipeline
+        """
         if data is None:
-            print(f"Request failed for adverb '{adverb}', see error logs")
+            print(f"Request failed for adverb '{adverb}' in {study['agent_type']}, see error logs")
             return None
+        _, mappings = self._get_knowledge_base(study["knowledge_base"])
+        sequences = self.llm_client.get_sequences(data)
+        if len(sequences) > 1:
+            return self.vote(sequences, sentence, adverb, study["has_CoT"], mappings)
+        raw, logprobs = sequences[0]
+        parsed = self.process_data(raw, logprobs, sentence, adverb, study["has_CoT"], mappings)
+        if study.get("scoring"):
+            parsed["ppl"] = None # Nothing was generated before the answer
+        return parsed
 
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        print(raw)
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, True) # Has chain of thought
-        print(parsed)
+    def vote(self, sequences, sentence: str, adverb: str, has_CoT: bool, mappings: dict):
+        """
+        Self-consistency: parses every sampled chain and returns the record of the majority answer.
+        The chain of thought is that of the chain with the lowest perplexity among those that voted for it,
+        the perplexity and the answer probability distribution are the means over the chains.
+        Chains that did not reach a valid final answer do not vote.
+        """
+        chains = []
+        for raw, logprobs in sequences:
+            try:
+                chains.append(self.process_data(raw, logprobs, sentence, adverb, has_CoT, mappings))
+            except (TypeError, KeyError, IndexError):
+                continue # No final answer, or not one of the choices
+        result = self.prob_handler.aggregate_chains(chains)
+        parsed = dict(chains[result["best_chain"]])
+        parsed["final_answer"] = result["final_answer"]
+        parsed["category"] = mappings[result["final_answer"]]
+        parsed["ppl"] = result["ppl"]
+        parsed["probdist"] = result["probdist"]
+        parsed["self_consistency"] = {
+            "votes": result["votes"],
+            "vote_share": result["vote_share"],
+            "chains": len(sequences)
+        }
+        return parsed
 
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Base Study for adverb '{adverb}': \n {parsed}")
+    def run_study(self, study: dict, sentence: str, adverb: str):
+        """
+        Runs one study of the ablation matrix for one sentence and adverb
+        """
+        print(f"\n------ Ablation Study: Beginning {study['agent_type']} for {adverb} ------")
+        data = self.request_study(study, sentence, adverb)
+        parsed = self.parse_study(study, data, sentence, adverb)
+        print(f"\n------ {study['agent_type']} for adverb '{adverb}': \n {parsed}")
         return parsed
 
+    def base_study(self, sentence: str, adverb: str):
+        """
+        Knowledge base + few-shot + CoT
+        This is the baseline study.
+        We use a knowledge base, and examples for each category
+        which contain reasoning chains
+        """
+        return self.run_study(self.get_study("base_study"), sentence, adverb)
+
     def kb_oneshot_cot(self, sentence: str, adverb: str):
         """
         Knowledge base + one-shot + CoT
         This is ablation study 1
         """
-        print(f"\n------ Ablation Study: Beginning Ablation 1 - Knowledge base + one-shot + CoT for {adverb} ------")
-
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base
-        # ----------
-        if self.knowledge_base_cache is None:
-            self.knowledge_base.create_examples_knowledge_base()
-            self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
-
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
-            prompt,
-            "kb_oneshot_cot",
-            knowledge_base = self.knowledge_base_cache,
-            sentence = sentence,
-            adverb = adverb,
-            temperature = 0.0,
-            n_predict = 128
-        )
-
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, True) # Has chain of thought
-
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Ablation study 1 for adverb '{adverb}': \n {parsed}")
-        return parsed
+        return self.run_study(self.get_study("kb_oneshot_cot"), sentence, adverb)
     
     def kb_zeroshot(self, sentence: str, adverb: str):
         """
@@ -164,45 +226,7 @@ class AdverbsAblationStudy:
         This is ablation study 2
         In this study, we keep the knowledge base but use no examples
         """
-        print(f"\n------ Ablation Study: Beginning Ablation 2 - Knowledge base + zero shot for {adverb} ------")
-
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base
-        # ----------
-        if self.knowledge_base_cache is None:
-            self.knowledge_base.create_examples_knowledge_base()
-            self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
-
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
-            prompt,
-            "kb_zeroshot",
-            knowledge_base = self.knowledge_base_cache,
-            sentence = sentence,
-            adverb = adverb,
-            temperature = 0.0,
-            n_predict = 128
-        )
-
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, False) # Does not have chain of thought
-
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Ablation study 2 for adverb '{adverb}': \n {parsed}")
-        return parsed
+        return self.run_study(self.get_study("kb_zeroshot"), sentence, adverb)
 
     def zeroshot(self, sentence: str, adverb: str):
         """
@@ -210,47 +234,7 @@ class AdverbsAblationStudy:
         This is ablation study 3
         In this study, we offer no examples, just instructions
         """
-        print(f"\n------ Ablation Study: Beginning Ablation 3 - Zero shot for {adverb} ------")
-
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base 
-        # In this study the knowledge base is just the category names
-        # These are currently hard-coded into the jinja template
-        # ----------
-        # if self.knowledge_base_cache is None:
-        #     self.knowledge_base.create_broad_adverb_knowledge_base()
-        #     self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
-
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
-            prompt,
-            "zeroshot",
-            knowledge_base = "",
-            sentence = sentence,
-            adverb = adverb,
-            temperature = 0.0,
-            n_predict = 128
-        )
-
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, False) # Does not have chain of thought
-
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Ablation study 3 for adverb '{adverb}': \n {parsed}")
-        return parsed
+        return self.run_study(self.get_study("zeroshot"), sentence, adverb)
 
     def oneshot_cot(self, sentence: str, adverb: str):
         """
@@ -259,47 +243,7 @@ class AdverbsAblationStudy:
         In this study, we offer one example with a reasoning
         chain and instructions
         """
-        print(f"\n------ Ablation Study: Beginning Ablation 4 - One shot + CoT for {adverb} ------")
-
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base 
-        # In this study the knowledge base is just the category names
-        # These are currently hard-coded into the jinja template
-        # ----------
-        # if self.knowledge_base_cache is None:
-        #     self.knowledge_base.create_broad_adverb_knowledge_base()
-        #     self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
-
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
-            prompt,
-            "oneshot_cot",
-            knowledge_base = "",
-            sentence = sentence,
-            adverb = adverb,
-            temperature = 0.0,
-            n_predict = 128
-        )
-
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, True) # Has chain of thought
-
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Ablation study 4 for adverb '{adverb}': \n {parsed}")
-        return parsed
+        return self.run_study(self.get_study("oneshot_cot"), sentence, adverb)
 
     def fewshot_cot(self, sentence: str, adverb: str):
         """
@@ -308,47 +252,7 @@ class AdverbsAblationStudy:
         In this study, we offer examples for each category with
         reasoning chains and instructions, but no knowledge base.
         """
-        print(f"\n------ Ablation Study: Beginning Ablation 5 - Few shot + CoT for {adverb} ------")
-
-        # ----------
-        # Prepare the prompt
-        # ----------
-        prompt = "" # No extra instructions in the study
-
-        # ----------
-        # Prepare the knowledge base 
-        # In this study the knowledge base is just the category names
-        # These are currently hard-coded into the jinja template
-        # ----------
-        # if self.knowledge_base_cache is None:
-        #     self.knowledge_base.create_broad_adverb_knowledge_base()
-        #     self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
-
-        # ----------
-        # Send the data to the LLM
-        # ----------
-        data = self._send_request(
-            prompt,
-            "fewshot_cot",
-            knowledge_base = "",
-            sentence = sentence,
-            adverb = adverb,
-            temperature = 0.0,
-            n_predict = 128
-        )
-
-        # ----------
-        # Get the data back from the LLM and process the data
-        # ----------
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
-        parsed = self.process_data(raw, logprobs, sentence, adverb, True) # Has chain of thought
-
-        # ----------
-        # Send processed data back to the pipeline
-        # ----------
-        print(f"\n------ Ablation study 5 for adverb '{adverb}': \n {parsed}")
-        return parsed
+        return self.run_study(self.get_study("fewshot_cot"), sentence, adverb)
 
     # ----------
     # Clear the knowledge base cache
@@ -360,16 +264,20 @@ class AdverbsAblationStudy:
         """
         Necessary for reformulating the knowledge base for different studies
         """
-        self.knowledge_base_cache = None
+        self.knowledge_base_cache = {}
 
     # ----------
     # Process data retrieved back from the LLM
     # This utility method is called by all studies
     # ----------
-    def process_data(self, raw_llm_output, logprobs, sentence: str, adverb: str, has_CoT: bool):
+    def process_data(self, raw_llm_output, logprobs, sentence: str, adverb: str, has_CoT: bool, mappings: dict = None):
         """
         Data processing from the LLM is the same for each study
+        mappings: answer letter -> category, defaults to the mappings of the last created knowledge base
         """
+        if mappings is None:
+            mappings = self.knowledge_base.get_knowledge_base_mappings()
+
         # ----------
         # Handle the probabilities
         # ----------
@@ -398,7 +306,7 @@ class AdverbsAblationStudy:
         parsed["final_answer"] = logprobs["content"][final_answer_token_index]["token"].strip()
 
         # Add the category answer
-        parsed["category"] = self.knowledge_base.get_knowledge_base_mappings()[parsed["final_answer"]]
+        parsed["category"] = mappings[parsed["final_answer"]]
 
         # Add the perplexity to the output
         parsed["ppl"] = ppl
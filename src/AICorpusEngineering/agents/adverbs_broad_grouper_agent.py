@@ -1,8 +1,9 @@
-import requests, json, re
+import asyncio, json, re
 from pathlib import Path
 from datetime import datetime
 from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
 from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.llm_client.llm_client import LLMClient
 
 class BroadGrouperAgent:
     """
@@ -20,32 +21,35 @@ class BroadGrouperAgent:
             self, 
             server_url, 
             prob_handler: MCQProbHandler, 
-            knowledge_base: KnowledgeBase
+            knowledge_base: KnowledgeBase,
+            llm_client: LLMClient = None,
+            self_consistency: int = 1,
+            self_consistency_temperature: float = 0.7
         ):
+            """
+            self_consistency: number of reasoning chains sampled per adverb, which answer by majority vote (1: one greedy chain).
+            The chains share one evaluation of the prompt. Sentences with several adverbs (syntactic-grouper-multi) keep one chain.
+            self_consistency_temperature: sampling temperature of the chains
+            """
             self.server_url = server_url
             self.knowledge_base_cache = None
             self.prob_handler = prob_handler
             self.knowledge_base = knowledge_base
+            self.llm_client = llm_client or LLMClient(server_url) # Shared keep-alive connection to the server
+            self.self_consistency = max(1, self_consistency)
+            self.self_consistency_temperature = self_consistency_temperature
     
-    def _send_request(self, payload, agent_type, knowledge_base, sentence, adverb, temperature=0.001, n_predict=128):
-        response = requests.post(
-            f"{self.server_url}/chat/completions",
-            headers={"Content-Type": "application/json"},
-            data=json.dumps({
-                "messages": [{"role": "user", "content": payload}],
-                "chat_template_kwargs": {"agent_type": agent_type, "knowledge_base": knowledge_base, "sentence": sentence, "adverb": adverb},
-                "n_predict": n_predict,
-                "temperature": temperature,
-                "top_p": 0.85,
-                "logprobs": 1000,
-                "echo": False,
-                "stop": ["<|user|>", "<|system|>"]
-            })
+    def _send_request(self, payload, agent_type, knowledge_base, sentence, adverb, temperature=0.001, n_predict=128, examples=None, n_sequences=1):
+        chat_template_kwargs = {"agent_type": agent_type, "knowledge_base": knowledge_base, "sentence": sentence, "adverb": adverb}
+        if examples is not None:
+            chat_template_kwargs["examples"] = examples # Replaces the template's own few-shot examples
+        return self.llm_client.chat(
+            chat_template_kwargs,
+            messages=[{"role": "user", "content": payload}],
+            temperature=temperature,
+            n_predict=n_predict,
+            n_sequences=n_sequences
         )
-
-        if response.status_code != 200:
-            raise RuntimeError(f"Server error: {response.text}")
-        return response.json()
     
     def _parse_raw_to_json(self, raw_llm_response):
         """
@@ -117,29 +121,93 @@ class BroadGrouperAgent:
         }
         """
         print(f"\n########  GROUPING '{adverb}' with syntactic-grouper-agent.  ########")
-        prompt = ""
+        data = self.request_by_syntax(sentence, adverb)
+        return self.parse_by_syntax(data, sentence, adverb)
+
+    async def analyze_by_syntax_async(self, sentence: str, adverb: str):
+        """
+        Same as analyze_by_syntax, but the request to the LLM runs in a worker thread
+        so that many requests can be in flight at once.
+        The parsing of the response runs back on the event loop thread because
+        the prob_handler is shared between all requests.
+        """
+        self._prepare_knowledge_base()
+        data = await asyncio.to_thread(self.request_by_syntax, sentence, adverb)
+        return self.parse_by_syntax(data, sentence, adverb)
 
-        #knowledge_base = self._retrieve_knowledge_base()
-        # Construct the knowledge base if we do not already have it in cache
+    def _prepare_knowledge_base(self):
+        """
+        Construct the knowledge base if we do not already have it in cache
+        """
         if self.knowledge_base_cache is None:
             self.knowledge_base.create_broad_adverb_knowledge_base()
             self.knowledge_base_cache = self.knowledge_base.get_knowledge_base()
 
-        
+    def request_by_syntax(self, sentence: str, adverb: str):
+        """
+        Sends the sentence and adverb to the syntactic-grouper and returns the raw server response
+        """
+        prompt = ""
+        self._prepare_knowledge_base()
+
         # Send the data to the LMM
-        data = self._send_request(prompt, 
+        return self._send_request(prompt, 
                                   "syntactic-grouper", 
                                   knowledge_base = self.knowledge_base_cache, 
                                   sentence = sentence, 
                                   adverb = adverb, 
-                                  temperature=0.0,
-                                  n_predict=128
+                                  temperature=self.self_consistency_temperature if self.self_consistency > 1 else 0.0,
+                                  n_predict=128,
+                                  examples = self.knowledge_base.get_examples(sentence, adverb),
+                                  n_sequences = self.self_consistency
                                 )
 
+    def parse_by_syntax(self, data, sentence: str, adverb: str):
+        """
+        Turns the server response for one adverb into the parsed record described in analyze_by_syntax
+        """
         # Get the data back from the LMM
-        raw = data["choices"][0]["message"]["content"].strip()
-        logprobs = data["choices"][0]["logprobs"]
+        sequences = self.llm_client.get_sequences(data)
+        if len(sequences) > 1:
+            return self._vote(sequences, sentence, adverb)
+        raw, logprobs = sequences[0]
+        return self._build_record(self._chain_of_thought(raw), logprobs, sentence, adverb)
+
+    @staticmethod
+    def _chain_of_thought(raw):
+        # Get the chain of thought from the LLM
+        match = re.search(r"<\|assistant\|>(.*?)Final Answer", raw, re.DOTALL | re.IGNORECASE) # This assumes the output always starts with <|assistant|> and ends with Final Answer: 
+        if match:
+            return match.group(1).strip()
+        return raw # If the output was different, just put the raw LLM output into the parsed object
 
+    def _vote(self, sequences, sentence: str, adverb: str):
+        """
+        Self-consistency: builds the record of every sampled chain and returns the record of the majority answer,
+        with the chain of thought of its lowest-perplexity chain and the mean perplexity and probability distribution.
+        Chains without a valid final answer do not vote.
+        """
+        chains = []
+        for raw, logprobs in sequences:
+            try:
+                chains.append(self._build_record(self._chain_of_thought(raw), logprobs, sentence, adverb))
+            except (TypeError, KeyError, IndexError):
+                continue # No final answer, or not one of the choices
+        result = self.prob_handler.aggregate_chains(chains)
+        parsed = dict(chains[result["best_chain"]])
+        parsed["final_answer"] = result["final_answer"]
+        parsed["category"] = self.knowledge_base.get_knowledge_base_mappings()[result["final_answer"]]
+        parsed["ppl"] = result["ppl"]
+        parsed["probdist"] = result["probdist"]
+        parsed["self_consistency"] = {"votes": result["votes"], "vote_share": result["vote_share"], "chains": len(sequences)}
+        print(f"\nVoted {adverb}: {result['final_answer']} ({result['votes']})")
+        return parsed
+
+    def _build_record(self, chain_of_thought, logprobs, sentence: str, adverb: str):
+        """
+        Builds the parsed record of one adverb from its chain of thought and the logprobs
+        of its reasoning and final answer tokens
+        """
         ### Handle probabilities ###
         # Use prob_handlers to calculate reasoning complexity
         self.prob_handler.set_logprobs(logprobs)
@@ -155,12 +223,7 @@ class BroadGrouperAgent:
         parsed["sentence"] = sentence
         parsed["adverb"] = adverb
         
-        # Get the chain of thought from the LLM
-        match = re.search(r"<\|assistant\|>(.*?)Final Answer", raw, re.DOTALL | re.IGNORECASE) # This assumes the output always starts with <|assistant|> and ends with Final Answer: 
-        if match:
-            parsed["CoT"] = match.group(1).strip()
-        else:
-            parsed["CoT"] = raw # If the output was different, just put the raw LLM output into the parsed object
+        parsed["CoT"] = chain_of_thought
 
         # Add the final answer token
         # First, get the final answer index token from the prob_handler because this class can find it
@@ -181,3 +244,80 @@ class BroadGrouperAgent:
         parsed["time"] = datetime.now().isoformat()
         print(f"\nAnalyzed {adverb}:\n{parsed}")
         return parsed
+
+    def analyze_sentence_by_syntax(self, sentence: str, adverbs: list):
+        """
+        Receives a sentence and all of its adverbs and classifies every adverb in a single generation
+        with the syntactic-grouper-multi agent, so the sentence, knowledge base and examples are evaluated once per sentence
+        instead of once per adverb.
+        Returns a list with one parsed record per adverb, in the order of adverbs, each
+        in the same shape as the record returned by analyze_by_syntax.
+        """
+        print(f"\n########  GROUPING {adverbs} with syntactic-grouper-agent.  ########")
+        data = self.request_sentence_by_syntax(sentence, adverbs)
+        return self.parse_sentence_by_syntax(data, sentence, adverbs)
+
+    async def analyze_sentence_by_syntax_async(self, sentence: str, adverbs: list):
+        """
+        Same as analyze_sentence_by_syntax, but the request to the LLM runs in a worker thread
+        (see analyze_by_syntax_async)
+        """
+        self._prepare_knowledge_base()
+        data = await asyncio.to_thread(self.request_sentence_by_syntax, sentence, adverbs)
+        missing = self._missing_answers(data, adverbs)
+        fallback = {}
+        for i in missing:
+            fallback[i] = await asyncio.to_thread(self.request_by_syntax, sentence, adverbs[i])
+        return self.parse_sentence_by_syntax(data, sentence, adverbs, fallback)
+
+    def request_sentence_by_syntax(self, sentence: str, adverbs: list):
+        """
+        Sends the sentence and all of its adverbs to the syntactic-grouper-multi and returns the raw server response
+        """
+        self._prepare_knowledge_base()
+        return self.llm_client.chat(
+            {"agent_type": "syntactic-grouper-multi", "knowledge_base": self.knowledge_base_cache, "sentence": sentence, "adverbs": list(adverbs)},
+            messages=[{"role": "user", "content": ""}],
+            temperature=0.0,
+            n_predict=128 * len(adverbs),
+            expected_answers=len(adverbs)
+        )
+
+    def _missing_answers(self, data, adverbs: list):
+        """
+        Returns the positions of the adverbs the generation did not answer, e.g., when it ran out of tokens
+        """
+        _, logprobs = self.llm_client.get_content_and_logprobs(data)
+        answer_finder = MCQProbHandler()
+        answer_finder.set_logprobs(logprobs)
+        n_answers = len(answer_finder.return_final_answer_token_indices())
+        return list(range(n_answers, len(adverbs)))
+
+    def parse_sentence_by_syntax(self, data, sentence: str, adverbs: list, fallback: dict = None):
+        """
+        Splits the server response for a whole sentence at each "Final answer: X" and turns every part
+        into the parsed record of its adverb, so each adverb keeps its own final answer,
+        reasoning perplexity and answer probability distribution.
+        Adverbs the generation did not answer are classified on their own with the syntactic-grouper;
+        fallback optionally holds their already requested responses by position.
+        """
+        fallback = fallback or {}
+        _, logprobs = self.llm_client.get_content_and_logprobs(data)
+        self.prob_handler.set_logprobs(logprobs)
+        parts = self.prob_handler.split_by_final_answers()
+
+        records = []
+        for i, adverb in enumerate(adverbs):
+            if i >= len(parts):
+                print(f"\nNo answer for '{adverb}' in the multi-adverb response; classifying it on its own")
+                single = fallback[i] if i in fallback else self.request_by_syntax(sentence, adverb)
+                records.append(self.parse_by_syntax(single, sentence, adverb))
+                continue
+            text = "".join(entry["token"] for entry in parts[i]["content"])
+            text = re.sub(r"<\|assistant\|>", "", text)
+            # Drop the "Adverb N: ..." header and the final answer line, keep the reasoning
+            text = re.sub(r"^\s*Adverb\s*\d+\s*:[^\n]*\n?", "", text, flags=re.IGNORECASE)
+            match = re.search(r"(.*?)Final Answer", text, re.DOTALL | re.IGNORECASE)
+            chain_of_thought = match.group(1).strip() if match else text.strip()
+            records.append(self._build_record(chain_of_thought, parts[i], sentence, adverb))
+        return records
@@ -0,0 +1,183 @@
+import asyncio
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+import importlib.resources as resources
+from AICorpusEngineering.llm_client.llm_client import answer_prefix_for
+
+class CascadeAgent:
+    """
+    Confidence-gated cascade in front of the BroadGrouperAgent.
+    Every adverb is first classified by a cheap tier: the syntactic-zeroshot agent (knowledge base, no examples
+    and no reasoning), which is scored with a single predicted token (see LLMClient.score_answer).
+    Only uncertain answers are escalated to the syntactic-grouper (knowledge base, few-shot examples and CoT).
+    An answer is uncertain when the top probability of the answer distribution is below min_probability,
+    or when its margin over the second most likely choice is below min_margin.
+    The records have the same shape as the records of the BroadGrouperAgent plus:
+        "tier": the agent_type that decided the final answer
+        "cascade": the {"tier", "final_answer", "probdist"} of the cheaper tier, when the adverb was escalated
+    The cascade has the same interface as the BroadGrouperAgent, so the TaggingPipeline can run either.
+    """
+    def __init__(
+            self,
+            grouper: BroadGrouperAgent,
+            min_probability: float = 0.8,
+            min_margin: float = 0.5,
+            cheap_agent_type: str = "syntactic-zeroshot",
+            chat_template = None
+        ):
+            """
+            chat_template: the template the server renders, read for the answer prefix of the cheap tier (default: adverbs.jinja)
+            """
+            self.grouper = grouper
+            self.llm_client = grouper.llm_client
+            self.min_probability = min_probability
+            self.min_margin = min_margin
+            self.cheap_agent_type = cheap_agent_type
+            self.chat_template = chat_template or resources.files("AICorpusEngineering.agent-templates").joinpath("adverbs.jinja")
+            self.stats = {"adverbs": 0, "escalated": 0, "cheap_failures": 0}
+
+    # ----------
+    # Cheap tier
+    # ----------
+    def request_cheap(self, sentence: str, adverb: str):
+        """
+        Scores the answer of the cheap tier for one adverb and returns the raw server response
+        """
+        self.grouper._prepare_knowledge_base()
+        return self.llm_client.chat(
+            {"agent_type": self.cheap_agent_type, "knowledge_base": self.grouper.knowledge_base_cache, "sentence": sentence, "adverb": adverb},
+            messages=[{"role": "user", "content": ""}],
+            temperature=0.0,
+            n_predict=8,
+            answer_prefix=answer_prefix_for(str(self.chat_template), self.cheap_agent_type),
+            answer_letters=tuple(self.grouper.knowledge_base.get_knowledge_base_mappings())
+        )
+
+    def parse_cheap(self, data, sentence: str, adverb: str):
+        """
+        Turns the cheap tier's response into a record of the same shape as the grouper's records
+        """
+        _, logprobs = self.llm_client.get_content_and_logprobs(data)
+        parsed = self.grouper._build_record(None, logprobs, sentence, adverb) # No chain of thought in the cheap tier
+        parsed["ppl"] = None # Nothing was generated before the answer
+        parsed["tier"] = self.cheap_agent_type
+        return parsed
+
+    def is_confident(self, probdist: dict):
+        """
+        True if the answer distribution is certain enough to keep the cheap tier's answer
+        """
+        probabilities = sorted(probdist.values(), reverse=True) + [0.0, 0.0]
+        return probabilities[0] >= self.min_probability and probabilities[0] - probabilities[1] >= self.min_margin
+
+    def _request_cheap_or_error(self, sentence: str, adverb: str):
+        """
+        Returns the cheap tier's response, or the exception if the request failed
+        """
+        try:
+            return self.request_cheap(sentence, adverb)
+        except Exception as e:
+            return e
+
+    def _cheap_or_none(self, data, sentence: str, adverb: str):
+        """
+        Returns the cheap tier's record, or None if no answer could be read from it, in which case the adverb is escalated.
+        Any other failure, e.g., the RuntimeError of a server error, is raised like in the other pipelines.
+        """
+        try:
+            if isinstance(data, Exception):
+                raise data
+            return self.parse_cheap(data, sentence, adverb)
+        except (ValueError, KeyError) as e: # No answer letter among the scored tokens, or not one of the choices
+            print(f"\nCheap tier failed for '{adverb}', escalating: {e}")
+            self.stats["cheap_failures"] += 1
+            return None
+
+    def _decide(self, cheap):
+        """
+        Returns True if the cheap record decides the adverb, counting the outcome
+        """
+        self.stats["adverbs"] += 1
+        if cheap is not None and self.is_confident(cheap["probdist"]):
+            return True
+        self.stats["escalated"] += 1
+        return False
+
+    def _escalated(self, parsed, cheap, tier="syntactic-grouper"):
+        """
+        Marks a record of the grouper as decided by the grouper after the cheap tier
+        """
+        if not parsed:
+            return parsed
+        parsed["tier"] = tier
+        if cheap is not None:
+            parsed["cascade"] = {"tier": cheap["tier"], "final_answer": cheap["final_answer"], "probdist": cheap["probdist"]}
+        return parsed
+
+    # ----------
+    # Same interface as the BroadGrouperAgent
+    # ----------
+    def analyze_by_syntax(self, sentence: str, adverb: str):
+        cheap = self._cheap_or_none(self._request_cheap_or_error(sentence, adverb), sentence, adverb)
+        if self._decide(cheap):
+            return cheap
+        return self._escalated(self.grouper.analyze_by_syntax(sentence, adverb), cheap)
+
+    async def analyze_by_syntax_async(self, sentence: str, adverb: str):
+        self.grouper._prepare_knowledge_base()
+        data = await asyncio.to_thread(self._request_cheap_or_error, sentence, adverb)
+        cheap = self._cheap_or_none(data, sentence, adverb)
+        if self._decide(cheap):
+            return cheap
+        return self._escalated(await self.grouper.analyze_by_syntax_async(sentence, adverb), cheap)
+
+    def analyze_sentence_by_syntax(self, sentence: str, adverbs: list):
+        """
+        Scores every adverb with the cheap tier and sends only the uncertain adverbs of the sentence,
+        together, to the grouper's multi-adverb request
+        """
+        cheap = [self._cheap_or_none(self._request_cheap_or_error(sentence, adverb), sentence, adverb) for adverb in adverbs]
+        uncertain = [i for i, record in enumerate(cheap) if not self._decide(record)]
+        if not uncertain:
+            return cheap
+        uncertain_adverbs = [adverbs[i] for i in uncertain]
+        data = self.grouper.request_sentence_by_syntax(sentence, uncertain_adverbs)
+        single = self.grouper._missing_answers(data, uncertain_adverbs) # Classified on their own by the grouper
+        escalated = self.grouper.parse_sentence_by_syntax(data, sentence, uncertain_adverbs)
+        return self._merge(cheap, uncertain, escalated, single)
+
+    async def analyze_sentence_by_syntax_async(self, sentence: str, adverbs: list):
+        self.grouper._prepare_knowledge_base()
+        responses = await asyncio.gather(*(asyncio.to_thread(self._request_cheap_or_error, sentence, adverb) for adverb in adverbs))
+        cheap = [self._cheap_or_none(data, sentence, adverb) for adverb, data in zip(adverbs, responses)]
+        uncertain = [i for i, record in enumerate(cheap) if not self._decide(record)]
+        if not uncertain:
+            return cheap
+        uncertain_adverbs = [adverbs[i] for i in uncertain]
+        data = await asyncio.to_thread(self.grouper.request_sentence_by_syntax, sentence, uncertain_adverbs)
+        single = self.grouper._missing_answers(data, uncertain_adverbs)
+        fallback = {}
+        for n in single:
+            fallback[n] = await asyncio.to_thread(self.grouper.request_by_syntax, sentence, uncertain_adverbs[n])
+        escalated = self.grouper.parse_sentence_by_syntax(data, sentence, uncertain_adverbs, fallback)
+        return self._merge(cheap, uncertain, escalated, single)
+
+    def _merge(self, cheap, uncertain, escalated, single=()):
+        """
+        Puts the escalated records back in the order of the adverbs.
+        single: the positions in escalated of the adverbs the multi-adverb generation did not answer,
+        which the grouper classified on their own with the syntactic-grouper
+        """
+        records = list(cheap)
+        for n, (i, parsed) in enumerate(zip(uncertain, escalated)):
+            records[i] = self._escalated(parsed, cheap[i], "syntactic-grouper" if n in single else "syntactic-grouper-multi")
+        return records
+
+    def report(self):
+        adverbs = self.stats["adverbs"]
+        escalated = self.stats["escalated"]
+        share = escalated / adverbs if adverbs else 0.0
+        return (
+            f"Cascade: {adverbs - escalated} of {adverbs} adverbs decided by {self.cheap_agent_type}, "
+            f"{escalated} ({share:.1%}) escalated to syntactic-grouper"
+            + (f", {self.stats['cheap_failures']} cheap tier failures" if self.stats["cheap_failures"] else "")
+        )
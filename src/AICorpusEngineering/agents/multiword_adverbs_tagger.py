@@ -1,6 +1,6 @@
 from pathlib import Path
 from datetime import datetime
-import requests, json
+from AICorpusEngineering.llm_client.llm_client import LLMClient
 
 class MWAdverbs:
     """
@@ -11,28 +11,19 @@ class MWAdverbs:
     def __init__(
             self,
             server_url,
+            llm_client: LLMClient = None
     ):
         self.server_url = server_url
+        self.llm_client = llm_client or LLMClient(server_url) # Shared keep-alive connection to the server
 
     def _send_request(self, payload, sentence, temperature=0.001, n_predict=128):
-        response = requests.post(
-            f"{self.server_url}/chat/completions",
-            headers={"Content-Type": "application/json"},
-            data=json.dumps({
-                "messages": [{"role": "user", "content": payload}],
-                "chat_template_kwargs": {"sentence": sentence},
-                "n_predict": n_predict,
-                "temperature": temperature,
-                "top_p": 0.85,
-                "logprobs": 1000,
-                "echo": False,
-                "stop": ["<|user|>", "<|system|>"]
-            })
+        return self.llm_client.chat(
+            {"agent_type": "mw_adverb_analyst", "sentence": sentence}, # The broker's combined template picks the branch by agent_type
+            messages=[{"role": "user", "content": payload}],
+            temperature=temperature,
+            n_predict=n_predict,
+            agent_type="mw_adverb_analyst"
         )
-
-        if response.status_code != 200:
-            raise RuntimeError(f"Server error: {response.text}")
-        return response.json()
     
     def get_mw_adverbs(self, sentence: str):
         """
@@ -48,5 +39,5 @@ class MWAdverbs:
             n_predict = 256
         )
 
-        raw = data["choices"][0]["message"]["content"].strip()
+        raw, _ = self.llm_client.get_content_and_logprobs(data)
         return raw
\ No newline at end of file
@@ -0,0 +1,140 @@
+from pathlib import Path
+import json
+import math
+import re
+
+WORD_PATTERN = re.compile(r"[a-z']+")
+# Words that say nothing about how an adverb is used
+STOP_WORDS = {"a", "an", "the", "and", "or", "of", "to", "in", "on", "at", "for", "by", "with", "is", "was", "are", "were", "be", "it", "we", "i", "you", "she", "he", "they"}
+
+def sentence_words(sentence: str):
+    return {word for word in WORD_PATTERN.findall(sentence.lower()) if word not in STOP_WORDS}
+
+def char_ngrams(word: str, n: int = 3):
+    """
+    Returns the character n-grams of a word padded with ^ and $, so that adverbs sharing a stem or a suffix (-ly) overlap
+    """
+    padded = f"^{word.lower().strip()}$"
+    return {padded[i:i + n] for i in range(max(1, len(padded) - n + 1))}
+
+def jaccard(a: set, b: set):
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def sentence_transformer_embedder(model_name: str):
+    """
+    Returns an embedder (a function from a list of texts to a list of vectors) that runs a
+    local sentence-transformers model. sentence-transformers is an optional dependency.
+    """
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as exc:
+        raise RuntimeError("Embedding similarity needs sentence-transformers: pip install aicorpusengineering[embeddings]") from exc
+    model = SentenceTransformer(model_name)
+    return lambda texts: [list(vector) for vector in model.encode(list(texts))]
+
+
+class ExamplePool:
+    """
+    Indexed pool of worked few-shot examples (knowledge_base/examples.json) from which the examples
+    most similar to a request are picked, instead of putting every example into every prompt.
+    Each example is {"sentence", "adverb", "reasoning": [lines], "answer": letter, "category"}.
+
+    The similarity of an example to a request is
+        adverb_weight * overlap of the character trigrams of the adverbs (1.0 for the same adverb)
+        + sentence_weight * overlap of the words of the sentences, without stop words
+        + embedding_weight * cosine similarity of the embeddings of "adverb: sentence", when an embedder is given
+    Only the examples sharing a trigram or a word with the request are scored, through an inverted index,
+    unless an embedder is given, in which case every example is a candidate.
+    """
+    def __init__(self, examples: list, embedder=None, adverb_weight: float = 1.0, sentence_weight: float = 0.5, embedding_weight: float = 1.0):
+        """
+        embedder: optional function from a list of texts to a list of vectors, e.g., sentence_transformer_embedder(model_name)
+        """
+        self.examples = examples
+        self.embedder = embedder
+        self.adverb_weight = adverb_weight
+        self.sentence_weight = sentence_weight
+        self.embedding_weight = embedding_weight
+        self.index = {} # trigram or word -> ids of the examples that contain it
+        self.features = []
+        for i, example in enumerate(examples):
+            features = (char_ngrams(example["adverb"]), sentence_words(example["sentence"]))
+            self.features.append(features)
+            for term in features[0] | features[1]:
+                self.index.setdefault(term, set()).add(i)
+        self.vectors = self.embedder([self._embedding_text(e["sentence"], e["adverb"]) for e in examples]) if embedder is not None else None
+
+    @classmethod
+    def from_file(cls, path=None, **kwargs):
+        """
+        Loads the pool from a JSON file with an "Examples" list; by default the bundled examples.json
+        """
+        path = Path(path) if path is not None else Path(__file__).resolve().parent / "examples.json"
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                examples = json.load(f)["Examples"]
+        except FileNotFoundError as exc:
+            raise RuntimeError(f"Example pool not found at {path}.") from exc
+        return cls(examples, **kwargs)
+
+    @staticmethod
+    def _embedding_text(sentence: str, adverb: str):
+        return f"{adverb}: {sentence}"
+
+    def __len__(self):
+        return len(self.examples)
+
+    def scores(self, sentence: str, adverb: str):
+        """
+        Returns {example id: similarity} of the candidate examples for a request
+        """
+        adverb_grams, words = char_ngrams(adverb), sentence_words(sentence)
+        if self.vectors is not None:
+            candidates = range(len(self.examples))
+            query = self.embedder([self._embedding_text(sentence, adverb)])[0]
+        else:
+            candidates = set().union(*(self.index.get(term, set()) for term in adverb_grams | words))
+        scores = {}
+        for i in candidates:
+            example_grams, example_words = self.features[i]
+            score = self.adverb_weight * jaccard(adverb_grams, example_grams) + self.sentence_weight * jaccard(words, example_words)
+            if self.vectors is not None:
+                score += self.embedding_weight * cosine(query, self.vectors[i])
+            scores[i] = score
+        return scores
+
+    def select(self, sentence: str, adverb: str, k: int):
+        """
+        Returns the k examples most similar to the request, the most similar last so that it is
+        closest to the request in the prompt. An example identical to the request is never selected.
+        Ties keep the order of the pool, and examples without any overlap fill up to k.
+        """
+        if k <= 0:
+            return []
+        scores = self.scores(sentence, adverb)
+        same = (" ".join(sentence.lower().split()), adverb.lower().strip())
+        allowed = [
+            i for i, example in enumerate(self.examples)
+            if (" ".join(example["sentence"].lower().split()), example["adverb"].lower().strip()) != same
+        ]
+        ranked = sorted(allowed, key=lambda i: (-scores.get(i, 0.0), i))
+        return [self.examples[i] for i in reversed(ranked[:k])]
+
+    @staticmethod
+    def format_examples(examples: list):
+        """
+        Returns the examples as the few-shot turns of the agent templates
+        """
+        turns = []
+        for example in examples:
+            reasoning = "\n".join(f"{n}. {line}" for n, line in enumerate(example["reasoning"], start=1))
+            turns.append(
+                f"<|user|>\n{{ \"sentence\": \"{example['sentence']}\", \"adverb\": \"{example['adverb']}\" }}\n\n"
+                f"<|assistant|>\n{reasoning}\nFinal answer: {example['answer']}\n\n"
+            )
+        return "".join(turns)
@@ -1,5 +1,6 @@
 from pathlib import Path
 import json
+from AICorpusEngineering.knowledge_base.example_pool import ExamplePool, sentence_transformer_embedder
 
 class KnowledgeBase:
     """
@@ -10,6 +11,8 @@ class KnowledgeBase:
         print("Initialize the knowledge base")
         self.knowledge_base = ""
         self.knowledge_base_mappings = {}
+        self.example_pool = None
+        self.few_shot_k = None
 
     def create_examples_knowledge_base(self):
         """
@@ -76,6 +79,28 @@ class KnowledgeBase:
 
         print(f"Knowledge base prepared: {self.knowledge_base}")
     
+    def create_example_pool(self, k: int = 3, embedding_model: str = None, path=None):
+        """
+        Dynamic few-shot mode: instead of the fixed few-shot examples written in the templates,
+        each request gets the k examples of an indexed pool (examples.json) that are most similar
+        to its adverb and sentence, see ExamplePool.
+        embedding_model: optional local sentence-transformers model, to add embedding similarity to the lexical overlap
+        path: optional JSON file with an "Examples" list, by default the bundled examples.json
+        """
+        embedder = sentence_transformer_embedder(embedding_model) if embedding_model else None
+        self.example_pool = ExamplePool.from_file(path, embedder=embedder)
+        self.few_shot_k = k
+        print(f"Example pool prepared: {len(self.example_pool)} examples, {k} per request")
+
+    def get_examples(self, sentence: str, adverb: str):
+        """
+        Returns the few-shot turns to inject into the template for a request,
+        or None if the dynamic few-shot mode is off and the template's own examples are used
+        """
+        if self.example_pool is None:
+            return None
+        return self.example_pool.format_examples(self.example_pool.select(sentence, adverb, self.few_shot_k))
+
     def get_knowledge_base(self):
         """
         Returns the string containing the created knowledge base.
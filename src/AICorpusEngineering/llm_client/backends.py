@@ -0,0 +1,222 @@
+import threading
+import time
+from collections.abc import Sequence
+from pathlib import Path
+from AICorpusEngineering.llm_client.llm_client import FINAL_ANSWER_PATTERN
+
+# ----------
+# Inference backends of the LLMClient
+# By default the LLMClient sends every request to llama-server over HTTP. With a backend, the prompt is
+# rendered by the client (PromptRenderer) and handed to the backend, which returns the same chat completion
+# shape, so the agents and MCQProbHandler read the responses unchanged.
+# ----------
+
+class InferenceBackend:
+    """
+    Interface of an inference backend.
+    generate() returns {"choices": [{"index", "message": {"role", "content"}, "logprobs": {"content": [...]}, "finish_reason"}],
+    "timings": {"prompt_n", "cache_n", "prompt_ms", "predicted_n", "predicted_ms"}} like llama-server's chat completions.
+    next_token() returns the top_k {"id", "token", "logprob"} entries of the token following the prompt, and the timings.
+    """
+    def generate(self, prompt: str, payload: dict, top_k: int, expected_answers: int = 1):
+        """
+        prompt: the rendered prompt
+        payload: the chat payload (see LLMClient.build_payload) with the sampling settings: n_predict, temperature, top_p, stop and n
+        top_k: number of top logprobs of every generated token
+        expected_answers: the generation stops once this many "Final answer: X" have been written
+        """
+        raise NotImplementedError
+
+    def next_token(self, prompt: str, top_k: int):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class TopLogprobs(Sequence):
+    """
+    The top logprobs of one token, kept as the arrays the backend computed them in: token ids and logprobs,
+    most likely first. The {"id", "token", "logprob"} entries are only built when they are read, which
+    for most tokens is never, as MCQProbHandler only reads those of the final answer token.
+    """
+    def __init__(self, ids, logprobs, piece):
+        """
+        piece: function from a token id to its text
+        """
+        self.ids = ids
+        self.logprobs = logprobs
+        self.piece = piece
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return {"id": int(self.ids[i]), "token": self.piece(int(self.ids[i])), "logprob": float(self.logprobs[i])}
+
+
+class LlamaCppBackend(InferenceBackend):
+    """
+    Runs the model in this process with the llama.cpp Python bindings (llama-cpp-python, an optional dependency).
+    There is no HTTP or JSON between the agents and the model: the logits of every step are read as a numpy array,
+    and the top logprobs are kept as arrays (TopLogprobs).
+    The prompt is evaluated from the longest prefix already in the KV cache, so the static prefix of an agent
+    is only evaluated again when another agent's prompt was evaluated in between, as with one llama-server slot.
+    There is one context, so requests run one at a time. Grammars are not supported, a payload with one raises a ValueError.
+    """
+    def __init__(self, model_path, n_ctx: int = 8192, n_threads: int = 6, n_gpu_layers: int = 0, n_batch: int = 512, seed: int = 0, eos_token: str = "<|eot_id|>"):
+        """
+        eos_token: the end of turn token of the chat template, which ends a generation like the model's own end of sequence token
+        """
+        try:
+            import llama_cpp
+            import numpy
+        except ImportError as exc:
+            raise RuntimeError("The in-process backend needs llama-cpp-python: pip install aicorpusengineering[llamacpp]") from exc
+        self._llama_cpp = llama_cpp
+        self._np = numpy
+        self.model_path = Path(model_path)
+        self.llm = llama_cpp.Llama(
+            model_path=str(self.model_path),
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_gpu_layers=n_gpu_layers,
+            n_batch=n_batch,
+            seed=seed,
+            logits_all=False,
+            verbose=False
+        )
+        self.n_vocab = self.llm.n_vocab()
+        self.rng = numpy.random.default_rng(seed)
+        self.end_tokens = {self.llm.token_eos()}
+        eos_ids = self.llm.tokenize(eos_token.encode("utf-8"), add_bos=False, special=True)
+        if len(eos_ids) == 1:
+            self.end_tokens.add(eos_ids[0])
+        self._pieces = {} # token id -> text
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_profile(cls, model_path, profile: dict, n_ctx: int = 8192, threads=None):
+        """
+        Loads the model with the threads, batch size and GPU layers of a server profile (see server_profiles.py)
+        threads: overrides the profile's threads (default: the profile's threads, else 6)
+        """
+        return cls(
+            model_path,
+            n_ctx=n_ctx,
+            n_threads=threads or profile.get("threads") or 6,
+            n_gpu_layers=profile.get("n_gpu_layers") or 0,
+            n_batch=profile.get("batch_size") or 512
+        )
+
+    def piece(self, token_id: int):
+        if token_id not in self._pieces:
+            self._pieces[token_id] = self.llm.detokenize([token_id]).decode("utf-8", errors="replace")
+        return self._pieces[token_id]
+
+    def _evaluate(self, prompt: str):
+        """
+        Evaluates the prompt from the longest prefix already in the KV cache and returns (evaluated, reused) token counts.
+        At least the last prompt token is evaluated, for the logits of the next token.
+        """
+        np = self._np
+        tokens = self.llm.tokenize(prompt.encode("utf-8"), add_bos=False, special=True) # The template writes the bos token
+        if len(tokens) >= self.llm.n_ctx():
+            raise RuntimeError(f"The prompt has {len(tokens)} tokens, more than the context of {self.llm.n_ctx()}")
+        limit = min(self.llm.n_tokens, len(tokens) - 1)
+        mismatches = np.nonzero(self.llm.input_ids[:limit] != np.asarray(tokens[:limit], dtype=self.llm.input_ids.dtype))[0]
+        reused = int(mismatches[0]) if len(mismatches) else limit
+        self.llm.n_tokens = reused # eval() drops the KV cache after n_tokens
+        self.llm.eval(tokens[reused:])
+        return len(tokens) - reused, reused
+
+    def _logprobs(self):
+        """
+        Returns the log softmax of the logits of the last evaluated token
+        """
+        np = self._np
+        logits = np.ctypeslib.as_array(self._llama_cpp.llama_get_logits(self.llm.ctx), shape=(self.n_vocab,)).astype(np.float64)
+        shifted = logits - logits.max()
+        return shifted - np.log(np.exp(shifted).sum())
+
+    def _top(self, logprobs, top_k: int):
+        np = self._np
+        top_k = min(top_k, self.n_vocab)
+        ids = np.argpartition(-logprobs, top_k - 1)[:top_k]
+        ids = ids[np.argsort(-logprobs[ids])]
+        return TopLogprobs(ids, logprobs[ids], self.piece)
+
+    def _sample(self, logprobs, temperature: float, top_p: float):
+        """
+        Greedy below a temperature of 0.01, otherwise nucleus sampling
+        """
+        np = self._np
+        if temperature < 0.01:
+            return int(np.argmax(logprobs))
+        probs = np.exp((logprobs - logprobs.max()) / temperature)
+        probs /= probs.sum()
+        order = np.argsort(-probs)
+        keep = order[:int(np.searchsorted(np.cumsum(probs[order]), top_p)) + 1]
+        return int(self.rng.choice(keep, p=probs[keep] / probs[keep].sum()))
+
+    def generate(self, prompt: str, payload: dict, top_k: int, expected_answers: int = 1):
+        if payload.get("grammar"):
+            raise ValueError("The in-process backend does not apply GBNF grammars")
+        n_predict = payload.get("n_predict", -1)
+        if n_predict is None or n_predict < 0:
+            n_predict = self.llm.n_ctx()
+        stops = payload.get("stop") or []
+        choices = []
+        timings = {"prompt_n": 0, "cache_n": 0, "prompt_ms": 0.0, "predicted_n": 0, "predicted_ms": 0.0}
+        with self._lock:
+            for index in range(max(1, payload.get("n", 1))):
+                started = time.perf_counter()
+                evaluated, reused = self._evaluate(prompt) # Sequences after the first reuse the whole prompt
+                if index == 0:
+                    timings.update(prompt_n=evaluated, cache_n=reused, prompt_ms=1000 * (time.perf_counter() - started))
+                started = time.perf_counter()
+                content, text, finish_reason = [], "", "length"
+                for step in range(n_predict):
+                    logprobs = self._logprobs()
+                    token = self._sample(logprobs, payload.get("temperature", 0.0), payload.get("top_p", 1.0))
+                    if token in self.end_tokens:
+                        finish_reason = "stop"
+                        break
+                    piece = self.piece(token)
+                    stop = next((s for s in stops if s in text + piece), None)
+                    if stop is not None:
+                        text = (text + piece)[:(text + piece).index(stop)]
+                        finish_reason = "stop"
+                        break
+                    entry = {"id": token, "token": piece, "logprob": float(logprobs[token])}
+                    if top_k:
+                        entry["top_logprobs"] = self._top(logprobs, top_k)
+                    content.append(entry)
+                    text += piece
+                    if len(FINAL_ANSWER_PATTERN.findall(text)) >= expected_answers:
+                        finish_reason = "stop" # Nothing after the final answer is used
+                        break
+                    if step + 1 < n_predict:
+                        self.llm.eval([token])
+                timings["predicted_n"] += len(content)
+                timings["predicted_ms"] += 1000 * (time.perf_counter() - started)
+                choices.append({
+                    "index": index,
+                    "message": {"role": "assistant", "content": text},
+                    "logprobs": {"content": content},
+                    "finish_reason": finish_reason
+                })
+        return {"choices": choices, "timings": timings}
+
+    def next_token(self, prompt: str, top_k: int):
+        with self._lock:
+            started = time.perf_counter()
+            evaluated, reused = self._evaluate(prompt)
+            top = self._top(self._logprobs(), top_k)
+        return list(top), {"prompt_n": evaluated, "cache_n": reused, "prompt_ms": 1000 * (time.perf_counter() - started), "predicted_n": 1, "predicted_ms": 0.0}
+
+    def close(self):
+        if hasattr(self.llm, "close"):
+            self.llm.close()
@@ -0,0 +1,71 @@
+# ----------
+# GBNF grammars sent with each request so that llama-server can only generate
+# output in the shape the agents parse. Generation ends as soon as the grammar is complete,
+# e.g., straight after the final answer letter, so no tokens are wasted and no output
+# needs to be repaired or re-run.
+# Grammars constrain characters, not tokens, so the model still writes the answer as " A" etc.
+# and MCQProbHandler finds the same choice tokens.
+# ----------
+
+ANSWER_LINE_PREFIX = "Final answer:"
+
+def text_not_starting_with(reserved: str):
+    """
+    Returns the alternatives of a GBNF rule matching any non-empty line of text that does not start with reserved.
+    The line may start with any proper prefix of reserved as long as it then differs from it, e.g., "Finally, ..."
+    or "Final answer" without the colon.
+    """
+    alternatives = [f'[^{reserved[0]}\\n] [^\\n]*']
+    for n in range(1, len(reserved)):
+        prefix = reserved[:n]
+        alternatives += [f'"{prefix}"', f'"{prefix}" [^{reserved[n]}\\n] [^\\n]*']
+    return " | ".join(alternatives)
+
+# Short step-by-step reasoning lines followed by the final answer.
+# Reasoning lines may not start with "Final answer:", which is reserved for the answer line.
+COT_FINAL_ANSWER = r'''
+root ::= line* "Final answer: " [A-E]
+line ::= text? "\n"
+text ::= ''' + text_not_starting_with(ANSWER_LINE_PREFIX) + "\n"
+
+# One block of reasoning lines and final answer per question, e.g., per adverb of the sentence.
+# The "Adverb N: ..." header opening each block is an ordinary reasoning line.
+COT_FINAL_ANSWERS = r'''
+root ::= block ("\n" block)*
+block ::= line* "Final answer: " [A-E]
+line ::= text? "\n"
+text ::= ''' + text_not_starting_with(ANSWER_LINE_PREFIX) + "\n"
+
+# Only the final answer, optionally after the assistant tag the templates use
+FINAL_ANSWER_ONLY = r'''
+root ::= ("<|assistant|>" [ \n]*)? "Final answer: " [A-E]
+'''
+
+# The JSON object returned by the multiword adverb analyst, e.g., {"adverbs": ["In fact", "at the very least"]}
+MW_ADVERBS_JSON = r'''
+root ::= "{\"adverbs\": [" ( item ( ", " item )* )? "]}"
+item ::= "\"" [^"\\\n]+ "\""
+'''
+
+AGENT_GRAMMARS = {
+    # adverbs.jinja
+    "syntactic-grouper": COT_FINAL_ANSWER,
+    "syntactic-grouper-multi": COT_FINAL_ANSWERS,
+    "syntactic-zeroshot": FINAL_ANSWER_ONLY,
+    "semantic-thinker": COT_FINAL_ANSWER,
+    # ablation_adverbs_examples_kb.jinja
+    "base_study": COT_FINAL_ANSWER,
+    "kb_oneshot_cot": COT_FINAL_ANSWER,
+    "kb_zeroshot": FINAL_ANSWER_ONLY,
+    "zeroshot": FINAL_ANSWER_ONLY,
+    "oneshot_cot": COT_FINAL_ANSWER,
+    "fewshot_cot": COT_FINAL_ANSWER,
+    # mw_adverb_analyst.jinja
+    "mw_adverb_analyst": MW_ADVERBS_JSON,
+}
+
+def grammar_for(agent_type):
+    """
+    Returns the GBNF grammar for an agent_type, or None if its output is not constrained
+    """
+    return AGENT_GRAMMARS.get(agent_type)
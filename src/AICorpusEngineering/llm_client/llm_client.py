@@ -0,0 +1,937 @@
+import functools
+import json
+import math
+import re
+import threading
+import time
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+from AICorpusEngineering.llm_client.response_cache import ResponseCache
+from AICorpusEngineering.llm_client.grammars import grammar_for
+from AICorpusEngineering.llm_client.router import LeastOutstandingRouter
+from AICorpusEngineering.llm_client.prompt_renderer import PromptRenderer
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+
+# The generation is complete once the model has written its final answer letter
+FINAL_ANSWER_PATTERN = re.compile(r"final answer\s*:\s*[A-J]\b", re.IGNORECASE)
+ANSWER_LETTERS = ("A", "B", "C", "D", "E", "F", "G", "H", "I", "J")
+# What the model writes before the answer letter in the studies without reasoning, when the template has no example of it
+ANSWER_PREFIX = "<|assistant|>\nFinal answer:"
+# The assistant turn of a template example up to its answer letter
+EXAMPLE_ANSWER_PATTERN = re.compile(r"<\|assistant\|>[ \t]*\n[ \t]*Final answer:")
+
+@functools.lru_cache(maxsize=None)
+def answer_prefix_for(chat_template, agent_type: str):
+    """
+    Returns what the examples of an agent_type in a chat template write before the answer letter, e.g., "<|assistant|> \nFinal answer:",
+    so that a scored prompt continues exactly like the examples the model was shown.
+    Falls back to ANSWER_PREFIX when the agent_type's branch has no example answer.
+    """
+    template = Path(chat_template).read_text(encoding="utf-8")
+    branch = re.search(r"agent_type\s*==\s*[\"']" + re.escape(agent_type) + r"[\"']\s*%\}(.*?)\{%-?\s*(?:elif|else|endif)", template, re.DOTALL)
+    examples = EXAMPLE_ANSWER_PATTERN.findall(branch.group(1)) if branch else []
+    return examples[-1] if examples else ANSWER_PREFIX
+
+def percentile(values, q):
+    """
+    Returns the q-th percentile (0-100) of a list of numbers, or 0.0 for an empty list
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class LLMClient:
+    """
+    Shared client for sending requests to llama-server.
+    All agents send their requests through one instance of this class so that
+    connections to the server are kept alive and reused from a pool instead of
+    opening a new TCP connection for every classification.
+
+    Every request is built with the same payload schema:
+    {
+        "messages": [...],
+        "chat_template_kwargs": {...}, - the variables injected into the jinja template
+        "n_predict": int,
+        "temperature": float,
+        "top_p": 0.85,
+        "logprobs": 1000,
+        "echo": False,
+        "stop": ["<|user|>", "<|system|>"],
+        "cache_prompt": True, - reuse the KV cache of the prompt prefix already held by the slot
+        "id_slot": int - only when slot_affinity is switched on
+        "grammar": str - only when use_grammar is switched on, the GBNF grammar of the agent_type (see grammars.py)
+    }
+    and every response is returned as the server's chat completion JSON, from which
+    the content and logprobs can be taken with get_content_and_logprobs()
+
+    Logprob modes:
+    "full" - the top 1000 logprobs are returned for every generated token (the original behaviour)
+    "two_phase" - the generation only returns the logprob of each sampled token, which is all the perplexity needs.
+    A second scoring call then evaluates the prompt plus the generated tokens up to the final answer
+    and returns the top answer_top_k logprobs at that one position. They are put back into the
+    final answer token's top_logprobs, so MCQProbHandler calculates the same answer probabilities
+    from responses that are orders of magnitude smaller.
+
+    Streaming: with stream=True the response is read token by token as server-sent events and the
+    connection is closed as soon as "Final answer: X" has been generated, which cancels the rest of
+    the generation on the server. The streamed tokens are assembled into the same response shape.
+
+    Timing: every chat() call records its round trip time, the time the server reports it spent on the
+    prompt and the generation (timings.prompt_ms + predicted_ms), the time spent decoding the JSON and
+    the size of the response. The difference between the round trip and the server time is the client
+    overhead (HTTP, serialization, queueing). See timing_stats() and timing_report().
+
+    Client-side rendering: with a chat_template the agent template is rendered here instead of by the server
+    (see PromptRenderer). The static prefix of each agent_type and knowledge base is tokenized once through
+    the server's /tokenize, and every request is sent to the raw /completion endpoint as
+    [prefix token ids..., "per-sentence suffix"], so the server neither renders the template nor tokenizes
+    the prefix again, and the prompt reuse between requests is exact.
+    The responses are converted into the same chat completion shape.
+
+    Inference backends: with a backend (see backends.py) the requests do not go to llama-server at all.
+    The prompt is rendered here and the backend, e.g., the model loaded in this process, returns the same
+    chat completion shape. The backend returns the top answer_top_k logprobs of every generated token,
+    so the logprobs_mode, streaming and slots do not apply. Grammars are not supported.
+    """
+    def __init__(
+            self,
+            server_url,
+            pool_size: int = 4,
+            connect_timeout: float = 5.0,
+            base_timeout: float = 30.0,
+            seconds_per_token: float = 0.5,
+            cache_prompt: bool = True,
+            slot_affinity: bool = False,
+            n_slots: int = 1,
+            response_cache: ResponseCache = None,
+            cache_namespace: str = "",
+            logprobs_mode: str = "full",
+            answer_top_k: int = 1000,
+            stream: bool = False,
+            use_grammar: bool = False,
+            server_manager = None,
+            max_replays: int = 2,
+            throttle = None,
+            chat_template = None,
+            backend = None,
+            priority = None,
+            client_name = None
+        ):
+        """
+        server_url: location of the llama-server, e.g., http://127.0.0.1:8080,
+        or a list of locations when a pool of servers is running. Requests are then spread over the
+        servers by a LeastOutstandingRouter.
+        pool_size: number of keep-alive connections held open to the server
+        connect_timeout: seconds to wait for a connection to the server
+        base_timeout, seconds_per_token: the read timeout of each call is base_timeout + seconds_per_token * n_predict
+        so that long chain of thought generations are given more time than single letter answers
+        cache_prompt: ask the server to keep and reuse the KV cache of each slot's prompt
+        slot_affinity: pin each agent_type to its own slot id so that the long shared prompt prefix
+        (template header + knowledge base + few-shot examples) is only evaluated once per slot.
+        Only useful when requests are sent one at a time, as a pinned slot serves one request at a time.
+        n_slots: number of slots each server was started with (--parallel)
+        response_cache: optional persistent ResponseCache checked before sending deterministic (temperature 0) requests
+        cache_namespace: identifies the model and template the responses belong to, see ResponseCache.namespace_for
+        logprobs_mode: "full" or "two_phase", see above
+        answer_top_k: number of top logprobs requested at the final answer position in two_phase mode
+        server_manager: optional ServerManager; a request that loses its connection is replayed up to
+        max_replays times once the manager has the server running again. When the manager has a slot_cache_dir
+        the KV state of each static prompt prefix is saved and restored through it (see _prepare_slot_state).
+        throttle: optional AdaptiveThrottle or FixedCooldown (see pipelines/throttle.py), told about every
+        request so it can adjust the number of requests in flight and pause an overloaded server
+        chat_template: optional path of the template the server was started with, to render the prompts client-side
+        backend: optional InferenceBackend (see backends.py) that runs the requests instead of llama-server, which needs the chat_template
+        priority, client_name: sent with every request when server_url is an inference broker (see llm_server/broker.py),
+        which schedules the requests by priority ("interactive", "normal" or "batch") and shares the slots fairly between the clients
+        """
+        if logprobs_mode not in ("full", "two_phase"):
+            raise ValueError(f"Unknown logprobs_mode '{logprobs_mode}', use 'full' or 'two_phase'")
+        if backend is not None and chat_template is None:
+            raise ValueError("An inference backend needs the chat_template, the prompts are rendered by the client")
+        if backend is not None and use_grammar:
+            raise ValueError("Grammars are not applied by the inference backends; leave out use_grammar (--grammar) or use llama-server")
+        server_urls = [server_url] if isinstance(server_url, str) else list(server_url)
+        self.router = LeastOutstandingRouter(server_urls)
+        self.server_urls = self.router.server_urls
+        self.server_url = self.server_urls[0]
+        self.connect_timeout = connect_timeout
+        self.base_timeout = base_timeout
+        self.seconds_per_token = seconds_per_token
+        self.cache_prompt = cache_prompt
+        self.slot_affinity = slot_affinity
+        self.n_slots = max(1, n_slots)
+        self.slot_ids = {} # agent_type -> order in which the agent_type was pinned
+        self.cache_stats = {} # agent_type -> prompt cache counters
+        self.request_stats = {} # agent_type -> request timing counters
+        self.response_cache = response_cache
+        self.cache_namespace = cache_namespace
+        self.logprobs_mode = logprobs_mode
+        self.answer_top_k = answer_top_k
+        self.stream = stream
+        self.use_grammar = use_grammar
+        self.server_manager = server_manager
+        self.max_replays = max_replays
+        self.throttle = throttle
+        self.renderer = PromptRenderer(chat_template) if chat_template is not None else None
+        self.backend = backend
+        self.prefix_tokens = {} # static prefix text -> its token ids, or None when the server renders the prompts of the prefix
+        self._lock = threading.RLock()
+        self._prefix_lock = threading.Lock() # Held while a new static prefix is checked and tokenized
+        self.slot_states = {} # static prefix text -> its saved slot state file, or None when its state is not saved
+        self._state_renderer = None
+        self._slot_state_lock = threading.Lock() # Held while the state of a new static prefix is restored or saved
+        self._local = threading.local() # Timing of the chat() call running on each thread
+
+        # ----------
+        # Keep-alive connection pool
+        # ----------
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.server_urls), pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+        if priority is not None:
+            self.session.headers["X-Priority"] = priority
+        if client_name is not None:
+            self.session.headers["X-Client"] = client_name
+
+    def timeout_for(self, n_predict: int):
+        """
+        Returns the (connect, read) timeout for a call which generates n_predict tokens
+        """
+        return (self.connect_timeout, self.base_timeout + self.seconds_per_token * n_predict)
+
+    def _pin(self, agent_type):
+        """
+        Returns the order in which this agent_type was first seen.
+        Agent types are spread over the servers first and then over the slots of each server,
+        wrapping around when there are more agent types than slots.
+        """
+        with self._lock:
+            if agent_type not in self.slot_ids:
+                self.slot_ids[agent_type] = len(self.slot_ids)
+            return self.slot_ids[agent_type]
+
+    def slot_for(self, agent_type):
+        """
+        Returns the slot id pinned to this agent_type
+        """
+        return (self._pin(agent_type) // len(self.server_urls)) % self.n_slots
+
+    def server_for(self, agent_type):
+        """
+        Returns the server url pinned to this agent_type
+        """
+        return self.server_urls[self._pin(agent_type) % len(self.server_urls)]
+
+    def build_payload(self, chat_template_kwargs: dict, messages=None, temperature=0.001, n_predict=128, agent_type=None):
+        """
+        Builds the request body shared by all agents.
+        agent_type is added to the chat_template_kwargs when they lack it, as a template
+        holding several agent templates (see broker.combine_templates) renders by agent_type.
+        """
+        if agent_type is not None and "agent_type" not in chat_template_kwargs:
+            chat_template_kwargs = dict(chat_template_kwargs, agent_type=agent_type)
+        payload = {
+            "messages": messages if messages is not None else [],
+            "chat_template_kwargs": chat_template_kwargs,
+            "n_predict": n_predict,
+            "temperature": temperature,
+            "top_p": 0.85,
+            "logprobs": 1000,
+            "echo": False,
+            "stop": ["<|user|>", "<|system|>"],
+            "cache_prompt": self.cache_prompt
+        }
+        if self.logprobs_mode == "two_phase":
+            # Only the sampled token's logprob is needed during generation
+            payload["logprobs"] = True
+            payload["top_logprobs"] = 1
+        if self.slot_affinity:
+            payload["id_slot"] = self.slot_for(agent_type)
+        if self.use_grammar:
+            grammar = grammar_for(agent_type)
+            if grammar is not None:
+                payload["grammar"] = grammar
+        return payload
+
+    def post(self, path: str, payload: dict, n_predict: int = 128, server_url=None):
+        """
+        Sends an already built payload to an endpoint of the server and returns the decoded JSON.
+        server_url: the server to use; by default the router picks the least busy server.
+        Raises a RuntimeError if the server does not answer with status 200.
+        """
+        if server_url is None:
+            with self.router.route() as routed_url:
+                return self.post(path, payload, n_predict, routed_url)
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        response = self.session.post(
+            f"{server_url}{path}",
+            data=body,
+            timeout=self.timeout_for(n_predict)
+        )
+        if response.status_code != 200:
+            raise RuntimeError(f"Server error: {response.status_code} with body: {response.text[:200]}")
+        started = time.perf_counter()
+        data = response.json()
+        self._track_response(len(response.content), time.perf_counter() - started, data)
+        return data
+
+    def response_namespace(self, answer_prefix=None):
+        """
+        Returns the cache namespace of a request: the model and template, plus the client settings that change
+        the response without changing the payload, i.e., the logprobs mode, the number of top logprobs read
+        at the final answer, and whether the answer is scored or generated
+        """
+        mode = "score" if answer_prefix is not None else "generate"
+        return f"{self.cache_namespace}|logprobs_mode={self.logprobs_mode}|answer_top_k={self.answer_top_k}|{mode}"
+
+    def chat(self, chat_template_kwargs: dict, messages=None, temperature=0.001, n_predict=128, agent_type=None, expected_answers=1, answer_prefix=None, n_sequences=1, answer_letters=None):
+        """
+        Sends a chat completion request using the shared payload schema.
+        agent_type defaults to the agent_type injected into the template.
+        expected_answers: number of "Final answer: X" the generation should contain, e.g., one per adverb
+        for the syntactic-grouper-multi agent. Streaming stops after the last of them and
+        the two_phase mode scores each of them.
+        answer_prefix: scoring mode for agent types that answer without reasoning (see score_answer).
+        Nothing is generated: the prompt plus answer_prefix is evaluated once and the answer is read
+        from the distribution of the next token.
+        answer_letters: in scoring mode, the letters the agent may answer, e.g., the keys of its knowledge base mappings (default: ANSWER_LETTERS)
+        n_sequences: number of sequences sampled from one evaluation of the prompt (llama-server's n / n_cmpl),
+        e.g., for self-consistency voting. The response has one choice per sequence and is never streamed.
+        Each sequence runs on a slot of its own, so the server needs at least n_sequences slots and slot affinity does not apply.
+        """
+        if agent_type is None:
+            agent_type = chat_template_kwargs.get("agent_type")
+        payload = self.build_payload(chat_template_kwargs, messages, temperature, n_predict, agent_type)
+        if n_sequences > 1:
+            payload["n"] = n_sequences
+            payload.pop("id_slot", None) # The sequences are spread over free slots, a pinned slot only holds one
+        if answer_prefix is not None:
+            payload["answer_prefix"] = answer_prefix # Only used for the cache key; score_answer builds its own request
+            if answer_letters is not None:
+                payload["answer_letters"] = list(answer_letters)
+
+        # Deterministic requests are answered from the persistent response cache when possible
+        cache_key = None
+        if self.response_cache is not None and temperature <= 0:
+            cache_key = self.response_cache.make_key(self.response_namespace(answer_prefix), payload)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        if self.server_manager is not None and self.server_manager.slot_cache_dir is not None:
+            self._prepare_slot_state(payload, agent_type)
+
+        # A pinned agent_type always goes to the server holding its slot
+        preferred = self.server_for(agent_type) if self.slot_affinity else None
+        if self.throttle is not None:
+            self.throttle.wait()
+        self._local.tracker = {"bytes": 0, "decode_seconds": 0.0, "server_ms": 0.0, "predicted_n": 0, "timed": False}
+        started = time.perf_counter()
+        try:
+            if self.backend is not None:
+                data = self.backend_chat(payload, expected_answers, answer_prefix)
+            else:
+                for attempt in range(self.max_replays + 1):
+                    server_url = None
+                    try:
+                        with self.router.route(preferred) as server_url:
+                            if answer_prefix is not None:
+                                data = self.score_answer(payload, answer_prefix, server_url)
+                            elif self.renderer is not None:
+                                data = self.complete_rendered(payload, n_predict, server_url, expected_answers)
+                            elif self.stream and n_sequences == 1:
+                                data = self.stream_chat(payload, n_predict, server_url, expected_answers)
+                            else:
+                                data = self.post("/chat/completions", payload, n_predict * n_sequences, server_url)
+                            if self.logprobs_mode == "two_phase" and answer_prefix is None:
+                                # The scoring call goes to the same server so it reuses the cached prompt
+                                self._score_final_answer(payload, data, server_url, expected_answers)
+                        break
+                    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                        # The server went away mid-request: wait for it to be restarted and replay the request
+                        if self.server_manager is None or server_url is None or attempt == self.max_replays:
+                            raise
+                        print(f"Lost the connection to {server_url}; replaying the request once the server is running again")
+                        self.server_manager.ensure_running(server_url)
+        except Exception:
+            if self.throttle is not None:
+                self.throttle.record_error(agent_type)
+            raise
+        seconds = time.perf_counter() - started
+        self.record_request(agent_type, seconds)
+        if self.throttle is not None:
+            self.throttle.record(agent_type, seconds, data.get("timings"))
+        self.record_cache_usage(agent_type, data)
+        if cache_key is not None:
+            self.response_cache.put(cache_key, data)
+        return data
+
+    def stream_chat(self, payload: dict, n_predict: int = 128, server_url=None, expected_answers: int = 1, path: str = "/chat/completions"):
+        """
+        Sends a streamed chat completion request and reads the server-sent events as they arrive.
+        path: "/completion" to stream a raw completion request (see complete_rendered) instead.
+        Once the text contains expected_answers times "Final answer: X" and the last answer letter is the latest token, the
+        connection is closed, which cancels the remaining generation on the server.
+        Returns the same structure as a non-streamed response:
+        {"choices": [{"message": {"content": ...}, "logprobs": {"content": [...]}, "finish_reason": ...}], "timings": ...}
+        """
+        if server_url is None:
+            with self.router.route() as routed_url:
+                return self.stream_chat(payload, n_predict, routed_url, expected_answers, path)
+        # timings_per_token: each event carries the timings so far, as the final event is never read when stopping early
+        payload = dict(payload, stream=True, timings_per_token=True)
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        response = self.session.post(
+            f"{server_url}{path}",
+            data=body,
+            timeout=self.timeout_for(n_predict),
+            stream=True
+        )
+        if response.status_code != 200:
+            text = response.text
+            response.close()
+            raise RuntimeError(f"Server error: {response.status_code} with body: {text[:200]}")
+
+        text_parts = []
+        content = []
+        finish_reason = None
+        timings = None
+        n_bytes = 0
+        decode_seconds = 0.0
+        try:
+            for line in response.iter_lines():
+                n_bytes += len(line)
+                if not line or not line.startswith(b"data: "):
+                    continue
+                event = line[len(b"data: "):]
+                if event == b"[DONE]":
+                    break
+                decode_started = time.perf_counter()
+                chunk = json.loads(event)
+                decode_seconds += time.perf_counter() - decode_started
+                timings = chunk.get("timings", timings)
+                if path == "/completion":
+                    delta_text = chunk.get("content")
+                    entries = self.completion_probabilities_to_content(chunk)
+                    finish = self.completion_finish_reason(chunk) if chunk.get("stop") else None
+                else:
+                    if not chunk.get("choices"):
+                        continue
+                    choice = chunk["choices"][0]
+                    delta_text = (choice.get("delta") or {}).get("content")
+                    entries = (choice.get("logprobs") or {}).get("content") or []
+                    finish = choice.get("finish_reason")
+                if delta_text:
+                    text_parts.append(delta_text)
+                content.extend(entries)
+                if finish:
+                    finish_reason = finish
+
+                # Stop as soon as the (last) final answer letter has been generated
+                last_token = content[-1]["token"].strip() if content else ""
+                if last_token in ANSWER_LETTERS and len(FINAL_ANSWER_PATTERN.findall("".join(text_parts))) >= expected_answers:
+                    finish_reason = "final_answer"
+                    break
+        finally:
+            response.close()
+
+        data = {
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(text_parts)},
+                "logprobs": {"content": content},
+                "finish_reason": finish_reason
+            }],
+            "timings": timings
+        }
+        self._track_response(n_bytes, decode_seconds, data)
+        return data
+
+    def render_prompt(self, chat_template_kwargs: dict, messages=None, server_url=None):
+        """
+        Asks the server to render the chat template and returns the prompt text
+        exactly as the server would evaluate it for a chat completion
+        """
+        payload = {
+            "messages": messages if messages is not None else [],
+            "chat_template_kwargs": chat_template_kwargs
+        }
+        return self.post("/apply-template", payload, 0, server_url)["prompt"]
+
+    def tokenize(self, text: str, server_url=None):
+        """
+        Returns the token ids of text from the server's tokenizer. Special tokens written in the text,
+        e.g., the bos_token of the template, are parsed; no BOS is added.
+        """
+        payload = {"content": text, "add_special": False, "parse_special": True}
+        return self.post("/tokenize", payload, 0, server_url)["tokens"]
+
+    def prompt_for(self, payload: dict, server_url=None):
+        """
+        Returns the prompt of a chat payload for the /completion endpoint.
+        Without a client-side renderer the server renders the template and the prompt is text.
+        With one, the static prefix is replaced by its token ids: [prefix token ids..., "per-sentence suffix"]
+        """
+        chat_template_kwargs, messages = payload["chat_template_kwargs"], payload["messages"]
+        if self.renderer is None:
+            return self.render_prompt(chat_template_kwargs, messages, server_url)
+        prefix, suffix = self.renderer.split(chat_template_kwargs, messages)
+        prefix_ids = self._prefix_token_ids(prefix, suffix, chat_template_kwargs, messages, server_url)
+        if prefix_ids is None:
+            return self.render_prompt(chat_template_kwargs, messages, server_url)
+        return list(prefix_ids) + [suffix] if suffix else list(prefix_ids)
+
+    def _prefix_token_ids(self, prefix: str, suffix: str, chat_template_kwargs: dict, messages, server_url=None):
+        """
+        Returns the token ids of a static prefix, tokenized once through the server.
+        The first prompt of each prefix is checked against the server: the client-side rendering must be the
+        same as the server's, and the prefix must end on a token boundary, i.e., tokenizing the prefix and the
+        suffix separately must give the tokens of the whole prompt.
+        Returns None if a check fails; the prompts of that prefix are then rendered by the server.
+        """
+        if prefix in self.prefix_tokens:
+            return self.prefix_tokens[prefix]
+        with self._prefix_lock:
+            if prefix not in self.prefix_tokens:
+                self.prefix_tokens[prefix] = self._check_prefix(prefix, suffix, chat_template_kwargs, messages, server_url)
+            return self.prefix_tokens[prefix]
+
+    def _check_prefix(self, prefix: str, suffix: str, chat_template_kwargs: dict, messages, server_url=None):
+        prefix_ids = None
+        name = chat_template_kwargs.get("agent_type", "the template")
+        if not prefix:
+            print(f"No static prefix found for {name}; its prompts are rendered by the server")
+        elif self.render_prompt(chat_template_kwargs, messages, server_url) != prefix + suffix:
+            print(f"The client-side rendering of {name} differs from the server's; its prompts are rendered by the server")
+        else:
+            prefix_ids = self.tokenize(prefix, server_url)
+            if self.tokenize(prefix + suffix, server_url) != prefix_ids + self.tokenize(suffix, server_url):
+                print(f"The static prefix of {name} does not end on a token boundary; its prompts are rendered by the server")
+                prefix_ids = None
+            else:
+                print(f"Tokenized the static prefix of {name} once: {len(prefix_ids)} tokens")
+        return prefix_ids
+
+    def _prepare_slot_state(self, payload: dict, agent_type):
+        """
+        The first time a static prefix is used, its saved KV state is restored into the slots that will serve it:
+        the agent_type's pinned slot, or every slot when the requests are not pinned (a later prefix then takes over the slots).
+        A prefix without a saved state is evaluated once on the first of those slots and saved there,
+        so the next run, or a server restarted after a crash, restores it instead of evaluating it again.
+        """
+        if self._state_renderer is None:
+            self._state_renderer = self.renderer or PromptRenderer(self.server_manager.chat_template)
+        prefix = self._state_renderer.static_prefix(payload["chat_template_kwargs"], payload["messages"])
+        if prefix in self.slot_states:
+            return
+        with self._slot_state_lock:
+            if prefix not in self.slot_states:
+                self.slot_states[prefix] = self._load_slot_state(prefix, payload, agent_type)
+
+    def _load_slot_state(self, prefix: str, payload: dict, agent_type):
+        """
+        Restores (or evaluates and saves) the state of a static prefix and returns its file, or None if it is not saved
+        """
+        manager = self.server_manager
+        chat_template_kwargs, messages = payload["chat_template_kwargs"], payload["messages"]
+        name = chat_template_kwargs.get("agent_type", "the template")
+        if self.slot_affinity:
+            targets = [(self.server_for(agent_type), self.slot_for(agent_type))]
+        else:
+            targets = [(server_url, slot_id) for server_url in self.server_urls for slot_id in range(self.n_slots)]
+        server_url, slot_id = targets[0]
+        if not prefix or not self.render_prompt(chat_template_kwargs, messages, server_url).startswith(prefix):
+            print(f"No static prefix of {name} matches the server's rendering; its slot state is not saved")
+            return None
+
+        filename = manager.slot_state_file(prefix)
+        if not manager.has_slot_state(filename):
+            prompt = prefix
+            if self.renderer is not None:
+                # Evaluate the prefix as the same token ids the requests will send
+                _, suffix = self.renderer.split(chat_template_kwargs, messages)
+                prefix_ids = self._prefix_token_ids(prefix, suffix, chat_template_kwargs, messages, server_url)
+                prompt = list(prefix_ids) if prefix_ids is not None else prefix
+            self.post("/completion", {"prompt": prompt, "n_predict": 1, "temperature": 0.0, "id_slot": slot_id, "cache_prompt": True}, 1, server_url)
+            saved = manager.save_slot(server_url, slot_id, filename)
+            if saved is None:
+                return None
+            print(f"Saved the KV state of the static prefix of {name}: {saved} tokens")
+            targets = targets[1:]
+        restored = [manager.restore_slot(url, slot, filename) for url, slot in targets]
+        if restored and restored[0] is not None:
+            print(f"Restored the saved KV state of the static prefix of {name} into {sum(r is not None for r in restored)} slot(s): {restored[0]} tokens")
+        return filename
+
+    @staticmethod
+    def extend_prompt(prompt, extra):
+        """
+        Appends text or a list of token ids to a /completion prompt (text, or a list mixing text and token ids).
+        Adjacent text is joined, so it is tokenized in one piece.
+        """
+        parts = list(prompt) if isinstance(prompt, list) else [prompt]
+        extra = [extra] if isinstance(extra, str) else list(extra)
+        if not extra:
+            return prompt
+        if isinstance(extra[0], str) and parts and isinstance(parts[-1], str):
+            parts[-1] += extra.pop(0)
+        parts.extend(extra)
+        return parts[0] if len(parts) == 1 and isinstance(parts[0], str) else parts
+
+    def completion_payload(self, payload: dict, prompt):
+        """
+        Turns a chat payload into the request body of the raw /completion endpoint for prompt
+        """
+        logprobs = payload.get("logprobs")
+        request = {
+            "prompt": prompt,
+            "n_predict": payload["n_predict"],
+            "temperature": payload["temperature"],
+            "top_p": payload["top_p"],
+            "n_probs": payload.get("top_logprobs", 1) if logprobs is True else int(logprobs or 0),
+            "stop": payload["stop"],
+            "cache_prompt": payload["cache_prompt"]
+        }
+        for field in ("id_slot", "grammar"):
+            if field in payload:
+                request[field] = payload[field]
+        return request
+
+    def complete_rendered(self, payload: dict, n_predict: int = 128, server_url=None, expected_answers: int = 1):
+        """
+        Sends a chat payload to the /completion endpoint with the client-side rendered prompt (see prompt_for)
+        and returns the response in the shape of a chat completion response.
+        Streams the response when stream is switched on.
+        """
+        if server_url is None:
+            with self.router.route() as routed_url:
+                return self.complete_rendered(payload, n_predict, routed_url, expected_answers)
+        request = self.completion_payload(payload, self.prompt_for(payload, server_url))
+        n_sequences = payload.get("n", 1)
+        if self.stream and n_sequences == 1:
+            return self.stream_chat(request, n_predict, server_url, expected_answers, "/completion")
+        if n_sequences > 1:
+            request["n_cmpl"] = n_sequences
+        data = self.post("/completion", request, n_predict * n_sequences, server_url)
+        # With n_cmpl the server returns one result per sequence
+        results = sorted(data, key=lambda result: result.get("index", 0)) if isinstance(data, list) else [data]
+        return {
+            "choices": [{
+                "index": i,
+                "message": {"role": "assistant", "content": result.get("content", "")},
+                "logprobs": {"content": self.completion_probabilities_to_content(result)},
+                "finish_reason": self.completion_finish_reason(result)
+            } for i, result in enumerate(results)],
+            "timings": self.merge_timings([result.get("timings") for result in results])
+        }
+
+    @staticmethod
+    def merge_timings(timings: list):
+        """
+        Returns the timings of the sequences of one prompt as one request: the prompt of the first sequence
+        (the sequences share its evaluation) and the generated tokens of all of them
+        """
+        timings = [t for t in timings if t]
+        if len(timings) <= 1:
+            return timings[0] if timings else None
+        merged = dict(timings[0])
+        merged["predicted_n"] = sum(t.get("predicted_n", 0) or 0 for t in timings)
+        merged["predicted_ms"] = max(t.get("predicted_ms", 0) or 0 for t in timings)
+        return merged
+
+    @staticmethod
+    def completion_finish_reason(data):
+        """
+        Returns the chat completion finish_reason of a finished /completion response
+        """
+        return "length" if data.get("stop_type") == "limit" or data.get("stopped_limit") else "stop"
+
+    def score_next_token(self, prompt, top_k: int, id_slot=None, server_url=None):
+        """
+        Evaluates the prompt and returns the top_k logprobs of the next token as a list of
+        {"id", "token", "logprob"} entries, without generating any text beyond that one token.
+        prompt: text, or a list mixing text and token ids
+        """
+        payload = {
+            "prompt": prompt,
+            "n_predict": 1,
+            "n_probs": top_k,
+            "temperature": 0.0,
+            "cache_prompt": self.cache_prompt
+        }
+        if id_slot is not None:
+            payload["id_slot"] = id_slot
+        data = self.post("/completion", payload, 1, server_url)
+        content = self.completion_probabilities_to_content(data)
+        if not content:
+            raise ValueError("Scoring call returned no probabilities")
+        return content[0].get("top_logprobs", [])
+
+    def score_answer(self, payload, answer_prefix=ANSWER_PREFIX, server_url=None):
+        """
+        Evaluates the rendered prompt of a chat payload (see prompt_for) followed by answer_prefix, e.g., "<|assistant|>\nFinal answer:",
+        and predicts a single token. The most likely answer letter among the top answer_top_k next tokens becomes the answer,
+        counting only the payload's answer_letters when it has them (see chat).
+        Returns the same structure as a chat completion response, with one logprobs entry for the answer
+        token whose top_logprobs hold the next-token distribution, so MCQProbHandler reads it unchanged.
+        Raises a ValueError if no answer letter is among the top answer_top_k tokens; like a response that cannot be parsed,
+        it only fails this sentence, while a RuntimeError (server error) stops the run.
+        """
+        request = {
+            "prompt": self.extend_prompt(self.prompt_for(payload, server_url), answer_prefix),
+            "n_predict": 1,
+            "n_probs": self.answer_top_k,
+            "temperature": 0.0,
+            "cache_prompt": self.cache_prompt
+        }
+        if payload.get("id_slot") is not None:
+            request["id_slot"] = payload["id_slot"]
+        data = self.post("/completion", request, 1, server_url)
+        content = self.completion_probabilities_to_content(data)
+        if not content:
+            raise ValueError("Scoring call returned no probabilities")
+        return self.answer_response(content[0].get("top_logprobs", []), answer_prefix, data.get("timings"), payload.get("answer_letters"))
+
+    def answer_response(self, top, answer_prefix, timings, answer_letters=None):
+        """
+        Returns the chat completion response of a scored answer, see score_answer
+        top: the top logprobs of the token following answer_prefix
+        answer_letters: the letters the answer may be (default: ANSWER_LETTERS)
+        """
+        answer_letters = answer_letters or ANSWER_LETTERS
+        letters = [entry for entry in top if entry["token"].strip() in answer_letters]
+        if not letters:
+            raise ValueError(f"No answer letter among the top {self.answer_top_k} next tokens")
+        answer = max(letters, key=lambda entry: entry["logprob"])
+        return {
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": answer_prefix + answer["token"]},
+                "logprobs": {"content": [dict(answer, top_logprobs=top)]},
+                "finish_reason": "scored"
+            }],
+            "timings": timings
+        }
+
+    def backend_chat(self, payload: dict, expected_answers: int = 1, answer_prefix=None):
+        """
+        Runs a chat payload on the inference backend instead of llama-server
+        """
+        prompt = self.renderer.render(payload["chat_template_kwargs"], payload["messages"])
+        if answer_prefix is not None:
+            top, timings = self.backend.next_token(prompt + answer_prefix, self.answer_top_k)
+            data = self.answer_response(top, answer_prefix, timings, payload.get("answer_letters"))
+        else:
+            data = self.backend.generate(prompt, payload, self.answer_top_k, expected_answers)
+        self._track_response(0, 0.0, data)
+        return data
+
+    @staticmethod
+    def completion_probabilities_to_content(data):
+        """
+        Converts the completion_probabilities of a /completion response into the
+        logprobs["content"] list of a chat completion response, which is what MCQProbHandler reads.
+        Older llama-server versions return probabilities ("probs") instead of logprobs.
+        """
+        content = []
+        for entry in data.get("completion_probabilities", []):
+            if "top_logprobs" in entry:
+                content.append(entry)
+                continue
+            top = [
+                {"id": p.get("id"), "token": p["tok_str"], "logprob": math.log(p["prob"]) if p["prob"] > 0 else -math.inf}
+                for p in entry.get("probs", [])
+            ]
+            sampled = next((p for p in top if p["token"] == entry.get("content")), None)
+            content.append({
+                "id": entry.get("id"),
+                "token": entry.get("content", ""),
+                "logprob": sampled["logprob"] if sampled else (top[0]["logprob"] if top else 0.0),
+                "top_logprobs": top
+            })
+        return content
+
+    def _score_final_answer(self, payload, data, server_url=None, expected_answers=1):
+        """
+        Second phase of the two_phase logprobs mode.
+        Finds the final answer token in the generation, re-evaluates the prompt plus the generated
+        tokens before it (mostly from the slot's prompt cache) and replaces the final answer token's
+        top_logprobs with the top answer_top_k logprobs at that position.
+        With expected_answers > 1 every answer token written after "Final answer:" is scored the same way.
+        With several sequences (n_sequences) the answer of every sequence is scored.
+        """
+        rendered = None
+        for choice in data["choices"]:
+            logprobs = choice.get("logprobs")
+            if not logprobs or not logprobs.get("content"):
+                continue
+            content = logprobs["content"]
+            answer_finder = MCQProbHandler()
+            answer_finder.set_logprobs(logprobs)
+            if expected_answers > 1:
+                answer_indices = answer_finder.return_final_answer_token_indices()
+            else:
+                answer_index = answer_finder.return_final_answer_token_index()
+                answer_indices = [answer_index] if answer_index is not None else []
+            if not answer_indices:
+                continue # Nothing to score, MCQProbHandler handles the missing answer
+
+            if rendered is None:
+                rendered = self.prompt_for(payload, server_url)
+            for answer_index in answer_indices:
+                generated_ids = [entry["id"] for entry in content[:answer_index]]
+                prompt = self.extend_prompt(rendered, generated_ids)
+                content[answer_index]["top_logprobs"] = self.score_next_token(prompt, self.answer_top_k, payload.get("id_slot"), server_url)
+        return data
+
+    def _track_response(self, n_bytes, decode_seconds, data):
+        """
+        Adds one server response to the timing of the chat() call running on this thread.
+        A chat() call can make several requests, e.g., the scoring call of the two_phase mode.
+        """
+        tracker = getattr(self._local, "tracker", None)
+        if tracker is None:
+            return
+        tracker["bytes"] += n_bytes
+        tracker["decode_seconds"] += decode_seconds
+        if isinstance(data, list):
+            timings = self.merge_timings([result.get("timings") for result in data]) # One result per sequence (n_cmpl)
+        else:
+            timings = data.get("timings") if isinstance(data, dict) else None
+        if timings:
+            tracker["server_ms"] += (timings.get("prompt_ms", 0) or 0) + (timings.get("predicted_ms", 0) or 0)
+            tracker["predicted_n"] += timings.get("predicted_n", 0) or 0
+            tracker["timed"] = True
+
+    def record_request(self, agent_type, seconds):
+        """
+        Records the timing of one chat() call that went to the server.
+        The client overhead is only known when the server returned its timings, which a stream
+        stopped at the final answer does not.
+        """
+        tracker = self._local.tracker
+        self._local.tracker = None
+        with self._lock:
+            stats = self.request_stats.setdefault(agent_type, {
+                "requests": 0, "seconds": [], "overhead_seconds": [], "server_seconds": 0.0,
+                "decode_seconds": 0.0, "bytes": 0, "predicted_n": 0
+            })
+            stats["requests"] += 1
+            stats["seconds"].append(seconds)
+            stats["decode_seconds"] += tracker["decode_seconds"]
+            stats["bytes"] += tracker["bytes"]
+            stats["predicted_n"] += tracker["predicted_n"]
+            if tracker["timed"]:
+                stats["server_seconds"] += tracker["server_ms"] / 1000
+                stats["overhead_seconds"].append(max(0.0, seconds - tracker["server_ms"] / 1000))
+
+    def timing_stats(self):
+        """
+        Returns the request timing per agent_type and for all requests ("all"):
+        {
+            "requests": int,
+            "mean_seconds", "p50_seconds", "p95_seconds": round trip of a chat() call,
+            "server_seconds": mean time the server spent on the prompt and the generation,
+            "mean_overhead_seconds", "p95_overhead_seconds": round trip minus server time,
+            "decode_seconds": mean time spent decoding the response JSON,
+            "bytes": mean response size,
+            "predicted_n": total generated tokens
+        }
+        """
+        with self._lock:
+            groups = {agent_type: [stats] for agent_type, stats in self.request_stats.items()}
+            groups["all"] = list(self.request_stats.values())
+            summary = {}
+            for name, group in groups.items():
+                seconds = [s for stats in group for s in stats["seconds"]]
+                overheads = [s for stats in group for s in stats["overhead_seconds"]]
+                requests = len(seconds)
+                if not requests:
+                    continue
+                summary[name] = {
+                    "requests": requests,
+                    "mean_seconds": sum(seconds) / requests,
+                    "p50_seconds": percentile(seconds, 50),
+                    "p95_seconds": percentile(seconds, 95),
+                    "server_seconds": sum(stats["server_seconds"] for stats in group) / len(overheads) if overheads else 0.0,
+                    "mean_overhead_seconds": sum(overheads) / len(overheads) if overheads else 0.0,
+                    "p95_overhead_seconds": percentile(overheads, 95),
+                    "decode_seconds": sum(stats["decode_seconds"] for stats in group) / requests,
+                    "bytes": sum(stats["bytes"] for stats in group) / requests,
+                    "predicted_n": sum(stats["predicted_n"] for stats in group),
+                }
+        return summary
+
+    def timing_report(self):
+        """
+        Returns a printable summary of the request timing per agent_type
+        """
+        lines = ["Request timing:"]
+        for name, stats in self.timing_stats().items():
+            lines.append(
+                f"  {name}: {stats['requests']} requests, round trip mean {stats['mean_seconds'] * 1000:.1f} ms "
+                f"(p50 {stats['p50_seconds'] * 1000:.1f}, p95 {stats['p95_seconds'] * 1000:.1f}), "
+                f"server {stats['server_seconds'] * 1000:.1f} ms, client overhead {stats['mean_overhead_seconds'] * 1000:.1f} ms "
+                f"(p95 {stats['p95_overhead_seconds'] * 1000:.1f}), JSON decode {stats['decode_seconds'] * 1000:.1f} ms, "
+                f"{stats['bytes'] / 1024:.1f} KB per response"
+            )
+        return "\n".join(lines)
+
+    def record_cache_usage(self, agent_type, data):
+        """
+        Counts prompt cache hits and misses from the timings returned by llama-server.
+        timings.cache_n is the number of prompt tokens reused from the slot's KV cache and
+        timings.prompt_n is the number of prompt tokens that had to be evaluated.
+        A request is a hit when any of its prompt was reused.
+        """
+        timings = data.get("timings") if isinstance(data, dict) else None
+        if not timings:
+            return
+        cached = timings.get("cache_n", 0) or 0
+        evaluated = timings.get("prompt_n", 0) or 0
+        with self._lock:
+            stats = self.cache_stats.setdefault(agent_type, {"hits": 0, "misses": 0, "cached_tokens": 0, "evaluated_tokens": 0})
+            if cached > 0:
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+            stats["cached_tokens"] += cached
+            stats["evaluated_tokens"] += evaluated
+
+    def cache_report(self):
+        """
+        Returns a printable summary of the prompt cache counters per agent_type
+        """
+        lines = ["Prompt cache usage:"]
+        with self._lock:
+            for agent_type, stats in self.cache_stats.items():
+                total_tokens = stats["cached_tokens"] + stats["evaluated_tokens"]
+                reuse = stats["cached_tokens"] / total_tokens if total_tokens else 0.0
+                slot = f"{self.server_for(agent_type)} slot {self.slot_for(agent_type)}" if agent_type in self.slot_ids else "any slot"
+                lines.append(
+                    f"  {agent_type} ({slot}): {stats['hits']} hits, {stats['misses']} misses, "
+                    f"{stats['cached_tokens']} prompt tokens reused ({reuse:.1%}), {stats['evaluated_tokens']} evaluated"
+                )
+        return "\n".join(lines)
+
+    @staticmethod
+    def get_content_and_logprobs(data):
+        """
+        Returns the generated text and the logprobs from a chat completion response
+        """
+        choice = data["choices"][0]
+        return choice["message"]["content"].strip(), choice.get("logprobs")
+
+    @staticmethod
+    def get_sequences(data):
+        """
+        Returns the (generated text, logprobs) of every sequence of a chat completion response, see n_sequences
+        """
+        return [(choice["message"]["content"].strip(), choice.get("logprobs")) for choice in data["choices"]]
+
+    def close(self):
+        self.session.close()
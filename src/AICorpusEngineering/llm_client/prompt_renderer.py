@@ -0,0 +1,76 @@
+import json
+from pathlib import Path
+import jinja2
+
+class PromptRenderer:
+    """
+    Renders an agent template (agent-templates/*.jinja) on the client the same way llama-server renders it
+    with --jinja: trim_blocks and lstrip_blocks, with the messages, bos_token and add_generation_prompt
+    plus the chat_template_kwargs as template variables.
+
+    split() cuts a rendered prompt into:
+    - the static prefix: everything that only depends on the agent_type and the knowledge base
+    (instructions, knowledge base and few-shot examples), identical for every request of the agent_type
+    - the suffix: the per-sentence part, starting at the line which holds the first per-sentence variable
+    The prefix is cut at the start of a line so that it ends on a token boundary.
+    """
+    STATIC_KWARGS = ("agent_type", "knowledge_base")
+    SENTINEL = "\u0000sentinel\u0000"
+
+    def __init__(self, template_path, bos_token: str = "<|begin_of_text|>", eos_token: str = "<|eot_id|>"):
+        """
+        template_path: the template the server was started with (--chat-template-file)
+        bos_token, eos_token: the special tokens of the model, which llama-server injects into the template
+        """
+        self.template_path = Path(template_path)
+        self.bos_token = bos_token
+        self.eos_token = eos_token
+        environment = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+        self.template = environment.from_string(self.template_path.read_text(encoding="utf-8"))
+        self._prefixes = {} # static kwargs -> static prefix text
+
+    def render(self, chat_template_kwargs: dict, messages=None):
+        """
+        Returns the prompt text for a request, as /apply-template would return it
+        """
+        variables = {
+            "messages": messages if messages is not None else [],
+            "bos_token": self.bos_token,
+            "eos_token": self.eos_token,
+            "add_generation_prompt": True
+        }
+        variables.update(chat_template_kwargs)
+        return self.template.render(**variables)
+
+    def static_prefix(self, chat_template_kwargs: dict, messages=None):
+        """
+        Returns the static prefix of the prompts rendered with the same agent_type and knowledge base.
+        The template is rendered once with a sentinel in every per-sentence variable and message,
+        and cut at the start of the line holding the first sentinel.
+        """
+        static = {k: v for k, v in chat_template_kwargs.items() if k in self.STATIC_KWARGS}
+        cache_key = json.dumps(static, sort_keys=True, ensure_ascii=False)
+        if cache_key not in self._prefixes:
+            probe = {
+                k: ([self.SENTINEL] if isinstance(v, (list, tuple)) else self.SENTINEL)
+                for k, v in chat_template_kwargs.items() if k not in self.STATIC_KWARGS
+            }
+            probe_messages = [dict(m, content=self.SENTINEL) for m in (messages or [])]
+            text = self.render(dict(probe, **static), probe_messages)
+            position = text.find(self.SENTINEL)
+            if position < 0:
+                position = len(text) # Nothing per-sentence is rendered
+            self._prefixes[cache_key] = text[:text.rfind("\n", 0, position) + 1]
+        return self._prefixes[cache_key]
+
+    def split(self, chat_template_kwargs: dict, messages=None):
+        """
+        Renders the prompt of a request and returns (static prefix, per-sentence suffix).
+        The prefix is "" if the rendered prompt does not start with the static prefix,
+        e.g., when a per-sentence variable changes the template text before it.
+        """
+        prompt = self.render(chat_template_kwargs, messages)
+        prefix = self.static_prefix(chat_template_kwargs, messages)
+        if not prompt.startswith(prefix):
+            return "", prompt
+        return prefix, prompt[len(prefix):]
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses.
+    The studies run at temperature 0.0, so the same request to the same model with the same
+    template always gives the same response. Responses are stored in a SQLite file keyed by
+    a hash of everything that determines the response:
+    - the model file and the chat template file (the namespace, see namespace_for), and the client settings
+      that change the response but not the payload (see LLMClient.response_namespace)
+    - the request payload: agent_type, knowledge base, sentence, adverb, messages and sampling parameters
+    The jinja template is rendered by the server from the template file and the chat_template_kwargs,
+    so hashing both is equivalent to hashing the rendered prompt.
+
+    The cache is bounded in size; when it grows past max_bytes the least recently used
+    responses are evicted.
+    In read_only mode responses are looked up but never written or evicted,
+    e.g., for analysis reruns over a finished study.
+    """
+    # Fields of the payload that do not change the response
+    IGNORED_FIELDS = ("id_slot", "cache_prompt")
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 2 * 1024**3, read_only: bool = False):
+        self.cache_dir = Path(cache_dir).expanduser().resolve()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.cache_dir / "responses.sqlite"
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # ----------
+    # Keys
+    # ----------
+    @staticmethod
+    def fingerprint_file(path, sample_bytes: int = 1024**2):
+        """
+        Returns a fingerprint of a file.
+        Model files are several gigabytes, so only the size, the first and the last
+        sample_bytes of the file are hashed.
+        """
+        path = Path(path)
+        size = path.stat().st_size
+        digest = hashlib.sha256(str(size).encode("utf-8"))
+        with path.open("rb") as f:
+            digest.update(f.read(sample_bytes))
+            if size > sample_bytes:
+                f.seek(max(sample_bytes, size - sample_bytes))
+                digest.update(f.read(sample_bytes))
+        return digest.hexdigest()
+
+    @classmethod
+    def namespace_for(cls, model_path, chat_template):
+        """
+        Returns the namespace of a model and template pair.
+        Changing the model or editing the template changes the namespace and so invalidates the cache.
+        """
+        return f"{cls.fingerprint_file(model_path)}:{cls.fingerprint_file(chat_template)}"
+
+    def make_key(self, namespace: str, payload: dict):
+        """
+        Returns the cache key of a request payload
+        """
+        relevant = {k: v for k, v in payload.items() if k not in self.IGNORED_FIELDS}
+        canonical = json.dumps(relevant, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(f"{namespace}\n{canonical}".encode("utf-8")).hexdigest()
+
+    # ----------
+    # Lookups and storage
+    # ----------
+    def get(self, key: str):
+        """
+        Returns the cached response for the key, or None
+        """
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.read_only:
+                self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+                self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key: str, data):
+        """
+        Stores a response and evicts the least recently used responses if the cache is too large
+        """
+        if self.read_only:
+            return
+        # default=list stores the array-backed top logprobs of an in-process backend (see backends.py) as plain lists
+        value = json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=list).encode("utf-8")
+        with self._lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self.total_bytes -= old[0]
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time())
+            )
+            self.total_bytes += len(value)
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        """
+        Deletes the least recently used responses until the cache fits in max_bytes
+        """
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def report(self):
+        """
+        Returns a printable summary of the cache usage
+        """
+        mode = " (read only)" if self.read_only else ""
+        return (
+            f"Response cache{mode}: {self.hits} hits, {self.misses} misses, "
+            f"{self.total_bytes / 1024**2:.1f} MB stored in {self.db_path}"
+        )
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
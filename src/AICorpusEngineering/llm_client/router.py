@@ -0,0 +1,49 @@
+import threading
+from contextlib import contextmanager
+
+class LeastOutstandingRouter:
+    """
+    Spreads requests over a pool of llama-server instances.
+    Each request goes to the server with the fewest requests currently in flight,
+    with ties broken round robin so that idle servers take turns.
+    """
+    def __init__(self, server_urls):
+        self.server_urls = [url.rstrip("/") for url in server_urls]
+        if not self.server_urls:
+            raise ValueError("At least one server url is needed")
+        self.outstanding = {url: 0 for url in self.server_urls}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, preferred=None):
+        """
+        Picks a server and counts the request as in flight on it.
+        preferred: a server url that must be used, e.g., the server an agent_type is pinned to
+        """
+        with self._lock:
+            if preferred is not None:
+                url = preferred.rstrip("/")
+            else:
+                n = len(self.server_urls)
+                order = [self.server_urls[(self._next + i) % n] for i in range(n)]
+                url = min(order, key=lambda u: self.outstanding[u])
+                self._next = (self.server_urls.index(url) + 1) % n
+            self.outstanding[url] = self.outstanding.get(url, 0) + 1
+            return url
+
+    def release(self, url):
+        with self._lock:
+            self.outstanding[url] -= 1
+
+    @contextmanager
+    def route(self, preferred=None):
+        """
+        Context manager which holds a server for the duration of one request:
+        with router.route() as server_url:
+            ...
+        """
+        url = self.acquire(preferred)
+        try:
+            yield url
+        finally:
+            self.release(url)
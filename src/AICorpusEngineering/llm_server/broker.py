@@ -0,0 +1,320 @@
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import requests
+from requests.adapters import HTTPAdapter
+from AICorpusEngineering.llm_client.router import LeastOutstandingRouter
+
+# ----------
+# Local inference broker
+# One long-running process owns the llama-server instances and the loaded model, and every pipeline
+# (run-adverbs, run-adverbs-ablation, run-multiword-adverbs, ...) sends its requests to the broker
+# instead of starting servers of its own. The broker speaks llama-server's HTTP API on a local port,
+# so the LLMClient is pointed at it like at a server, and it tells the broker its priority and name
+# in the X-Priority and X-Client headers.
+# Generation requests wait in the broker's queues until a slot is free (see FairScheduler);
+# every other request (/health, /tokenize, /apply-template, ...) is passed straight through.
+# ----------
+
+PRIORITIES = ("interactive", "normal", "batch") # Highest first
+GENERATION_PATHS = ("/completion", "/chat/completions", "/v1/chat/completions")
+AGENT_TYPE_PATTERN = re.compile(r"agent_type\s*==\s*[\"']([^\"']+)[\"']")
+
+def template_agent_types(template_path):
+    """
+    Returns the agent_types a template has a branch for.
+    A template without agent_type branches serves the agent_type named after its file, e.g., mw_adverb_analyst.
+    """
+    path = Path(template_path)
+    agent_types = list(dict.fromkeys(AGENT_TYPE_PATTERN.findall(path.read_text(encoding="utf-8"))))
+    return agent_types or [path.stem]
+
+def combine_templates(template_paths, output_path):
+    """
+    Writes one template holding all the agent templates, each in a branch on its agent_types, so one
+    llama-server renders the prompts of every pipeline. With llama-server's trim_blocks each branch renders
+    exactly like the template it holds, so client-side rendering (PromptRenderer) still matches.
+    Returns {template file name: its agent_types}.
+    Raises a ValueError when two templates have an agent_type in common, e.g., the two ablation templates.
+    """
+    served, owners, parts = {}, {}, []
+    for n, template_path in enumerate(template_paths):
+        path = Path(template_path)
+        agent_types = template_agent_types(path)
+        for agent_type in agent_types:
+            if agent_type in owners:
+                raise ValueError(f"{path.name} and {owners[agent_type]} both have the agent_type '{agent_type}', the broker can serve only one of them")
+            owners[agent_type] = path.name
+        served[path.name] = agent_types
+        parts.append(f"{'{% if' if n == 0 else '{% elif'} agent_type in {json.dumps(agent_types)} %}}\n{path.read_text(encoding='utf-8')}")
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text("".join(parts) + "{% endif %}", encoding="utf-8")
+    return served
+
+def broker_status(broker_url, timeout: float = 5.0):
+    """
+    Returns the status of a running broker (see InferenceBroker.status).
+    Raises a RuntimeError when no broker answers at broker_url.
+    """
+    try:
+        response = requests.get(f"{broker_url.rstrip('/')}/broker/status", timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+    except (requests.RequestException, ValueError) as e:
+        raise RuntimeError(f"No inference broker at {broker_url} ({e}); start one with run-llm-broker") from e
+
+def connect_broker(broker_url, chat_template):
+    """
+    Returns the status of the broker a pipeline sends its requests to.
+    Raises a ValueError when the broker's servers do not render the pipeline's template.
+    """
+    status = broker_status(broker_url)
+    name = Path(str(chat_template)).name
+    if name not in status["templates"]:
+        raise ValueError(f"The inference broker at {broker_url} does not serve {name} (it serves {', '.join(status['templates'])}); restart it with --templates including {name}")
+    print(f"Sending the requests to the inference broker at {broker_url} ({Path(status['model']).name}, {status['in_flight']} of {status['capacity']} slots busy)")
+    return status
+
+
+class FairScheduler:
+    """
+    Admits generation requests while fewer than capacity units of work are in flight, i.e., one unit per
+    server slot, and a request sampling n sequences takes n units.
+    A free slot goes to the highest priority with waiting requests. Within a priority the slots are shared
+    fairly between the clients: the client that has been served the fewest units goes first, so a pipeline
+    with many requests in flight does not crowd out one with a few. A client that starts waiting is counted
+    as served as much as the least served waiting client, so an idle period gives no credit to catch up on.
+    Each client is served in arrival order.
+    """
+    def __init__(self, capacity: int):
+        self.capacity = max(1, capacity)
+        self.in_flight = 0
+        self.queues = {priority: {} for priority in PRIORITIES} # priority -> client -> deque of (ticket, units)
+        self.served = {} # client -> units served (the fair share clock)
+        self.clients = {} # client -> counters reported by stats()
+        self._tickets = itertools.count()
+        self._changed = threading.Condition()
+
+    def _next(self):
+        """
+        Returns (priority, client) of the request that gets the next free slot, or None when nothing waits
+        """
+        for priority in PRIORITIES:
+            waiting = {client: queue for client, queue in self.queues[priority].items() if queue}
+            if waiting:
+                return priority, min(waiting, key=lambda client: (self.served[client], waiting[client][0][0]))
+        return None
+
+    def acquire(self, priority: str, client: str, units: int = 1):
+        """
+        Blocks until the request may be sent to a server and returns the seconds it waited
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{priority}', use one of {', '.join(PRIORITIES)}")
+        units = min(max(1, units), self.capacity)
+        started = time.perf_counter()
+        with self._changed:
+            ticket = next(self._tickets)
+            queues = self.queues[priority]
+            if not queues.get(client):
+                waiting = [self.served[other] for other, queue in queues.items() if queue]
+                self.served[client] = max(self.served.get(client, 0), min(waiting, default=0))
+            queues.setdefault(client, deque()).append((ticket, units))
+            stats = self.clients.setdefault(client, {"priority": priority, "waiting": 0, "in_flight": 0, "requests": 0, "wait_seconds": 0.0})
+            stats["priority"] = priority
+            stats["waiting"] += 1
+            while not (self._next() == (priority, client) and queues[client][0][0] == ticket and self.in_flight + units <= self.capacity):
+                self._changed.wait()
+            queues[client].popleft()
+            self.in_flight += units
+            self.served[client] += units
+            waited = time.perf_counter() - started
+            stats["waiting"] -= 1
+            stats["in_flight"] += units
+            stats["requests"] += 1
+            stats["wait_seconds"] += waited
+            self._changed.notify_all() # The next request may fit in the remaining slots
+        return waited
+
+    def release(self, client: str, units: int = 1):
+        units = min(max(1, units), self.capacity)
+        with self._changed:
+            self.in_flight -= units
+            self.clients[client]["in_flight"] -= units
+            self._changed.notify_all()
+
+    def stats(self):
+        with self._changed:
+            return {
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "clients": {
+                    client: dict(stats, mean_wait_seconds=stats["wait_seconds"] / stats["requests"] if stats["requests"] else 0.0)
+                    for client, stats in self.clients.items()
+                }
+            }
+
+
+class InferenceBroker:
+    """
+    HTTP front of a ServerManager shared by several pipelines on one machine.
+    broker = InferenceBroker(server_manager, templates, port=8070)
+    broker.serve_forever() # starts the servers and blocks until interrupted
+
+    Generation requests are scheduled by a FairScheduler with one unit per slot of the servers and
+    spread over the servers by a LeastOutstandingRouter. Their id_slot is removed: the pipelines cannot
+    coordinate their slot pins, so the server picks the slot whose cached prompt matches best.
+    Responses, including streamed ones, are relayed as they arrive; a client that closes its connection
+    closes the server's too, which cancels the generation like it does without the broker.
+    A request that loses its server is replayed once the ServerManager has restarted it.
+    """
+    def __init__(self, server_manager, templates: dict, host: str = "127.0.0.1", port: int = 8070, max_replays: int = 2):
+        """
+        templates: {template file name: agent_types} of the combined template the servers run (see combine_templates)
+        """
+        self.server_manager = server_manager
+        self.templates = templates
+        self.host = host
+        self.port = port
+        self.max_replays = max_replays
+        self.scheduler = FairScheduler(server_manager.parallel * server_manager.instances)
+        self.router = LeastOutstandingRouter(server_manager.server_urls)
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=len(self.router.server_urls), pool_maxsize=self.scheduler.capacity + 4))
+        self.started_at = None
+        self.httpd = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def status(self):
+        return {
+            "model": str(self.server_manager.model_path),
+            "templates": self.templates,
+            "servers": self.router.server_urls,
+            "uptime_seconds": time.time() - self.started_at if self.started_at else 0.0,
+            "restarts": self.server_manager.restarts,
+            **self.scheduler.stats()
+        }
+
+    def serve_forever(self):
+        self.server_manager.start()
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.started_at = time.time()
+        print(f"Inference broker listening on {self.url} with {self.scheduler.capacity} slots", flush=True)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.stop()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.server_close()
+            self.httpd = None
+        self.server_manager.stop()
+        self.session.close()
+
+    def forward(self, method: str, path: str, body: bytes):
+        """
+        Sends a request to the least busy server, replaying it once the server is running again
+        if the connection is lost, and returns the streamed response
+        """
+        for attempt in range(self.max_replays + 1):
+            server_url = self.router.acquire()
+            try:
+                response = self.session.request(method, server_url + path, data=body, headers={"Content-Type": "application/json"}, stream=True, timeout=(5.0, None))
+                return server_url, response
+            except requests.ConnectionError:
+                self.router.release(server_url)
+                if attempt == self.max_replays:
+                    raise
+                print(f"Lost the connection to {server_url}; replaying the request once the server is running again", flush=True)
+                self.server_manager.ensure_running(server_url)
+
+    # ----------
+    # HTTP
+    # ----------
+    def _handler_class(self):
+        broker = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass # One line per request would bury the scheduling messages
+
+            def _send_json(self, status, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == "/broker/status":
+                    self._send_json(200, broker.status())
+                else:
+                    self._relay("GET", b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path.split("?")[0] not in GENERATION_PATHS:
+                    self._relay("POST", body)
+                    return
+                priority = self.headers.get("X-Priority", "normal")
+                client = self.headers.get("X-Client") or f"{self.client_address[0]}:{self.client_address[1]}"
+                if priority not in PRIORITIES:
+                    self._send_json(400, {"error": {"code": 400, "message": f"Unknown priority '{priority}', use one of {', '.join(PRIORITIES)}"}})
+                    return
+                try:
+                    payload = json.loads(body or b"{}")
+                except ValueError:
+                    self._send_json(400, {"error": {"code": 400, "message": "The request body is not JSON"}})
+                    return
+                payload.pop("id_slot", None)
+                units = max(1, int(payload.get("n", 1) or 1), int(payload.get("n_cmpl", 1) or 1))
+                broker.scheduler.acquire(priority, client, units)
+                try:
+                    self._relay("POST", json.dumps(payload).encode("utf-8"))
+                finally:
+                    broker.scheduler.release(client, units)
+
+            def _relay(self, method, body):
+                try:
+                    server_url, response = broker.forward(method, self.path, body)
+                except requests.ConnectionError as e:
+                    self._send_json(503, {"error": {"code": 503, "message": f"No server available: {e}"}})
+                    return
+                try:
+                    self.send_response(response.status_code)
+                    self.send_header("Content-Type", response.headers.get("Content-Type", "application/json"))
+                    if "Content-Length" in response.headers:
+                        content = response.content
+                        self.send_header("Content-Length", str(len(content)))
+                        self.end_headers()
+                        self.wfile.write(content)
+                    else:
+                        # Streamed (server-sent events): relayed chunk by chunk, the end of the body is the end of the connection
+                        self.send_header("Connection", "close")
+                        self.end_headers()
+                        self.close_connection = True
+                        for chunk in response.iter_content(chunk_size=None):
+                            self.wfile.write(chunk)
+                            self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # The client stopped reading, e.g., a stream cancelled after the final answer
+                finally:
+                    response.close()
+                    broker.router.release(server_url)
+
+        return Handler
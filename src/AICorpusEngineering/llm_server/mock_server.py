@@ -0,0 +1,768 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from AICorpusEngineering.llm_client.grammars import AGENT_GRAMMARS, FINAL_ANSWER_ONLY
+from AICorpusEngineering.llm_client.prompt_renderer import PromptRenderer
+
+# ----------
+# A stand-in for llama-server for benchmarking and regression testing the pipelines
+# on any machine, without a GGUF model.
+# It answers the same endpoints the LLMClient uses with responses of the same shape and size
+# (including top_logprobs for every token), and simulates the server's timing:
+# a fixed latency per request, prompt evaluation at prompt_tokens_per_second (skipped for the
+# part of the prompt already cached in the slot) and generation at tokens_per_second.
+# Answers are deterministic for a given sentence, adverb(s) and agent_type.
+# With a chat template the prompts are rendered from the real template, so raw /completion prompts
+# rendered client-side (LLMClient with a chat_template) are answered like chat completions.
+# ----------
+
+# Rough tokenizer: special tags, newlines, words and punctuation with their leading space, other whitespace
+TOKEN_PATTERN = re.compile(r"<\|[^|]*\|>|\n| ?[A-Za-z]+| ?[0-9]+| ?[^\sA-Za-z0-9]|\s")
+MOCK_KEY_PATTERN = re.compile(r"\[mock:([0-9a-f]+)\]")
+ANSWER_PROMPT_PATTERN = re.compile(r"final answer\s*:", re.IGNORECASE)
+ANSWER_CHOICES = ("A", "B", "C", "D", "E")
+CATEGORIES = ("circumstance", "stance", "focus", "linking", "discourse")
+TEMPLATE_TOKENS = 600 # Approximate size of the instructions and examples in the agent templates
+RAW_PLACEHOLDER = "\u0000raw\u0000" # Replaced by pre-encoded JSON, see encode()
+SEQUENCE_KEY_PATTERN = re.compile(r"^(.*):seq[0-9]+(:[0-9]+)?$") # Key of a sampled sequence, see _sequence_keys()
+
+REASONING_LINES = (
+    "The adverb \"{adverb}\" modifies the verb in the sentence.",
+    "The adverb \"{adverb}\" comments on the whole clause.",
+    "It does not add information about time, place or manner.",
+    "It shows the speaker's attitude towards the proposition.",
+    "It links this sentence with the previous one.",
+    "It singles out one part of the sentence.",
+    "It manages the flow of the conversation.",
+)
+
+VOCAB = {} # token id -> token, of every token the mock has handed out
+TOKEN_IDS = {} # token -> token id
+VOCAB_LOCK = threading.Lock()
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(text)
+
+def token_id(token: str):
+    """
+    Returns a stable id for a token, unique so that prompts sent as token ids can be decoded
+    """
+    if token not in TOKEN_IDS:
+        with VOCAB_LOCK:
+            if token not in TOKEN_IDS:
+                value = zlib.crc32(token.encode("utf-8")) % 128000
+                while value in VOCAB:
+                    value = (value + 1) % 128000
+                VOCAB[value] = token
+                TOKEN_IDS[token] = value
+    return TOKEN_IDS[token]
+
+def decode(prompt):
+    """
+    Returns the text of a /completion prompt: text, or a list mixing text and token ids
+    """
+    parts = prompt if isinstance(prompt, list) else [prompt]
+    return "".join(p if isinstance(p, str) else VOCAB.get(p, "") for p in parts)
+
+def estimate_tokens(text: str):
+    return max(1, len(text) // 4)
+
+def encode(data, raw_entries=None):
+    """
+    Encodes a response as JSON. The logprobs entries are encoded ahead of time (see _token_entry),
+    so the RAW_PLACEHOLDER string in data is replaced by the list of raw_entries.
+    With several placeholders (one per sequence), raw_entries is a tuple of such lists, in order.
+    Building a response with 1000 top_logprobs per token in Python would otherwise take longer
+    than the generation it simulates.
+    """
+    body = json.dumps(data, separators=(",", ":"))
+    if raw_entries is not None:
+        for entries in (raw_entries if isinstance(raw_entries, tuple) else (raw_entries,)):
+            body = body.replace(json.dumps(RAW_PLACEHOLDER), "[" + ",".join(entries) + "]", 1)
+    return body.encode("utf-8")
+
+
+class MockLlamaServer:
+    """
+    In-process mock of llama-server.
+    server = MockLlamaServer(port=0).start() # port 0 picks a free port
+    ... requests to server.url ...
+    server.stop()
+
+    latency: fixed seconds added to every request (HTTP handling, scheduling)
+    tokens_per_second: generation speed of each slot
+    prompt_tokens_per_second: prompt evaluation speed
+    parallel: number of slots; further requests wait for a free slot like they do on llama-server
+    load_time: seconds during which /health answers 503, as while the model is loading
+    seed: changes the simulated answers and logprobs
+    chat_template: optional path of the agent template, to render /apply-template like llama-server does
+    slot_save_path: optional directory for /slots/{id}?action=save|restore, like llama-server's --slot-save-path.
+    A saved slot state is the slot's cached prompt prefix, not a real KV cache.
+    Several sequences of one prompt (n on chat completions, n_cmpl on /completion) share one slot and are
+    generated side by side; sampled with a temperature, each draws its answers from the request's distribution.
+    """
+    def __init__(
+            self,
+            host: str = "127.0.0.1",
+            port: int = 8080,
+            latency: float = 0.02,
+            tokens_per_second: float = 25.0,
+            prompt_tokens_per_second: float = 400.0,
+            parallel: int = 1,
+            load_time: float = 0.0,
+            seed: int = 0,
+            chat_template = None,
+            slot_save_path = None
+        ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.parallel = max(1, parallel)
+        self.load_time = load_time
+        self.seed = seed
+        self.renderer = PromptRenderer(chat_template) if chat_template is not None else None
+        self.slot_save_path = slot_save_path
+        self.requests_served = 0
+        self.started_at = None
+        self.httpd = None
+        self._thread = None
+        self._slots = [{"busy": False, "prefix": None, "size": 0, "text": None, "key": None, "last_used": 0.0} for _ in range(self.parallel)]
+        self._slots_changed = threading.Condition()
+        self._fillers = {} # number of entries -> encoded filler top_logprobs entries
+        self._rendered = {} # request key -> (prefix, prompt tokens, tokens of the rendered text) of the prompts rendered by /apply-template
+        self._prefix_sizes = {} # static prefix text -> tokens
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    # ----------
+    # Starting and stopping
+    # ----------
+    def start(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self.httpd = ThreadingHTTPServer((self.host, self.port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.started_at = time.time()
+        print(f"Mock llama-server listening on {self.url} with {self.parallel} slots", flush=True)
+        self.httpd.serve_forever()
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    def is_ready(self):
+        return self.started_at is not None and time.time() - self.started_at >= self.load_time
+
+    # ----------
+    # Slots
+    # ----------
+    def _acquire_slot(self, id_slot, prefix, key=None, key_cached=0):
+        """
+        Waits for a free slot and returns its id and the number of prompt tokens it has cached.
+        Without an id_slot the free slot that last served the same request key is preferred,
+        then the one holding the same prompt prefix, then the least recently used one.
+        key_cached: tokens cached when the slot last served the same request key, e.g., a scoring call after its chat completion
+        prefix: (prefix id, prefix tokens) or, for prompts rendered from the real template, (prefix id, prefix tokens, prefix text),
+        in which case a slot holding another prefix still reuses the tokens the two prefixes have in common, like llama-server
+        """
+        with self._slots_changed:
+            while True:
+                if id_slot is not None and 0 <= id_slot < self.parallel:
+                    candidates = [id_slot] if not self._slots[id_slot]["busy"] else []
+                else:
+                    free = [i for i, slot in enumerate(self._slots) if not slot["busy"]]
+                    same_key = [i for i in free if key is not None and self._slots[i]["key"] == key]
+                    matching = [i for i in free if self._slots[i]["prefix"] == prefix[0]]
+                    candidates = same_key or matching or sorted(free, key=lambda i: self._slots[i]["last_used"])
+                if candidates:
+                    slot_id = candidates[0]
+                    slot = self._slots[slot_id]
+                    slot["busy"] = True
+                    if key is not None and slot["key"] == key and prefix[0] is not None:
+                        cached = key_cached
+                    else:
+                        cached = prefix[1] if slot["prefix"] == prefix[0] else self._shared_tokens(slot["text"], prefix[2] if len(prefix) > 2 else None)
+                    slot["prefix"] = prefix[0]
+                    slot["size"] = prefix[1]
+                    slot["text"] = prefix[2] if len(prefix) > 2 else None
+                    slot["key"] = key
+                    return slot_id, cached
+                self._slots_changed.wait()
+
+    def _shared_tokens(self, cached_text, text):
+        """
+        Returns the tokens of the longest common prefix of two prompt prefixes, cut at the start of a line
+        """
+        if not cached_text or not text:
+            return 0
+        shared = os.path.commonprefix([cached_text, text])
+        shared = shared[:shared.rfind("\n") + 1]
+        if shared not in self._prefix_sizes:
+            self._prefix_sizes[shared] = len(tokenize(shared))
+        return self._prefix_sizes[shared]
+
+    def _slot_action(self, slot_id: int, action: str, filename: str):
+        """
+        Saves the cached prompt prefix of a slot to a file of the slot_save_path, or restores it,
+        once the slot is idle. Returns (status, response) like llama-server's /slots/{id}?action=
+        """
+        if self.slot_save_path is None:
+            return 501, {"error": {"code": 501, "message": "This server does not support slots action.", "type": "not_supported_error"}}
+        if not 0 <= slot_id < self.parallel or not filename or "/" in filename or action not in ("save", "restore"):
+            return 400, {"error": {"code": 400, "message": "Invalid slot action", "type": "invalid_request_error"}}
+        path = Path(self.slot_save_path) / filename
+        with self._slots_changed:
+            while self._slots[slot_id]["busy"]:
+                self._slots_changed.wait()
+            slot = self._slots[slot_id]
+            if action == "save":
+                state = json.dumps({"prefix": slot["prefix"], "size": slot["size"], "text": slot["text"]})
+                path.write_text(state, encoding="utf-8")
+                return 200, {"id_slot": slot_id, "filename": filename, "n_saved": slot["size"], "n_written": len(state), "timings": {"save_ms": 0.0}}
+            if not path.exists():
+                return 400, {"error": {"code": 400, "message": "Failed to restore slot", "type": "invalid_request_error"}}
+            state = json.loads(path.read_text(encoding="utf-8"))
+            slot.update(prefix=state["prefix"], size=state["size"], text=state["text"], key=None)
+            return 200, {"id_slot": slot_id, "filename": filename, "n_restored": state["size"], "n_read": path.stat().st_size, "timings": {"restore_ms": 0.0}}
+
+    def _release_slot(self, slot_id):
+        with self._slots_changed:
+            self._slots[slot_id]["busy"] = False
+            self._slots[slot_id]["last_used"] = time.time()
+            self._slots_changed.notify_all()
+
+    # ----------
+    # Simulated model
+    # ----------
+    def _key(self, chat_template_kwargs: dict, messages):
+        relevant = {k: v for k, v in chat_template_kwargs.items() if k != "knowledge_base"}
+        canonical = json.dumps([relevant, messages], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{self.seed}\n{canonical}".encode("utf-8")).hexdigest()[:16]
+
+    @staticmethod
+    def _answer_key(key: str, i: int):
+        """
+        Returns the key of the i-th answer of a request; requests with several answers
+        (syntactic-grouper-multi) draw each answer separately
+        """
+        return key if i == 0 else f"{key}:{i}"
+
+    def _answer_distribution(self, key: str):
+        """
+        Returns the answer letter and the logprobs of all the answer choices for a request key
+        """
+        sampled = SEQUENCE_KEY_PATTERN.match(key)
+        if sampled:
+            # A sampled sequence draws its answer from the distribution of the request
+            _, logprobs = self._answer_distribution(sampled.group(1) + (sampled.group(2) or ""))
+            answer = random.Random(key).choices(ANSWER_CHOICES, weights=[math.exp(logprobs[c]) for c in ANSWER_CHOICES])[0]
+            return answer, logprobs
+        rng = random.Random(key)
+        weights = [rng.random() ** 3 + 1e-6 for _ in ANSWER_CHOICES]
+        answer = rng.randrange(len(ANSWER_CHOICES))
+        weights[answer] = sum(weights) + rng.random() * 4 # The answer clearly wins most of the time
+        total = sum(weights)
+        return ANSWER_CHOICES[answer], {choice: math.log(w / total) for choice, w in zip(ANSWER_CHOICES, weights)}
+
+    def _read_prompt(self, text: str):
+        """
+        Reads a prompt rendered from the real template (the mock's own rendering or the client's) and returns
+        {"key", "chat_template_kwargs", "agent_type", "answer_only", "prefix", "prompt_n", "tail"}:
+        the request is recovered from the last user turn, the static prefix is everything before that turn's content,
+        and the tail is what the client appended after the rendered prompt, e.g., "<|assistant|>\nFinal answer:"
+        or the tokens generated so far.
+        """
+        user = text.rfind("<|user|>")
+        content_start = text.find("\n", user) + 1 if user >= 0 else len(text) # No user turn: a static prefix on its own
+        tail_start = text.find("<|assistant|>", content_start)
+        if tail_start < 0:
+            tail_start = len(text)
+        content = text[content_start:tail_start].strip()
+        single = re.match(r'\{ "sentence": "(.*)", "adverb": "(.*)" \}$', content)
+        multi = re.match(r'\{ "sentence": "(.*)", "adverbs": \[(.*)\] \}$', content)
+        if single:
+            kwargs, agent_type = {"sentence": single.group(1), "adverb": single.group(2)}, None
+        elif multi:
+            kwargs, agent_type = {"sentence": multi.group(1), "adverbs": re.findall(r'"(.*?)"', multi.group(2))}, None
+        else:
+            kwargs, agent_type = {"sentence": content}, "mw_adverb_analyst"
+        prefix = text[:content_start]
+        if prefix not in self._prefix_sizes:
+            self._prefix_sizes[prefix] = len(tokenize(prefix))
+        base = text[:tail_start]
+        return {
+            "key": hashlib.sha256(f"{self.seed}\n{base}".encode("utf-8")).hexdigest()[:16],
+            "chat_template_kwargs": kwargs,
+            "agent_type": agent_type,
+            "answer_only": "only the final answer" in prefix,
+            "prefix": (f"prefix:{hash(prefix)}", self._prefix_sizes[prefix], prefix),
+            "prompt_n": len(tokenize(text)),
+            "tail": text[tail_start:]
+        }
+
+    def _generate_text(self, key: str, chat_template_kwargs: dict, agent_type, answer_only=None):
+        """
+        answer_only: whether the agent answers without reasoning; by default read from the agent_type's grammar
+        """
+        rng = random.Random(key)
+        sentence = chat_template_kwargs.get("sentence", "")
+        if agent_type == "mw_adverb_analyst":
+            words = [w for w in sentence.split() if w.isalpha()]
+            adverbs = []
+            if len(words) > 3 and rng.random() < 0.3:
+                start = rng.randrange(len(words) - 1)
+                adverbs.append(" ".join(words[start:start + 2]))
+            return json.dumps({"adverbs": adverbs})
+        answer, _ = self._answer_distribution(key)
+        if answer_only is None:
+            answer_only = AGENT_GRAMMARS.get(agent_type) == FINAL_ANSWER_ONLY
+        if answer_only:
+            return f"<|assistant|>\nFinal answer: {answer}"
+        if "adverbs" in chat_template_kwargs:
+            # One block per adverb, each with its own answer
+            blocks = []
+            for n, adverb in enumerate(chat_template_kwargs["adverbs"]):
+                answer, _ = self._answer_distribution(self._answer_key(key, n))
+                blocks.append(f"Adverb {n + 1}: \"{adverb}\"\n{self._reasoning(rng, adverb, answer)}\nFinal answer: {answer}")
+            return "<|assistant|>\n" + "\n".join(blocks)
+        adverb = chat_template_kwargs.get("adverb", "it")
+        return f"<|assistant|>\n{self._reasoning(rng, adverb, answer)}\nFinal answer: {answer}"
+
+    @staticmethod
+    def _reasoning(rng, adverb: str, answer: str):
+        lines = [line.format(adverb=adverb) for line in rng.sample(REASONING_LINES, rng.randint(2, 4))]
+        category = CATEGORIES[ANSWER_CHOICES.index(answer)]
+        lines.append(f"Therefore, it is a {category} adverb.")
+        return "\n".join(f"{i}. {line}" for i, line in enumerate(lines, start=1))
+
+    def _filler(self, n: int):
+        """
+        Returns n encoded unlikely alternative tokens that pad a top_logprobs list to top_k entries
+        """
+        if n not in self._fillers:
+            self._fillers[n] = ",".join(
+                json.dumps({"id": 1000 + i, "token": f" tok{i}", "bytes": list(f" tok{i}".encode("utf-8")), "logprob": -6.0 - 14.0 * i / n}, separators=(",", ":"))
+                for i in range(n)
+            )
+        return self._fillers[n]
+
+    def _token_entry(self, token: str, logprob: float, top_k: int, alternatives=None):
+        """
+        Returns the encoded logprobs entry of one token, with top_k top_logprobs
+        """
+        entry = {"id": token_id(token), "token": token, "bytes": list(token.encode("utf-8")), "logprob": logprob}
+        if top_k <= 0:
+            return json.dumps(entry, separators=(",", ":"))
+        top = [dict(entry)]
+        for alt_token, alt_logprob in (alternatives or []):
+            if alt_token != token:
+                top.append({"id": token_id(alt_token), "token": alt_token, "bytes": list(alt_token.encode("utf-8")), "logprob": alt_logprob})
+        top = [json.dumps(e, separators=(",", ":")) for e in top[:top_k]]
+        if top_k > len(top):
+            top.append(self._filler(top_k - len(top)))
+        return json.dumps(entry, separators=(",", ":"))[:-1] + ',"top_logprobs":[' + ",".join(top) + "]}"
+
+    def _logprobs_content(self, key: str, tokens, top_k: int):
+        """
+        Builds the encoded logprobs["content"] entries of the generated tokens.
+        Each final answer token carries its answer distribution in its top_logprobs.
+        """
+        rng = random.Random(key + ":logprobs")
+        # Answer tokens follow "Final answer:"; without one, the last letter token is the answer
+        answer_indices = [
+            i for i in range(2, len(tokens))
+            if tokens[i].strip() in ANSWER_CHOICES and tokens[i - 2:i] == [" answer", ":"]
+        ]
+        if not answer_indices:
+            answer_indices = [i for i in range(len(tokens)) if tokens[i].strip() in ANSWER_CHOICES][-1:]
+        answers = {index: self._answer_distribution(self._answer_key(key, n))[1] for n, index in enumerate(answer_indices)}
+        content = []
+        for i, token in enumerate(tokens):
+            if i in answers:
+                answer_logprobs = answers[i]
+                answer_alternatives = sorted(((f" {c}", lp) for c, lp in answer_logprobs.items()), key=lambda x: -x[1])
+                content.append(self._token_entry(token, answer_logprobs[token.strip()], top_k, answer_alternatives))
+            else:
+                content.append(self._token_entry(token, -rng.expovariate(4.0), top_k))
+        return content
+
+    def _prompt_size(self, chat_template_kwargs: dict, messages):
+        """
+        Returns (prefix, total) prompt tokens. The prefix is the part shared by all requests of an
+        agent_type (template and knowledge base), which llama-server can keep in a slot's cache.
+        """
+        prefix_text = f"{chat_template_kwargs.get('agent_type', '')}{chat_template_kwargs.get('knowledge_base', '')}"
+        prefix = TEMPLATE_TOKENS + estimate_tokens(prefix_text)
+        rest = sum(estimate_tokens(str(v)) for k, v in chat_template_kwargs.items() if k not in ("agent_type", "knowledge_base"))
+        rest += sum(estimate_tokens(str(m.get("content", ""))) for m in messages)
+        return prefix, prefix + rest + 4
+
+    @staticmethod
+    def _top_k(payload: dict):
+        logprobs = payload.get("logprobs")
+        if logprobs is True:
+            return max(0, int(payload.get("top_logprobs", 0)))
+        if isinstance(logprobs, int) and not isinstance(logprobs, bool):
+            return max(0, logprobs)
+        return 0
+
+    def _timings(self, prompt_n, cache_n, predicted_n):
+        prompt_ms = 1000 * prompt_n / self.prompt_tokens_per_second
+        predicted_ms = 1000 * predicted_n / self.tokens_per_second
+        return {
+            "cache_n": cache_n,
+            "prompt_n": prompt_n,
+            "prompt_ms": prompt_ms,
+            "prompt_per_second": self.prompt_tokens_per_second,
+            "predicted_n": predicted_n,
+            "predicted_ms": predicted_ms,
+            "predicted_per_second": self.tokens_per_second,
+        }
+
+    @staticmethod
+    def _sequence_keys(key: str, payload: dict):
+        """
+        Returns the keys of the sequences of a request (n or n_cmpl). Near-greedy sequences (temperature below 0.1)
+        are all the same generation
+        """
+        n = max(1, int(payload.get("n", payload.get("n_cmpl", 1)) or 1))
+        sampled = (payload.get("temperature", 0.8) or 0) >= 0.1
+        return [key if i == 0 or not sampled else f"{key}:seq{i}" for i in range(n)]
+
+    def _prepare_chat(self, payload: dict):
+        """
+        Returns the key, the sequences [(sequence key, generated tokens, finish reason)] and the prompt sizes
+        of a chat completion request
+        """
+        kwargs = payload.get("chat_template_kwargs") or {}
+        messages = payload.get("messages") or []
+        agent_type = kwargs.get("agent_type") or ("mw_adverb_analyst" if list(kwargs) == ["sentence"] else None)
+        if self.renderer is not None:
+            # Same key and prompt size as the raw completion of the same rendered prompt
+            prompt = self._read_prompt(self.renderer.render(kwargs, messages))
+            key, prefix, prompt_n = prompt["key"], prompt["prefix"], prompt["prompt_n"]
+        else:
+            key = self._key(kwargs, messages)
+            prefix_n, prompt_n = self._prompt_size(kwargs, messages)
+            prefix = (f"{kwargs.get('agent_type')}:{hash(kwargs.get('knowledge_base'))}", prefix_n)
+        n_predict = payload.get("n_predict", payload.get("max_tokens", -1))
+        sequences = [(seq_key, *self._generate_tokens(seq_key, kwargs, agent_type, n_predict)) for seq_key in self._sequence_keys(key, payload)]
+        return key, sequences, prefix, prompt_n
+
+    def _generate_tokens(self, key: str, chat_template_kwargs: dict, agent_type, n_predict, answer_only=None):
+        """
+        Returns the generated tokens, cut at n_predict, and the finish reason ("stop" or "length")
+        """
+        tokens = tokenize(self._generate_text(key, chat_template_kwargs, agent_type, answer_only))
+        if n_predict is not None and 0 <= n_predict < len(tokens):
+            return tokens[:n_predict], "length"
+        return tokens, "stop"
+
+    # ----------
+    # HTTP
+    # ----------
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass # Keep the load test output readable
+
+            def _send_json(self, status, data):
+                self._send_body(encode(data), status)
+
+            def _send_body(self, body: bytes, status=200):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _read_json(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                if self.path == "/health":
+                    if mock.is_ready():
+                        self._send_json(200, {"status": "ok"})
+                    else:
+                        self._send_json(503, {"error": {"code": 503, "message": "Loading model", "type": "unavailable_error"}})
+                else:
+                    self._send_json(404, {"error": {"code": 404, "message": "File Not Found"}})
+
+            def do_POST(self):
+                payload = self._read_json()
+                if not mock.is_ready():
+                    self._send_json(503, {"error": {"code": 503, "message": "Loading model"}})
+                    return
+                mock.requests_served += 1
+                if self.path in ("/chat/completions", "/v1/chat/completions"):
+                    if payload.get("stream"):
+                        self._stream_chat(payload)
+                    else:
+                        self._chat(payload)
+                elif self.path == "/completion":
+                    self._completion(payload)
+                elif self.path.startswith("/slots/"):
+                    slot, _, query = self.path[len("/slots/"):].partition("?action=")
+                    self._send_json(*mock._slot_action(int(slot) if slot.isdigit() else -1, query, payload.get("filename", "")))
+                elif self.path == "/tokenize":
+                    self._send_json(200, {"tokens": [token_id(token) for token in tokenize(payload.get("content", ""))]})
+                elif self.path == "/apply-template" and mock.renderer is not None:
+                    self._send_json(200, {"prompt": mock.renderer.render(payload.get("chat_template_kwargs") or {}, payload.get("messages") or [])})
+                elif self.path == "/apply-template":
+                    kwargs = payload.get("chat_template_kwargs") or {}
+                    messages = payload.get("messages") or []
+                    user_turns = "".join(f"\n<|user|>\n{m.get('content', '')}" for m in messages)
+                    key = mock._key(kwargs, messages)
+                    prefix_n, prompt_n = mock._prompt_size(kwargs, messages)
+                    prompt = (
+                        f"<|system|>\n[mock:{key}]\n{kwargs.get('knowledge_base', '')}\n"
+                        f"<|user|>\n{json.dumps({k: v for k, v in kwargs.items() if k != 'knowledge_base'})}{user_turns}\n"
+                    )
+                    mock._rendered[key] = ((f"{kwargs.get('agent_type')}:{hash(kwargs.get('knowledge_base'))}", prefix_n), prompt_n, estimate_tokens(prompt))
+                    self._send_json(200, {"prompt": prompt})
+                else:
+                    self._send_json(404, {"error": {"code": 404, "message": "File Not Found"}})
+
+            def _chat(self, payload):
+                started = time.perf_counter()
+                key, sequences, prefix, prompt_n = mock._prepare_chat(payload)
+                slot_id, cache_n = mock._acquire_slot(payload.get("id_slot"), prefix if payload.get("cache_prompt", True) else (None, 0), key, prompt_n - 1)
+                try:
+                    top_k = mock._top_k(payload)
+                    choices, contents = [], []
+                    for i, (seq_key, tokens, finish_reason) in enumerate(sequences):
+                        choice = {
+                            "index": i,
+                            "message": {"role": "assistant", "content": "".join(tokens)},
+                            "finish_reason": finish_reason
+                        }
+                        if payload.get("logprobs"):
+                            contents.append(mock._logprobs_content(seq_key, tokens, top_k))
+                            choice["logprobs"] = {"content": RAW_PLACEHOLDER}
+                        choices.append(choice)
+                    predicted_n = sum(len(tokens) for _, tokens, _ in sequences)
+                    timings = mock._timings(prompt_n - cache_n, cache_n, predicted_n)
+                    # The sequences are generated side by side, as long as the longest one
+                    timings["predicted_ms"] = 1000 * max(len(tokens) for _, tokens, _ in sequences) / mock.tokens_per_second
+                    data = {
+                        "choices": choices,
+                        "usage": {"prompt_tokens": prompt_n, "completion_tokens": predicted_n, "total_tokens": prompt_n + predicted_n},
+                        "timings": timings
+                    }
+                    body = encode(data, tuple(contents) if contents else None)
+                    # Building the response counts towards the simulated server time
+                    simulated = mock.latency + (timings["prompt_ms"] + timings["predicted_ms"]) / 1000
+                    time.sleep(max(0.0, simulated - (time.perf_counter() - started)))
+                finally:
+                    mock._release_slot(slot_id)
+                self._send_body(body)
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _stream_events(self, started, tokens, timings, event, final_events):
+                """
+                Writes the server-sent event of each generated token at the simulated generation speed,
+                followed by the final events
+                """
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                first_token_at = started + mock.latency + timings["prompt_ms"] / 1000
+                for i, token in enumerate(tokens):
+                    time.sleep(max(0.0, first_token_at + (i + 1) / mock.tokens_per_second - time.perf_counter()))
+                    self._write_chunk(b"data: " + event(i, token) + b"\n\n")
+                for final in final_events:
+                    self._write_chunk(b"data: " + final + b"\n\n")
+                self._write_chunk(b"")
+
+            def _stream_chat(self, payload):
+                started = time.perf_counter()
+                key, sequences, prefix, prompt_n = mock._prepare_chat(payload)
+                _, tokens, finish_reason = sequences[0] # Like the client, streaming only handles one sequence
+                slot_id, cache_n = mock._acquire_slot(payload.get("id_slot"), prefix if payload.get("cache_prompt", True) else (None, 0), key, prompt_n - 1)
+                try:
+                    top_k = mock._top_k(payload)
+                    content = mock._logprobs_content(key, tokens, top_k) if payload.get("logprobs") else None
+                    timings = mock._timings(prompt_n - cache_n, cache_n, len(tokens))
+
+                    def event(i, token):
+                        choice = {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                        if content is not None:
+                            choice["logprobs"] = {"content": RAW_PLACEHOLDER}
+                        chunk = {"choices": [choice]}
+                        if payload.get("timings_per_token"):
+                            chunk["timings"] = mock._timings(prompt_n - cache_n, cache_n, i + 1)
+                        return encode(chunk, content[i:i + 1] if content is not None else None)
+
+                    final = {"choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}], "timings": timings}
+                    self._stream_events(started, tokens, timings, event, [encode(final), b"[DONE]"])
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # The client stopped the generation early
+                finally:
+                    mock._release_slot(slot_id)
+
+            def _completion(self, payload):
+                """
+                Raw completion.
+                With n_predict 1: next-token scoring as used by LLMClient.score_next_token and LLMClient.score_answer,
+                the next token is the final answer of the request the prompt was rendered for. The answers already
+                written after the rendered prompt tell which answer of a multi-answer request is scored.
+                With a longer n_predict: the generation of a prompt rendered client-side (LLMClient.complete_rendered),
+                the same generation as the chat completion of the request. With n_cmpl > 1 the response is a list
+                with one result per sequence.
+                """
+                started = time.perf_counter()
+                prompt = payload.get("prompt", "")
+                parts = prompt if isinstance(prompt, list) else [prompt]
+                text = decode(prompt)
+                match = MOCK_KEY_PATTERN.search(text)
+                if match:
+                    # Rendered by the mock's own /apply-template without a chat template
+                    key = match.group(1)
+                    prompt_n = sum(estimate_tokens(p) if isinstance(p, str) else 1 for p in parts)
+                    prefix = (f"completion:{key}", 0)
+                    if key in mock._rendered:
+                        # Same prompt size and shared prefix as the chat completion of the request, plus what the client appended
+                        prefix, rendered_n, text_n = mock._rendered[key]
+                        prompt_n = rendered_n + prompt_n - text_n
+                    answers_written = sum(1 for p in parts if p == token_id(" answer"))
+                    read = None
+                else:
+                    read = mock._read_prompt(text)
+                    key, prefix, prompt_n = read["key"], read["prefix"], read["prompt_n"]
+                    answers_written = len(ANSWER_PROMPT_PATTERN.findall(read["tail"]))
+                n_predict = payload.get("n_predict", -1)
+                generate = read is not None and (n_predict is None or n_predict < 0 or n_predict > 1)
+                slot_id, cache_n = mock._acquire_slot(payload.get("id_slot"), prefix if payload.get("cache_prompt", True) else (None, 0), key, max(0, prompt_n - 1))
+                try:
+                    n_probs = max(0, int(payload.get("n_probs", 0) or 0))
+                    seq_keys = mock._sequence_keys(key, payload) if generate else [key]
+                    if len(seq_keys) > 1 and not payload.get("stream"):
+                        results, contents = [], []
+                        for i, seq_key in enumerate(seq_keys):
+                            tokens, finish_reason = mock._generate_tokens(seq_key, read["chat_template_kwargs"], read["agent_type"], n_predict, read["answer_only"])
+                            # The sequences share one evaluation of the prompt, the first one reports it
+                            result = {
+                                "index": i, "content": "".join(tokens), "stop": True, "stop_type": "limit" if finish_reason == "length" else "eos",
+                                "tokens_predicted": len(tokens), "tokens_evaluated": prompt_n,
+                                "timings": mock._timings(prompt_n - cache_n if i == 0 else 0, cache_n if i == 0 else prompt_n, len(tokens))
+                            }
+                            if n_probs:
+                                contents.append(mock._logprobs_content(seq_key, tokens, n_probs))
+                                result["completion_probabilities"] = RAW_PLACEHOLDER
+                            results.append(result)
+                        body = encode(results, tuple(contents) if contents else None)
+                        # Generated side by side, as long as the longest sequence
+                        simulated = mock.latency + (results[0]["timings"]["prompt_ms"] + max(r["timings"]["predicted_ms"] for r in results)) / 1000
+                    else:
+                        if generate:
+                            tokens, finish_reason = mock._generate_tokens(key, read["chat_template_kwargs"], read["agent_type"], n_predict, read["answer_only"])
+                            content = mock._logprobs_content(key, tokens, n_probs) if n_probs else None
+                            stop_type = "limit" if finish_reason == "length" else "eos"
+                        else:
+                            answer, answer_logprobs = mock._answer_distribution(mock._answer_key(key, max(0, answers_written - 1)))
+                            alternatives = sorted(((f" {c}", lp) for c, lp in answer_logprobs.items()), key=lambda x: -x[1])
+                            tokens, stop_type = [f" {answer}"], "limit"
+                            content = [mock._token_entry(f" {answer}", answer_logprobs[answer], max(1, n_probs), alternatives)]
+                        timings = mock._timings(prompt_n - cache_n, cache_n, len(tokens))
+                        if generate and payload.get("stream"):
+                            self._stream_completion(payload, started, tokens, content, stop_type, timings, prompt_n - cache_n, cache_n)
+                            return
+                        data = {"content": "".join(tokens), "stop": True, "stop_type": stop_type, "tokens_predicted": len(tokens), "tokens_evaluated": prompt_n, "timings": timings}
+                        if content is not None:
+                            data["completion_probabilities"] = RAW_PLACEHOLDER
+                        body = encode(data, content)
+                        simulated = mock.latency + (timings["prompt_ms"] + timings["predicted_ms"]) / 1000
+                    time.sleep(max(0.0, simulated - (time.perf_counter() - started)))
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True # The client stopped the generation early
+                    return
+                finally:
+                    mock._release_slot(slot_id)
+                self._send_body(body)
+
+            def _stream_completion(self, payload, started, tokens, content, stop_type, timings, prompt_n, cache_n):
+                def event(i, token):
+                    chunk = {"content": token, "stop": False}
+                    if content is not None:
+                        chunk["completion_probabilities"] = RAW_PLACEHOLDER
+                    if payload.get("timings_per_token"):
+                        chunk["timings"] = mock._timings(prompt_n, cache_n, i + 1)
+                    return encode(chunk, content[i:i + 1] if content is not None else None)
+
+                final = {"content": "", "stop": True, "stop_type": stop_type, "tokens_predicted": len(tokens), "timings": timings}
+                self._stream_events(started, tokens, timings, event, [encode(final)])
+
+        return Handler
+
+
+def main():
+    """
+    Runs the mock as a standalone server.
+    It accepts and ignores the other llama-server arguments, so it can be started by the
+    ServerManager in place of the real binary (--server_bin $(which mock-llama-server)).
+    """
+    parser = argparse.ArgumentParser(description="Mock llama-server for benchmarking the pipelines without a model.", allow_abbrev=False)
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument("--parallel", "-np", type=int, default=1, help="Number of slots (default: 1)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Fixed seconds added to every request (default: 0.02)")
+    parser.add_argument("--tokens_per_second", type=float, default=25.0, help="Generation speed of each slot (default: 25)")
+    parser.add_argument("--prompt_tokens_per_second", type=float, default=400.0, help="Prompt evaluation speed (default: 400)")
+    parser.add_argument("--load_time", type=float, default=0.0, help="Seconds before /health reports the model as loaded (default: 0)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the simulated answers (default: 0)")
+    parser.add_argument("--chat-template-file", dest="chat_template", default=None, help="Agent template to render /apply-template with, as passed by the ServerManager")
+    parser.add_argument("--slot-save-path", dest="slot_save_path", default=None, help="Directory of the saved slot states, as passed by the ServerManager")
+    args, _ = parser.parse_known_args()
+
+    server = MockLlamaServer(
+        args.host,
+        args.port,
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        prompt_tokens_per_second=args.prompt_tokens_per_second,
+        parallel=args.parallel,
+        load_time=args.load_time,
+        seed=args.seed,
+        chat_template=args.chat_template,
+        slot_save_path=args.slot_save_path
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
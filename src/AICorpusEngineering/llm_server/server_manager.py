@@ -1,37 +1,321 @@
-import subprocess, time
+import subprocess, time, threading, logging, hashlib
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+import requests
+from AICorpusEngineering.llm_client.response_cache import ResponseCache
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile, profile_arguments, validate_profile
 
 class ServerManager:
-    def __init__(self, server_bin, model_path, chat_template, port=8080):
+    def __init__(
+            self,
+            server_bin,
+            model_path,
+            chat_template,
+            port=8080,
+            parallel=1,
+            ctx_size=8192,
+            instances=1,
+            threads=None,
+            log_dir=None,
+            ready_timeout=600,
+            max_restarts=5,
+            slot_cache_dir=None,
+            profile=None
+        ):
+        """
+        parallel: number of slots each server decodes at once (continuous batching).
+        ctx_size: total context window (-c) of each server, shared equally between its slots.
+        instances: number of llama-server processes in the pool, listening on consecutive ports from port.
+        threads: total number of CPU threads, split evenly between the instances. Defaults to the profile's threads, else 6.
+        log_dir: directory for the rotating server log files, llama-server-{port}.log.
+        The server output is always drained so that a chatty server can never block on a full pipe;
+        without a log_dir it is discarded.
+        ready_timeout: seconds to wait for a server to load the model and report healthy.
+        max_restarts: number of times a crashed server is restarted before giving up.
+        slot_cache_dir: optional directory where the servers save the KV state of their slots (--slot-save-path),
+        so that the long shared prompt prefixes are restored instead of evaluated again after a restart or in the next run
+        (see save_slot, restore_slot and LLMClient._prepare_slot_state).
+        profile: the llama-server settings (batch sizes, KV cache types, mlock, ...) as a dict, see server_profiles.
+        Defaults to the "default" profile.
+        """
         self.server_bin = server_bin
         self.model_path = model_path
         self.chat_template = chat_template
         self.port = port
-        self.proc = None
+        self.parallel = parallel
+        self.ctx_size = ctx_size
+        self.instances = max(1, instances)
+        self.profile = validate_profile(dict(profile)) if profile is not None else load_server_profile(None)
+        self.threads = threads or self.profile.get("threads") or 6
+        self.log_dir = Path(log_dir).expanduser().resolve() if log_dir is not None else None
+        self.ready_timeout = ready_timeout
+        self.max_restarts = max_restarts
+        self.slot_cache_dir = Path(slot_cache_dir).expanduser().resolve() if slot_cache_dir is not None else None
+        self.slot_files = {} # port -> {slot id: saved state file the slot holds}
+        self._model_fingerprint = None
+        self.restarts = 0
+        self.procs = {} # port -> running llama-server process
+        self._lock = threading.RLock()
+        self._restarting = {} # port -> {"done": Event set once the restarted server is ready, "error"}
+        self._stopping = threading.Event()
+        self._watchdog = None
 
-    def start(self):
-        cmd=[
+    @property
+    def ports(self):
+        return [self.port + i for i in range(self.instances)]
+
+    @property
+    def server_urls(self):
+        """
+        The urls of all the servers in the pool, for the LLMClient's router
+        """
+        return [self._url(port) for port in self.ports]
+
+    def _url(self, port):
+        return f"http://127.0.0.1:{port}"
+
+    @staticmethod
+    def _port(port_or_url):
+        return port_or_url if isinstance(port_or_url, int) else int(str(port_or_url).rstrip("/").rsplit(":", 1)[1])
+
+    def _command(self, port):
+        threads_per_instance = max(1, self.threads // self.instances)
+        slot_cache = ["--slot-save-path", str(self.slot_cache_dir)] if self.slot_cache_dir is not None else []
+        return [
             self.server_bin,
             "-m", self.model_path,
-            "-c", "8192",
-            "-t", "6",
-            "--n-gpu-layers", "40",
+            "-c", str(self.ctx_size),
+            "-t", str(threads_per_instance),
+            *profile_arguments(self.profile, self.instances),
             "--temp", "0.001",
             "--top-p", "0.85",
             "--jinja",
             "--chat-template-file", self.chat_template,
-            "--port", str(self.port)
-        ]
-        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"Started llama-server (PID {self.proc.pid} on port {self.port})")
-        print(f"The chat template is {self.chat_template}")
-        time.sleep(5) # Let the server warm up
+            "--port", str(port),
+            "--parallel", str(self.parallel)
+        ] + slot_cache
+
+    # ----------
+    # Starting and stopping
+    # ----------
+    def start(self):
+        self._stopping.clear()
+        if self.slot_cache_dir is not None:
+            self.slot_cache_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            for port in self.ports:
+                self._launch(port)
+            print(f"The chat template is {self.chat_template}")
+            for port in self.ports:
+                self.wait_until_ready(port)
+                self.warm_up(port)
+        except Exception:
+            self.stop() # Do not leave half a pool running
+            raise
+
+        # Watch for crashed servers in the background
+        self._watchdog = threading.Thread(target=self._watch, daemon=True)
+        self._watchdog.start()
+
+    def _launch(self, port):
+        proc = subprocess.Popen(
+            self._command(port),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL
+        )
+        with self._lock:
+            self.procs[port] = proc
+        threading.Thread(target=self._drain_logs, args=(proc, port), daemon=True).start()
+        print(f"Started llama-server (PID {proc.pid} on port {port})")
+        return proc
 
     def stop(self):
-        if self.proc:
-            print(f"Stopping llama-server (PID {self.proc.pid})")
-            self.proc.terminate()
+        self._stopping.set()
+        with self._lock:
+            procs = list(self.procs.values())
+            self.procs = {}
+        for proc in procs:
+            print(f"Stopping llama-server (PID {proc.pid})")
+            proc.terminate()
+        for proc in procs:
             try:
-                self.proc.wait(timeout=10)
+                proc.wait(timeout=10)
             except subprocess.TimeoutExpired:
                 print("Forcing shutdown of llama-server")
-                self.proc.kill()
\ No newline at end of file
+                proc.kill()
+
+    # ----------
+    # Readiness
+    # ----------
+    def wait_until_ready(self, port, timeout=None):
+        """
+        Polls /health until the server has loaded the model.
+        llama-server answers 503 while loading and 200 once it can take requests.
+        Raises a RuntimeError if the server exits or does not become ready in time.
+        """
+        timeout = timeout or self.ready_timeout
+        deadline = time.time() + timeout
+        url = f"{self._url(port)}/health"
+        while time.time() < deadline:
+            proc = self.procs.get(port)
+            if proc is None or proc.poll() is not None:
+                code = proc.returncode if proc is not None else None
+                raise RuntimeError(f"llama-server on port {port} exited with code {code} before it was ready, see {self._log_path(port)}")
+            try:
+                if requests.get(url, timeout=2).status_code == 200:
+                    print(f"llama-server on port {port} is ready")
+                    return True
+            except requests.RequestException:
+                pass # Not listening yet
+            time.sleep(0.25)
+        raise RuntimeError(f"llama-server on port {port} was not ready after {timeout} seconds")
+
+    def warm_up(self, port):
+        """
+        Sends one tiny request so that the first real request does not pay for the first decode
+        """
+        try:
+            requests.post(f"{self._url(port)}/completion", json={"prompt": "Hello", "n_predict": 1}, timeout=60)
+        except requests.RequestException as e:
+            print(f"Warm-up request to port {port} failed: {e}")
+
+    # ----------
+    # Logs
+    # ----------
+    def _log_path(self, port):
+        return self.log_dir / f"llama-server-{port}.log" if self.log_dir is not None else "the server output (no log_dir set)"
+
+    def _drain_logs(self, proc, port):
+        """
+        Reads the server output continuously so the pipe never fills up,
+        writing it to a rotating log file when a log_dir is set
+        """
+        server_log = None
+        if self.log_dir is not None:
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            server_log = logging.getLogger(f"llama-server.{port}")
+            server_log.propagate = False
+            server_log.setLevel(logging.INFO)
+            if not server_log.handlers:
+                handler = RotatingFileHandler(self.log_dir / f"llama-server-{port}.log", maxBytes=10 * 1024**2, backupCount=3, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+                server_log.addHandler(handler)
+        for line in iter(proc.stdout.readline, b""):
+            if server_log is not None:
+                server_log.info(line.decode("utf-8", errors="replace").rstrip())
+        proc.stdout.close()
+
+    # ----------
+    # Crash detection and restarts
+    # ----------
+    def _watch(self):
+        while not self._stopping.wait(2):
+            for port in self.ports:
+                try:
+                    self.ensure_running(port)
+                except RuntimeError as e:
+                    print(f"ERROR: {e}")
+                    if self.restarts >= self.max_restarts:
+                        # Nothing left to restart; the requests to the server now fail and raise to the pipeline
+                        print("The llama-server watchdog stops")
+                        return
+
+    def ensure_running(self, port_or_url):
+        """
+        Restarts the server if it has crashed and waits until it is ready again.
+        Called by the watchdog, and by the LLMClient before it replays a request that failed
+        because the server went away.
+        Returns True when the server is running.
+        """
+        port = self._port(port_or_url)
+        with self._lock:
+            if self._stopping.is_set():
+                return False
+            restart = self._restarting.get(port)
+            owner = restart is None # This thread restarts the server, others wait for it
+            if owner:
+                proc = self.procs.get(port)
+                if proc is not None and proc.poll() is None:
+                    return True
+                if self.restarts >= self.max_restarts:
+                    raise RuntimeError(f"llama-server on port {port} crashed and the restart limit of {self.max_restarts} was reached")
+                self.restarts += 1
+                code = proc.returncode if proc is not None else None
+                print(f"llama-server on port {port} exited with code {code}; restarting ({self.restarts}/{self.max_restarts})")
+                self._launch(port)
+                restart = self._restarting[port] = {"done": threading.Event(), "error": None}
+
+        # The model loads without the lock, so requests to the other servers and the watchdog are not held up
+        if not owner:
+            restart["done"].wait()
+            if restart["error"] is not None:
+                raise RuntimeError(f"llama-server on port {port} could not be restarted: {restart['error']}")
+            return True
+        try:
+            self.wait_until_ready(port)
+            self.warm_up(port)
+            self._restore_slots(port)
+        except Exception as e:
+            restart["error"] = e
+            raise
+        finally:
+            with self._lock:
+                del self._restarting[port]
+            restart["done"].set()
+        return True
+
+    # ----------
+    # Saved slot KV states
+    # ----------
+    def slot_state_file(self, prefix: str):
+        """
+        Returns the file name of the saved KV state of a rendered prompt prefix.
+        It is keyed by the model file and the prefix text, so a new model or an edited template or knowledge base
+        never restores a stale state.
+        """
+        if self._model_fingerprint is None:
+            self._model_fingerprint = ResponseCache.fingerprint_file(self.model_path)
+        prefix_hash = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+        return f"{self._model_fingerprint[:16]}-{prefix_hash[:16]}.bin"
+
+    def has_slot_state(self, filename: str):
+        return self.slot_cache_dir is not None and (self.slot_cache_dir / filename).exists()
+
+    def save_slot(self, port_or_url, slot_id: int, filename: str):
+        """
+        Saves the KV state of a slot to filename in the slot_cache_dir.
+        Returns the number of tokens saved, or None if the server could not save it.
+        """
+        return self._slot_action(port_or_url, slot_id, "save", filename)
+
+    def restore_slot(self, port_or_url, slot_id: int, filename: str):
+        """
+        Loads a saved KV state from the slot_cache_dir into a slot.
+        Returns the number of tokens restored, or None if the server could not restore it.
+        """
+        return self._slot_action(port_or_url, slot_id, "restore", filename)
+
+    def _slot_action(self, port_or_url, slot_id: int, action: str, filename: str):
+        port = self._port(port_or_url)
+        try:
+            response = requests.post(f"{self._url(port)}/slots/{slot_id}?action={action}", json={"filename": filename}, timeout=self.ready_timeout)
+        except requests.RequestException as e:
+            print(f"Could not {action} slot {slot_id} of llama-server on port {port}: {e}")
+            return None
+        if response.status_code != 200:
+            print(f"Could not {action} slot {slot_id} of llama-server on port {port}: {response.status_code} {response.text[:200]}")
+            return None
+        with self._lock:
+            self.slot_files.setdefault(port, {})[slot_id] = filename
+        return response.json().get("n_saved" if action == "save" else "n_restored", 0)
+
+    def _restore_slots(self, port):
+        """
+        Restores the saved states the slots of a restarted server held, so the replayed requests skip the prefix evaluation
+        """
+        for slot_id, filename in list(self.slot_files.get(port, {}).items()):
+            if self.has_slot_state(filename):
+                restored = self.restore_slot(port, slot_id, filename)
+                if restored is not None:
+                    print(f"Restored {restored} cached prompt tokens into slot {slot_id} of llama-server on port {port}")
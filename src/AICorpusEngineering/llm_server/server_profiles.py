@@ -0,0 +1,85 @@
+import json
+from pathlib import Path
+
+# ----------
+# llama-server configuration profiles
+# A profile holds the llama-server settings the ServerManager starts its servers with, other than
+# the model, template, port, context size and slots, which the pipelines set themselves.
+# threads: generation threads, split between the instances (see ServerManager)
+# threads_batch: threads for prompt evaluation, split the same way (default: llama-server uses threads)
+# batch_size, ubatch_size: logical and physical batch sizes of prompt evaluation (-b, -ub)
+# cont_batching: continuous batching of the slots
+# mlock: keep the model in RAM; mmap: map the model file instead of reading it
+# cache_type_k, cache_type_v: KV cache types, e.g. "f16" or "q8_0" (a quantized V cache needs flash_attn)
+# flash_attn: "on", "off" or "auto"
+# n_gpu_layers: layers offloaded to the GPU, 0 on CPU-only hosts
+# Settings left out of a profile keep llama-server's default.
+# ----------
+SERVER_PROFILES = {
+    "default": {"n_gpu_layers": 40}, # How the servers have always been started
+    "cpu": {"n_gpu_layers": 0, "batch_size": 512, "ubatch_size": 512, "cont_batching": True, "mlock": True},
+    "cpu-lowmem": {"n_gpu_layers": 0, "batch_size": 256, "ubatch_size": 256, "cont_batching": True, "cache_type_k": "q8_0"},
+    "gpu": {"n_gpu_layers": 99, "batch_size": 2048, "ubatch_size": 512, "cont_batching": True, "flash_attn": "auto"},
+}
+
+# setting -> llama-server flag
+VALUE_FLAGS = {
+    "batch_size": "--batch-size",
+    "ubatch_size": "--ubatch-size",
+    "cache_type_k": "--cache-type-k",
+    "cache_type_v": "--cache-type-v",
+    "flash_attn": "--flash-attn",
+    "n_gpu_layers": "--n-gpu-layers",
+}
+# setting -> (flag when True, flag when False)
+SWITCH_FLAGS = {
+    "cont_batching": ("--cont-batching", "--no-cont-batching"),
+    "mlock": ("--mlock", None),
+    "mmap": (None, "--no-mmap"),
+}
+THREAD_SETTINGS = ("threads", "threads_batch")
+SETTINGS = tuple(VALUE_FLAGS) + tuple(SWITCH_FLAGS) + THREAD_SETTINGS
+
+
+def validate_profile(settings: dict):
+    """
+    Raises a ValueError for settings a profile does not know
+    """
+    unknown = sorted(set(settings) - set(SETTINGS))
+    if unknown:
+        raise ValueError(f"Unknown server profile settings {unknown}, expected some of {list(SETTINGS)}")
+    return settings
+
+def load_server_profile(name_or_path):
+    """
+    Returns the settings of a built-in profile (see SERVER_PROFILES) or of a profile file
+    written by tune-llama-server (its "settings"). None returns the default profile.
+    """
+    if name_or_path is None:
+        return dict(SERVER_PROFILES["default"])
+    if str(name_or_path) in SERVER_PROFILES:
+        return dict(SERVER_PROFILES[str(name_or_path)])
+    path = Path(name_or_path).expanduser()
+    if not path.exists():
+        raise ValueError(f"No server profile named '{name_or_path}' (built-in: {', '.join(SERVER_PROFILES)}) and no profile file at {path}")
+    with path.open("r", encoding="utf-8") as f:
+        data = json.load(f)
+    return validate_profile(dict(data.get("settings", data)))
+
+def profile_arguments(settings: dict, instances: int = 1):
+    """
+    Returns the llama-server arguments of a profile, without the generation threads (-t),
+    which the ServerManager sets. threads_batch is split between the instances like the threads.
+    """
+    validate_profile(settings)
+    arguments = []
+    for setting, flag in VALUE_FLAGS.items():
+        if settings.get(setting) is not None:
+            arguments += [flag, str(settings[setting])]
+    for setting, (on, off) in SWITCH_FLAGS.items():
+        flag = on if settings.get(setting) else off
+        if setting in settings and settings[setting] is not None and flag is not None:
+            arguments.append(flag)
+    if settings.get("threads_batch"):
+        arguments += ["--threads-batch", str(max(1, settings["threads_batch"] // max(1, instances)))]
+    return arguments
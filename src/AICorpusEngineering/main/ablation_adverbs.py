@@ -1,16 +1,24 @@
 from pathlib import Path
 import argparse
+import math
 import os
+from urllib.parse import urlparse
 import importlib.resources as resources
 from datetime import datetime
 
 from AICorpusEngineering.llm_server.server_manager import ServerManager
-from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.llm_server.broker import PRIORITIES, connect_broker
+from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy, ABLATION_STUDIES
 from AICorpusEngineering.pipelines.ablation_adverbs import AblationPipeline
 from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
 from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
 from AICorpusEngineering.logger.logger import NDJSONLogger
 from AICorpusEngineering.logger.logger_registry import set_logger
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.llm_client.response_cache import ResponseCache
+from AICorpusEngineering.llm_client.backends import LlamaCppBackend
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle, FixedCooldown
 
 
 def repo_root() -> Path:
@@ -82,7 +90,226 @@ def main():
         help="Server URL (default: http://127.0.0.1:8080)",
     )
 
+    # ----------
+    # Prompt cache
+    # ----------
+    parser.add_argument(
+        "--slots",
+        type=int,
+        default=6,
+        help="Number of server slots. Each study is pinned to its own slot so that its long prompt prefix is evaluated once and reused (default: 6, one per study)",
+    )
+
+    parser.add_argument(
+        "--slot_ctx",
+        type=int,
+        default=2048,
+        help="Context window of each slot in tokens (default: 2048)",
+    )
+
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=10,
+        help="Number of sentences run through each study before moving on to the next study (default: 10)",
+    )
+
+    # ----------
+    # Response cache
+    # ----------
+    parser.add_argument(
+        "--response_cache",
+        type=Path,
+        default=None,
+        help="Directory of a persistent cache of LLM responses. Unchanged requests are answered from the cache on reruns (default: no cache)",
+    )
+
+    parser.add_argument(
+        "--response_cache_size",
+        type=int,
+        default=2048,
+        help="Maximum size of the response cache in MB. The least recently used responses are evicted first (default: 2048)",
+    )
+
+    parser.add_argument(
+        "--response_cache_read_only",
+        action="store_true",
+        help="Read responses from the cache but never write to it",
+    )
+
+    # ----------
+    # Logprobs
+    # ----------
+    parser.add_argument(
+        "--logprobs_mode",
+        choices=["full", "two_phase"],
+        default="full",
+        help="full: top 1000 logprobs for every generated token. two_phase: only the sampled token's logprob during generation, then one scoring call for the top logprobs at the final answer (default: full)",
+    )
+
+    parser.add_argument(
+        "--answer_top_k",
+        type=int,
+        default=1000,
+        help="Number of top logprobs requested at the final answer in two_phase mode and in the scoring calls (default: 1000)",
+    )
+
+    parser.add_argument(
+        "--non_cot_mode",
+        choices=["score", "generate"],
+        default="generate",
+        help="generate: the studies without reasoning (kb_zeroshot, zeroshot) generate their answer like the other studies, as in earlier runs. score: they evaluate the prompt once and read the answer from the next-token distribution, which is faster but records no perplexity, so its results are not comparable with generated runs (default: generate)",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream each generation and stop it as soon as the final answer letter has been written",
+    )
+
+    parser.add_argument(
+        "--grammar",
+        action="store_true",
+        help="Constrain each answer to reasoning followed by 'Final answer: [A-E]' with a GBNF grammar",
+    )
+
+    parser.add_argument(
+        "--few_shot_k",
+        type=int,
+        default=None,
+        help="Give the few-shot studies (base_study, fewshot_cot) the k examples of the example pool most similar to each adverb and sentence instead of the template's fixed examples (default: the fixed examples)",
+    )
+
+    parser.add_argument(
+        "--embedding_model",
+        default=None,
+        help="Local sentence-transformers model used with --few_shot_k to add embedding similarity to the lexical overlap (default: lexical overlap only)",
+    )
+
+    parser.add_argument(
+        "--client_render",
+        action="store_true",
+        help="Render the agent template client-side, tokenize its static prefix once and send the prompts to /completion as token ids plus the per-sentence text",
+    )
+
+    parser.add_argument(
+        "--self_consistency",
+        type=int,
+        default=1,
+        help="Sample K reasoning chains per request of the generated studies with CoT from one evaluation of the prompt and answer by majority vote. Each request takes K server slots (default: 1, one greedy chain)",
+    )
+
+    parser.add_argument(
+        "--self_consistency_temperature",
+        type=float,
+        default=0.7,
+        help="Sampling temperature of the chains with --self_consistency (default: 0.7)",
+    )
+
+    # ----------
+    # Server pool
+    # ----------
+    parser.add_argument(
+        "--servers",
+        type=int,
+        default=1,
+        help="Number of llama-server instances, started on consecutive ports from the --server_url port. Requests go to the least busy server (default: 1)",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Total number of CPU threads, split evenly between the servers (default: the server profile's threads, else 6)",
+    )
+
+    parser.add_argument(
+        "--server_profile",
+        default=None,
+        help="llama-server settings: a built-in profile (default, cpu, cpu-lowmem, gpu) or a profile file written by tune-llama-server (default: default)",
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=["server", "llama_cpp"],
+        default="server",
+        help="server: send the requests to llama-server; llama_cpp: load the model in this process with llama-cpp-python, without a server or HTTP (default: server)",
+    )
+
+    parser.add_argument(
+        "--broker",
+        default=None,
+        help="URL of a running inference broker (run-llm-broker), e.g. http://127.0.0.1:8070, to send the requests to instead of starting llama-server (default: start llama-server)",
+    )
+
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITIES),
+        default="normal",
+        help="With --broker, the priority of this run's requests (default: normal)",
+    )
+
+    parser.add_argument(
+        "--server_logs",
+        type=Path,
+        default=None,
+        help="Directory for the rotating llama-server log files (default: server_logs inside output_dir)",
+    )
+
+    parser.add_argument(
+        "--slot_cache",
+        type=Path,
+        default=None,
+        help="Directory where the KV state of each prompt prefix is saved after it is first evaluated and restored in later runs and after server restarts (default: not saved)",
+    )
+
+    # ----------
+    # Throttling
+    # ----------
+    parser.add_argument(
+        "--throttle",
+        choices=["adaptive", "fixed"],
+        default="adaptive",
+        help="adaptive: adjust the requests in flight from the measured latency, tokens/s and temperature, pausing only when the server slows down. fixed: pause for --cooldown seconds after every chunk (default: adaptive)",
+    )
+
+    parser.add_argument(
+        "--cooldown",
+        type=float,
+        default=180,
+        help="Seconds to pause after every chunk with --throttle fixed (default: 180)",
+    )
+
+    parser.add_argument(
+        "--no_dedup",
+        action="store_true",
+        help="Send every occurrence of a repeated (sentence, adverb) to the LLM instead of sending each unique one once",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Maximum number of sentences of a study sent at once. Above 1 the studies are no longer pinned to slots (default: 1)",
+    )
+
+    parser.add_argument(
+        "--latency_drift",
+        type=float,
+        default=1.5,
+        help="Back off when the latency per generated token grows to this many times its best level (default: 1.5)",
+    )
+
+    parser.add_argument(
+        "--max_temperature",
+        type=float,
+        default=None,
+        help="Back off when the hottest /sys/class/thermal zone reaches this temperature in Celsius (default: off)",
+    )
+
     args = parser.parse_args()
+    if args.backend == "llama_cpp" and args.grammar:
+        parser.error("--grammar does not apply to --backend llama_cpp, the in-process backend does not apply grammars")
 
     # ----------
     # Resolve user paths
@@ -110,20 +337,80 @@ def main():
     # ----------
     # Prepare objects for ablation study and start server
     # ----------
-    server = ServerManager(args.server_bin, args.model, chat_template)
+    slots_per_server = math.ceil(max(args.slots, args.concurrency * args.self_consistency) / args.servers) # The studies are pinned across all the servers
+    slots_per_server = max(slots_per_server, args.self_consistency) # The chains of one request run side by side on one server
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=slots_per_server,
+        ctx_size=args.slot_ctx * slots_per_server,
+        instances=args.servers,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=args.server_logs or output_dir / "server_logs",
+        slot_cache_dir=args.slot_cache
+    )
+    server_urls = server.server_urls if args.servers > 1 else args.server_url
     prob_handler = MCQProbHandler()
     knowledge_base = KnowledgeBase()
-    server.start()
+    if args.few_shot_k is not None:
+        knowledge_base.create_example_pool(args.few_shot_k, args.embedding_model)
+    # Start the LLM server, or load the model in this process
+    backend, broker = None, None
+    if args.backend == "llama_cpp":
+        backend = LlamaCppBackend.from_profile(args.model, load_server_profile(args.server_profile), n_ctx=args.slot_ctx, threads=args.threads)
+    elif args.broker is not None:
+        broker = connect_broker(args.broker, chat_template) # The broker's servers are already running
+        server_urls = args.broker
+    else:
+        server.start()
+    managed = server if backend is None and broker is None else None
 
     # ----------
     # Begin the ablation studies
     # ----------
     try:
-        agents = AdverbsAblationStudy(args.server_url, prob_handler, knowledge_base)
-        pipeline = AblationPipeline(agents, logger)
+        response_cache, cache_namespace = None, ""
+        if args.response_cache is not None:
+            response_cache = ResponseCache(args.response_cache, args.response_cache_size * 1024**2, args.response_cache_read_only)
+            cache_namespace = ResponseCache.namespace_for(Path(broker["model"]) if broker is not None else args.model, chat_template)
+        if args.throttle == "fixed":
+            throttle = FixedCooldown(args.cooldown, args.concurrency)
+        else:
+            throttle = AdaptiveThrottle(args.concurrency, latency_drift=args.latency_drift, max_temperature=args.max_temperature)
+        llm_client = LLMClient(
+            server_urls,
+            pool_size=max(4, args.concurrency),
+            slot_affinity=args.concurrency == 1 and broker is None, # With more sentences in flight the server picks the slot whose cached prompt matches best
+            n_slots=slots_per_server,
+            response_cache=response_cache,
+            cache_namespace=cache_namespace,
+            logprobs_mode=args.logprobs_mode,
+            answer_top_k=args.answer_top_k,
+            stream=args.stream,
+            use_grammar=args.grammar,
+            server_manager=managed,
+            throttle=throttle,
+            chat_template=chat_template if args.client_render or backend is not None else None,
+            backend=backend,
+            priority=args.priority if broker is not None else None,
+            client_name=f"{parser.prog}-{os.getpid()}"
+        )
+        studies = [dict(study, scoring=study.get("scoring", False) and args.non_cot_mode == "score") for study in ABLATION_STUDIES]
+        agents = AdverbsAblationStudy(args.server_url, prob_handler, knowledge_base, llm_client, studies, args.self_consistency, args.self_consistency_temperature, chat_template)
+        pipeline = AblationPipeline(agents, logger, chunk_size=args.chunk_size, throttle=throttle, concurrency=args.concurrency, dedup=not args.no_dedup)
         pipeline.run(file_path, output_dir)
+        print(llm_client.cache_report())
+        print(llm_client.timing_report())
+        if response_cache is not None:
+            print(response_cache.report())
     finally:
-        server.stop()
+        if backend is not None:
+            backend.close()
+        if managed is not None:
+            server.stop()
 
 
 if __name__ == "__main__":
@@ -1,16 +1,25 @@
 from pathlib import Path
 import argparse
+import math
 import os
+from urllib.parse import urlparse
 import importlib.resources as resources
 from datetime import datetime
 
 from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.llm_server.broker import PRIORITIES, connect_broker
 from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.agents.adverbs_cascade_agent import CascadeAgent
 from AICorpusEngineering.pipelines.tagging_pipeline import TaggingPipeline
 from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
 from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
 from AICorpusEngineering.logger.logger import NDJSONLogger
 from AICorpusEngineering.logger.logger_registry import set_logger
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.llm_client.response_cache import ResponseCache
+from AICorpusEngineering.llm_client.backends import LlamaCppBackend
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle
 
 
 def repo_root() -> Path:
@@ -90,7 +99,221 @@ def main():
         help="Server URL (default: http://127.0.0.1:8080)",
     )
 
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="Number of requests kept in flight across the adverbs of a file. The server is started with this many parallel slots (default: 1)",
+    )
+
+    parser.add_argument(
+        "--slot_ctx",
+        type=int,
+        default=2048,
+        help="Context window of each slot in tokens; each server gets this many tokens per slot (default: 2048)",
+    )
+
+    # ----------
+    # Response cache
+    # ----------
+    parser.add_argument(
+        "--response_cache",
+        type=Path,
+        default=None,
+        help="Directory of a persistent cache of LLM responses. Unchanged requests are answered from the cache on reruns (default: no cache)",
+    )
+
+    parser.add_argument(
+        "--response_cache_size",
+        type=int,
+        default=2048,
+        help="Maximum size of the response cache in MB. The least recently used responses are evicted first (default: 2048)",
+    )
+
+    parser.add_argument(
+        "--response_cache_read_only",
+        action="store_true",
+        help="Read responses from the cache but never write to it",
+    )
+
+    # ----------
+    # Logprobs
+    # ----------
+    parser.add_argument(
+        "--logprobs_mode",
+        choices=["full", "two_phase"],
+        default="full",
+        help="full: top 1000 logprobs for every generated token. two_phase: only the sampled token's logprob during generation, then one scoring call for the top logprobs at the final answer (default: full)",
+    )
+
+    parser.add_argument(
+        "--answer_top_k",
+        type=int,
+        default=1000,
+        help="Number of top logprobs requested at the final answer in two_phase mode (default: 1000)",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream each generation and stop it as soon as the final answer letter has been written",
+    )
+
+    parser.add_argument(
+        "--grammar",
+        action="store_true",
+        help="Constrain each answer to reasoning followed by 'Final answer: [A-E]' with a GBNF grammar",
+    )
+
+    parser.add_argument(
+        "--few_shot_k",
+        type=int,
+        default=None,
+        help="Give the syntactic-grouper the k examples of the example pool most similar to each adverb and sentence instead of the template's fixed examples (default: the fixed examples)",
+    )
+
+    parser.add_argument(
+        "--embedding_model",
+        default=None,
+        help="Local sentence-transformers model used with --few_shot_k to add embedding similarity to the lexical overlap (default: lexical overlap only)",
+    )
+
+    parser.add_argument(
+        "--client_render",
+        action="store_true",
+        help="Render the agent template client-side, tokenize its static prefix once and send the prompts to /completion as token ids plus the per-sentence text",
+    )
+
+    parser.add_argument(
+        "--self_consistency",
+        type=int,
+        default=1,
+        help="Sample K reasoning chains per adverb from one evaluation of the prompt and answer by majority vote. Each request takes K server slots (default: 1, one greedy chain)",
+    )
+
+    parser.add_argument(
+        "--self_consistency_temperature",
+        type=float,
+        default=0.7,
+        help="Sampling temperature of the chains with --self_consistency (default: 0.7)",
+    )
+
+    # ----------
+    # Server pool
+    # ----------
+    parser.add_argument(
+        "--servers",
+        type=int,
+        default=1,
+        help="Number of llama-server instances, started on consecutive ports from the --server_url port. Requests go to the least busy server (default: 1)",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Total number of CPU threads, split evenly between the servers (default: the server profile's threads, else 6)",
+    )
+
+    parser.add_argument(
+        "--server_profile",
+        default=None,
+        help="llama-server settings: a built-in profile (default, cpu, cpu-lowmem, gpu) or a profile file written by tune-llama-server (default: default)",
+    )
+
+    parser.add_argument(
+        "--backend",
+        choices=["server", "llama_cpp"],
+        default="server",
+        help="server: send the requests to llama-server; llama_cpp: load the model in this process with llama-cpp-python, without a server or HTTP (default: server)",
+    )
+
+    parser.add_argument(
+        "--broker",
+        default=None,
+        help="URL of a running inference broker (run-llm-broker), e.g. http://127.0.0.1:8070, to send the requests to instead of starting llama-server (default: start llama-server)",
+    )
+
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITIES),
+        default="normal",
+        help="With --broker, the priority of this run's requests (default: normal)",
+    )
+
+    parser.add_argument(
+        "--server_logs",
+        type=Path,
+        default=None,
+        help="Directory for the rotating llama-server log files (default: server_logs inside output_dir)",
+    )
+
+    parser.add_argument(
+        "--slot_cache",
+        type=Path,
+        default=None,
+        help="Directory where the KV state of each prompt prefix is saved after it is first evaluated and restored in later runs and after server restarts (default: not saved)",
+    )
+
+    parser.add_argument(
+        "--cascade",
+        action="store_true",
+        help="Score each adverb with the cheap syntactic-zeroshot agent first and only send uncertain adverbs to the syntactic-grouper",
+    )
+
+    parser.add_argument(
+        "--cascade_min_probability",
+        type=float,
+        default=0.8,
+        help="With --cascade, escalate when the most likely answer of the cheap agent has a lower probability (default: 0.8)",
+    )
+
+    parser.add_argument(
+        "--cascade_min_margin",
+        type=float,
+        default=0.5,
+        help="With --cascade, escalate when the most likely answer of the cheap agent leads the second by less than this (default: 0.5)",
+    )
+
+    parser.add_argument(
+        "--no_dedup",
+        action="store_true",
+        help="Send every occurrence of a repeated (sentence, adverb) to the LLM instead of sending each unique one once",
+    )
+
+    parser.add_argument(
+        "--multi_adverb",
+        action="store_true",
+        help="Classify all the adverbs of a sentence in one request instead of one request per adverb",
+    )
+
+    # ----------
+    # Throttling
+    # ----------
+    parser.add_argument(
+        "--throttle",
+        choices=["none", "adaptive"],
+        default="none",
+        help="adaptive: start with one request in flight and raise it towards --concurrency while the measured latency, tokens/s and temperature stay healthy (default: none)",
+    )
+
+    parser.add_argument(
+        "--latency_drift",
+        type=float,
+        default=1.5,
+        help="Back off when the latency per generated token grows to this many times its best level (default: 1.5)",
+    )
+
+    parser.add_argument(
+        "--max_temperature",
+        type=float,
+        default=None,
+        help="Back off when the hottest /sys/class/thermal zone reaches this temperature in Celsius (default: off)",
+    )
+
     args = parser.parse_args()
+    if args.backend == "llama_cpp" and args.grammar:
+        parser.error("--grammar does not apply to --backend llama_cpp, the in-process backend does not apply grammars")
 
     input_dir = args.input_dir.expanduser().resolve() # expanduser deals with ~ and resolve deals with relative paths
     output_dir = args.output_dir.expanduser().resolve()
@@ -110,24 +333,90 @@ def main():
     
 
     # Prepare all the necessary objects
-    server = ServerManager(args.server_bin, args.model, chat_template)
+    # With --cascade each agent_type of the cascade keeps its own slot when one request is in flight
+    slots_per_server = math.ceil(max(args.concurrency * args.self_consistency, 2 if args.cascade else 1) / args.servers) # The requests in flight are shared between the servers
+    slots_per_server = max(slots_per_server, args.self_consistency) # The chains of one request run side by side on one server
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=slots_per_server,
+        ctx_size=args.slot_ctx * slots_per_server,
+        instances=args.servers,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=args.server_logs or output_dir / "server_logs",
+        slot_cache_dir=args.slot_cache
+    )
+    server_urls = server.server_urls if args.servers > 1 else args.server_url
     prob_handler = MCQProbHandler()
     knowledge_base = KnowledgeBase()
+    if args.few_shot_k is not None:
+        knowledge_base.create_example_pool(args.few_shot_k, args.embedding_model)
     data_logs = args.data_logs
     if args.data_logs is None:
         data_logs = output_dir
 
     print(f"In adverbs.py the data_logs are: {data_logs}")
-    # Start the LLM server
-    server.start()
+    # Start the LLM server, or load the model in this process
+    backend, broker = None, None
+    if args.backend == "llama_cpp":
+        backend = LlamaCppBackend.from_profile(args.model, load_server_profile(args.server_profile), n_ctx=args.slot_ctx, threads=args.threads)
+    elif args.broker is not None:
+        broker = connect_broker(args.broker, chat_template) # The broker's servers are already running
+        server_urls = args.broker
+    else:
+        server.start()
+    managed = server if backend is None and broker is None else None
 
     # Try the tagging process
     try:
-        agents = BroadGrouperAgent(args.server_url, prob_handler, knowledge_base)
-        pipeline = TaggingPipeline(agents, logger)
+        # With a single request in flight the grouper is pinned to one slot so its prompt prefix stays cached.
+        # With more, the server is left to pick the slot whose cached prompt matches best.
+        response_cache, cache_namespace = None, ""
+        if args.response_cache is not None:
+            response_cache = ResponseCache(args.response_cache, args.response_cache_size * 1024**2, args.response_cache_read_only)
+            cache_namespace = ResponseCache.namespace_for(Path(broker["model"]) if broker is not None else args.model, chat_template)
+        throttle = None
+        if args.throttle == "adaptive":
+            throttle = AdaptiveThrottle(args.concurrency, latency_drift=args.latency_drift, max_temperature=args.max_temperature)
+        llm_client = LLMClient(
+            server_urls,
+            pool_size=max(4, args.concurrency),
+            slot_affinity=args.concurrency == 1 and broker is None,
+            n_slots=slots_per_server,
+            response_cache=response_cache,
+            cache_namespace=cache_namespace,
+            logprobs_mode=args.logprobs_mode,
+            answer_top_k=args.answer_top_k,
+            stream=args.stream,
+            use_grammar=args.grammar,
+            server_manager=managed,
+            throttle=throttle,
+            chat_template=chat_template if args.client_render or backend is not None else None,
+            backend=backend,
+            priority=args.priority if broker is not None else None,
+            client_name=f"{parser.prog}-{os.getpid()}"
+        )
+        agents = BroadGrouperAgent(args.server_url, prob_handler, knowledge_base, llm_client, args.self_consistency, args.self_consistency_temperature)
+        if args.cascade:
+            agents = CascadeAgent(agents, args.cascade_min_probability, args.cascade_min_margin, chat_template=chat_template)
+        pipeline = TaggingPipeline(agents, logger, concurrency=args.concurrency, throttle=throttle, multi_adverb=args.multi_adverb, dedup=not args.no_dedup)
         pipeline.run(input_dir, output_dir)
+        print(llm_client.cache_report())
+        print(llm_client.timing_report())
+        if args.cascade:
+            print(agents.report())
+        if throttle is not None:
+            print(throttle.report())
+        if response_cache is not None:
+            print(response_cache.report())
     finally:
-        server.stop()
+        if backend is not None:
+            backend.close()
+        if managed is not None:
+            server.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+from pathlib import Path
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import os
+import socket
+import time
+from datetime import datetime
+from urllib.parse import urlparse
+import importlib.resources as resources
+
+from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.pipelines.dispatch import AsyncDispatcher
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.main.load_test import write_synthetic_input
+
+
+def repo_root() -> Path:
+    """Return the repository root."""
+    return Path(__file__).resolve().parents[4]
+
+def get_chat_template_path() -> Path:
+    """Return the installed path to the adverbs.jinja template."""
+    return resources.files("AICorpusEngineering.agent-templates").joinpath("adverbs.jinja")
+
+def on_off(value: str):
+    if value not in ("on", "off"):
+        raise argparse.ArgumentTypeError("expected on or off")
+    return value == "on"
+
+def load_workload(path: Path, limit: int):
+    """
+    Returns the (plain sentence, adverb) jobs of an ndjson file with sentence and adverb, e.g., a gold standard
+    or the input of run-adverbs-ablation. The POS tags of tagged sentences are removed like the pipelines do.
+    """
+    jobs = []
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            words = item["sentence"].split()
+            jobs.append((" ".join(w.rsplit("_", 1)[0] if "_" in w else w for w in words), item["adverb"]))
+    return jobs[:limit]
+
+def grid(args):
+    """
+    Returns every combination of the settings to benchmark, as (server profile settings, parallel slots)
+    """
+    combinations = itertools.product(
+        args.threads, args.threads_batch, args.batch_size, args.ubatch_size, args.cache_type_k,
+        args.mlock, args.mmap, args.cont_batching, args.parallel
+    )
+    points = []
+    for threads, threads_batch, batch_size, ubatch_size, cache_type_k, mlock, mmap, cont_batching, parallel in combinations:
+        if ubatch_size > batch_size:
+            continue # llama-server caps the physical batch at the logical batch, a duplicate of ubatch_size == batch_size
+        settings = {
+            "threads": threads,
+            "batch_size": batch_size,
+            "ubatch_size": ubatch_size,
+            "cache_type_k": cache_type_k,
+            "mlock": mlock,
+            "mmap": mmap,
+            "cont_batching": cont_batching,
+            "n_gpu_layers": args.n_gpu_layers,
+        }
+        if threads_batch:
+            settings["threads_batch"] = threads_batch
+        points.append((settings, parallel))
+    return points
+
+def run_workload(agent, jobs, concurrency):
+    """
+    Classifies every job and returns the number of failed requests
+    """
+    failed = []
+    if concurrency > 1:
+        async def analyze(sentence, adverb):
+            return await agent.analyze_by_syntax_async(sentence, adverb)
+        AsyncDispatcher(concurrency).run(jobs, analyze, lambda job, e: failed.append(e))
+        return len(failed)
+    for sentence, adverb in jobs:
+        try:
+            agent.analyze_by_syntax(sentence, adverb)
+        except Exception as e:
+            failed.append(e)
+    return len(failed)
+
+def benchmark(args, chat_template, settings, parallel, jobs, log_dir):
+    """
+    Starts a server with the settings, classifies the workload with parallel requests in flight and
+    returns the measurements. The first job warms up the prompt cache and is not timed.
+    """
+    result = {"parallel": parallel, **settings, "load_seconds": None, "requests_per_second": 0.0, "generated_tokens_per_second": 0.0, "mean_seconds_per_request": None, "failed": 0, "error": None}
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=parallel,
+        ctx_size=args.slot_ctx * parallel,
+        threads=settings["threads"],
+        log_dir=log_dir,
+        ready_timeout=args.ready_timeout,
+        profile={k: v for k, v in settings.items() if k != "threads"}
+    )
+    started = time.perf_counter()
+    try:
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            server.start()
+            result["load_seconds"] = time.perf_counter() - started
+            knowledge_base = KnowledgeBase()
+            for warm_up in (True, False):
+                # A new client for the timed run, so the warm-up request is not counted
+                llm_client = LLMClient(args.server_url, pool_size=max(4, parallel), slot_affinity=parallel == 1, n_slots=parallel)
+                agent = BroadGrouperAgent(args.server_url, MCQProbHandler(), knowledge_base, llm_client)
+                run_started = time.perf_counter()
+                failed = run_workload(agent, jobs[:1] if warm_up else jobs[1:], 1 if warm_up else parallel)
+                wall = time.perf_counter() - run_started
+                llm_client.close()
+            result["failed"] = failed
+        timing = llm_client.timing_stats().get("all", {"requests": 0, "predicted_n": 0, "mean_seconds": None})
+        result["requests_per_second"] = timing["requests"] / wall if wall else 0.0
+        result["generated_tokens_per_second"] = timing["predicted_n"] / wall if wall else 0.0
+        result["mean_seconds_per_request"] = timing["mean_seconds"]
+    except Exception as e:
+        # A setting the host or the llama-server build does not support must not stop the tuning
+        result["error"] = str(e)
+    finally:
+        with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+            server.stop()
+    return result
+
+def describe(result):
+    settings = ", ".join(f"{k}={result[k]}" for k in ("parallel", "threads", "threads_batch", "batch_size", "ubatch_size", "cache_type_k", "mlock", "mmap", "cont_batching") if k in result)
+    if result["error"]:
+        return f"{settings}: failed ({result['error']})"
+    return f"{settings}: {result['requests_per_second']:.2f} requests/s, {result['generated_tokens_per_second']:.1f} tokens/s, {result['failed']} failed"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark a grid of llama-server settings with the syntactic-grouper template on this machine and save the fastest as a server profile"
+    )
+    parser.add_argument("output_dir", type=Path, help="Directory of the profile file and of the results of every setting")
+    parser.add_argument("--input", type=Path, default=None, help="ndjson file with sentence and adverb to classify, e.g. a gold standard (default: synthetic sentences)")
+    parser.add_argument("--sentences", type=int, default=20, help="Number of sentences classified per setting (default: 20)")
+    parser.add_argument(
+        "--server_bin",
+        type=Path,
+        default=Path(os.environ.get("LLM_SERVER_BIN", repo_root() / "llama.cpp/build/bin/llama-server")),
+        help="Path to the llama-server binary (env: LLM_SERVER_BIN)",
+    )
+    parser.add_argument(
+        "--model",
+        type=Path,
+        default=Path(os.environ.get("LLM_MODEL", repo_root() / "Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf")),
+        help="Path to the large language model (env: LLM_MODEL)",
+    )
+    parser.add_argument("--server_url", default="http://127.0.0.1:8080", help="Server URL (default: http://127.0.0.1:8080)")
+    parser.add_argument("--slot_ctx", type=int, default=2048, help="Context window of each slot (default: 2048)")
+    parser.add_argument("--ready_timeout", type=int, default=600, help="Seconds to wait for each server to load the model (default: 600)")
+    cpus = os.cpu_count() or 6
+    parser.add_argument("--threads", type=int, nargs="+", default=sorted({max(1, cpus // 2), cpus}), help=f"Thread counts to try (default: half and all of the {cpus} CPUs)")
+    parser.add_argument("--threads_batch", type=int, nargs="+", default=[0], help="Prompt evaluation thread counts to try, 0 for the same as the threads (default: 0)")
+    parser.add_argument("--batch_size", type=int, nargs="+", default=[512, 2048], help="Logical batch sizes to try (default: 512 2048)")
+    parser.add_argument("--ubatch_size", type=int, nargs="+", default=[512], help="Physical batch sizes to try (default: 512)")
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 4], help="Parallel slots to try, each with as many requests in flight (default: 1 4)")
+    parser.add_argument("--cache_type_k", nargs="+", default=["f16"], help="K cache types to try, e.g. f16 q8_0 (default: f16)")
+    parser.add_argument("--mlock", type=on_off, nargs="+", default=[False], help="on and/or off (default: off)")
+    parser.add_argument("--mmap", type=on_off, nargs="+", default=[True], help="on and/or off (default: on)")
+    parser.add_argument("--cont_batching", type=on_off, nargs="+", default=[True], help="on and/or off (default: on)")
+    parser.add_argument("--n_gpu_layers", type=int, default=0, help="Layers offloaded to the GPU in every setting (default: 0, CPU only)")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir.expanduser().resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if args.input is not None:
+        jobs = load_workload(args.input.expanduser().resolve(), args.sentences + 1)
+    else:
+        jobs = load_workload(write_synthetic_input("ablation", args.sentences + 1, output_dir / "input"), args.sentences + 1)
+    if len(jobs) < 2:
+        raise ValueError("The workload needs at least two sentences, the first one only warms up the server")
+
+    chat_template = get_chat_template_path()
+    points = grid(args)
+    host = socket.gethostname()
+    print(f"Tuning llama-server on {host} for {Path(args.model).name}: {len(points)} settings, {len(jobs) - 1} sentences each")
+    results = []
+    for n, (settings, parallel) in enumerate(points, start=1):
+        result = benchmark(args, chat_template, settings, parallel, jobs, output_dir / "server_logs")
+        results.append(result)
+        print(f"  [{n}/{len(points)}] {describe(result)}")
+
+    with (output_dir / "autotune_results.csv").open("w", encoding="utf-8", newline="") as f:
+        fieldnames = list(dict.fromkeys(k for result in results for k in result))
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
+
+    successful = [result for result in results if not result["error"] and not result["failed"]]
+    if not successful:
+        print("No setting completed the workload, see the server logs")
+        return
+    best = max(successful, key=lambda result: result["requests_per_second"])
+    settings = {k: best[k] for k in ("threads", "threads_batch", "batch_size", "ubatch_size", "cache_type_k", "mlock", "mmap", "cont_batching", "n_gpu_layers") if k in best}
+    profile = {
+        "host": host,
+        "model": Path(args.model).name,
+        "tuned_at": datetime.now().isoformat(),
+        "settings": settings,
+        "concurrency": best["parallel"], # The requests in flight the settings were measured with
+        "requests_per_second": best["requests_per_second"],
+        "generated_tokens_per_second": best["generated_tokens_per_second"],
+    }
+    profile_path = output_dir / f"{host}-{Path(args.model).stem}.json"
+    profile_path.write_text(json.dumps(profile, indent=2), encoding="utf-8")
+    print(f"\nFastest: {describe(best)}")
+    print(f"Profile written to {profile_path}; use it with --server_profile {profile_path} --concurrency {best['parallel']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+from pathlib import Path
+import argparse
+import os
+from urllib.parse import urlparse
+import importlib.resources as resources
+
+from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.llm_server.broker import InferenceBroker, combine_templates
+
+
+# The templates of run-adverbs, run-adverbs-ablation (and run-model-sweep) and run-multiword-adverbs
+DEFAULT_TEMPLATES = ("adverbs.jinja", "ablation_adverbs_examples_kb.jinja", "mw_adverb_analyst.jinja")
+
+def repo_root() -> Path:
+    """Return the repository root."""
+    return Path(__file__).resolve().parents[4]
+
+def get_template_path(name: str) -> Path:
+    """Return the installed path to an agent template, or the path itself when it is not an installed template."""
+    installed = resources.files("AICorpusEngineering.agent-templates").joinpath(name)
+    return Path(str(installed)) if installed.is_file() else Path(name).expanduser().resolve()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a local inference broker that owns the llama-server instances and schedules the requests of every pipeline on this machine by priority"
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host the broker listens on (default: 127.0.0.1, this machine only)")
+    parser.add_argument("--port", type=int, default=8070, help="Port the broker listens on, the --broker of the pipelines (default: 8070)")
+    parser.add_argument(
+        "--templates",
+        nargs="+",
+        default=list(DEFAULT_TEMPLATES),
+        help=f"Agent templates the servers render, installed template names or paths; their agent_types must differ (default: {' '.join(DEFAULT_TEMPLATES)})",
+    )
+    parser.add_argument(
+        "--server_bin",
+        type=Path,
+        default=Path(os.environ.get("LLM_SERVER_BIN", repo_root() / "llama.cpp/build/bin/llama-server")),
+        help="Path to the llama-server binary (env: LLM_SERVER_BIN)",
+    )
+    parser.add_argument(
+        "--model",
+        type=Path,
+        default=Path(os.environ.get("LLM_MODEL", repo_root() / "Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf")),
+        help="Path to the large language model (env: LLM_MODEL)",
+    )
+    parser.add_argument("--server_url", default="http://127.0.0.1:8080", help="URL of the first llama-server the broker starts (default: http://127.0.0.1:8080)")
+    parser.add_argument("--servers", type=int, default=1, help="Number of llama-server instances, see run-adverbs (default: 1)")
+    parser.add_argument("--slots", type=int, default=4, help="Parallel slots of each server, the requests in flight across all the pipelines (default: 4)")
+    parser.add_argument("--slot_ctx", type=int, default=4096, help="Context window of each slot (default: 4096)")
+    parser.add_argument("--threads", type=int, default=None, help="Total number of CPU threads, split evenly between the servers (default: the server profile's threads, else 6)")
+    parser.add_argument("--server_profile", default=None, help="See run-adverbs (default: default)")
+    parser.add_argument("--server_logs", type=Path, default=None, help="Directory for the rotating llama-server log files (default: server output is discarded)")
+    parser.add_argument("--state_dir", type=Path, default=Path("~/.cache/aicorpusengineering/broker"), help="Directory of the combined template (default: ~/.cache/aicorpusengineering/broker)")
+    args = parser.parse_args()
+
+    templates = [get_template_path(name) for name in args.templates]
+    for template in templates:
+        if not template.exists():
+            raise FileNotFoundError(f"Chat template not found at {template}")
+    chat_template = args.state_dir.expanduser().resolve() / "broker.jinja"
+    served = combine_templates(templates, chat_template)
+    for name, agent_types in served.items():
+        print(f"Serving {name}: {', '.join(agent_types)}")
+
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=args.slots,
+        ctx_size=args.slot_ctx * args.slots,
+        instances=args.servers,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=args.server_logs
+    )
+    broker = InferenceBroker(server, served, host=args.host, port=args.port)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
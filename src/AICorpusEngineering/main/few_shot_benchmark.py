@@ -0,0 +1,195 @@
+from pathlib import Path
+import argparse
+import contextlib
+import json
+import os
+import time
+from urllib.parse import urlparse
+import importlib.resources as resources
+
+from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.pipelines.dispatch import AsyncDispatcher
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+
+
+def repo_root() -> Path:
+    """Return the repository root."""
+    return Path(__file__).resolve().parents[4]
+
+def get_chat_template_path() -> Path:
+    """Return the installed path to the adverbs.jinja template."""
+    return resources.files("AICorpusEngineering.agent-templates").joinpath("adverbs.jinja")
+
+def normalize_label(label):
+    """
+    Gold labels are e.g. "STANCE", the knowledge base mappings may be "STANCE ADVERBS"
+    """
+    return str(label).upper().replace(" ADVERBS", "").strip()
+
+def load_gold(path: Path, limit=None):
+    """
+    Returns the gold standard sentences tagged with manual-tagger that have a main_tag,
+    and the number of lines skipped because they have none
+    """
+    gold, skipped = [], 0
+    with path.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get("main_tag"):
+                skipped += 1
+                continue
+            gold.append(item)
+    return (gold[:limit] if limit else gold), skipped
+
+def run_setting(agent, gold, concurrency):
+    """
+    Classifies every gold sentence with the agent and returns one record (or None if the request failed) per sentence
+    """
+    jobs = [(item["sentence"], item["adverb"]) for item in gold]
+    if concurrency > 1:
+        async def analyze(sentence, adverb):
+            return await agent.analyze_by_syntax_async(sentence, adverb)
+        return AsyncDispatcher(concurrency).run(jobs, analyze, lambda job, e: None)
+    records = []
+    for sentence, adverb in jobs:
+        try:
+            records.append(agent.analyze_by_syntax(sentence, adverb))
+        except Exception as e:
+            print(f"Request failed for '{adverb}': {e}")
+            records.append(None)
+    return records
+
+def summarize(setting, gold, records, llm_client, wall):
+    """
+    Returns the accuracy and the prompt size per request of one setting
+    """
+    answered = [(item, record) for item, record in zip(gold, records) if record]
+    correct = sum(1 for item, record in answered if normalize_label(record["category"]) == normalize_label(item["main_tag"]))
+    cache = llm_client.cache_stats.get("syntactic-grouper", {"hits": 0, "misses": 0, "cached_tokens": 0, "evaluated_tokens": 0})
+    timing = llm_client.timing_stats().get("all", {"requests": 0, "mean_seconds": 0.0})
+    requests = cache["hits"] + cache["misses"]
+    return {
+        "setting": setting,
+        "sentences": len(gold),
+        "answered": len(answered),
+        "accuracy": correct / len(gold) if gold else 0.0,
+        "prompt_tokens_per_request": (cache["cached_tokens"] + cache["evaluated_tokens"]) / requests if requests else 0.0,
+        "evaluated_tokens_per_request": cache["evaluated_tokens"] / requests if requests else 0.0,
+        "mean_seconds_per_request": timing["mean_seconds"],
+        "wall_seconds": wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the dynamic few-shot examples of the syntactic-grouper on a gold standard: accuracy and prompt tokens per request for each k"
+    )
+    parser.add_argument("gold_file", type=Path, help="Gold standard sentences tagged with manual-tagger (ndjson with sentence, adverb and main_tag)")
+    parser.add_argument("output_dir", type=Path, help="Directory where the predictions and the results are saved")
+    parser.add_argument("--k", type=int, nargs="+", default=[0, 1, 2, 3, 5], help="Numbers of retrieved examples to benchmark (default: 0 1 2 3 5)")
+    parser.add_argument("--no_fixed", action="store_true", help="Do not benchmark the template's fixed examples as the baseline")
+    parser.add_argument("--embedding_model", default=None, help="Local sentence-transformers model to add embedding similarity to the lexical overlap (default: lexical overlap only)")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N gold sentences")
+    parser.add_argument("--verbose", action="store_true", help="Show the agent's output")
+    parser.add_argument(
+        "--server_bin",
+        type=Path,
+        default=Path(os.environ.get("LLM_SERVER_BIN", repo_root() / "llama.cpp/build/bin/llama-server")),
+        help="Path to the llama-server binary (env: LLM_SERVER_BIN)",
+    )
+    parser.add_argument(
+        "--model",
+        type=Path,
+        default=Path(os.environ.get("LLM_MODEL", repo_root() / "Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf")),
+        help="Path to the large language model (env: LLM_MODEL)",
+    )
+    parser.add_argument("--server_url", default="http://127.0.0.1:8080", help="Server URL (default: http://127.0.0.1:8080)")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads of the server (default: the server profile's threads, else 6)")
+    parser.add_argument("--server_profile", default=None, help="See run-adverbs (default: default)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests kept in flight (default: 1)")
+    parser.add_argument("--slot_ctx", type=int, default=4096, help="Context window of each slot in tokens; the fixed examples baseline needs room for every example (default: 4096)")
+    parser.add_argument("--client_render", action="store_true", help="See run-adverbs")
+    args = parser.parse_args()
+
+    gold_path = args.gold_file.expanduser().resolve()
+    if not gold_path.exists():
+        raise FileNotFoundError(f"Gold standard not found: {gold_path}")
+    output_dir = args.output_dir.expanduser().resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    gold, skipped = load_gold(gold_path, args.limit)
+    print(f"Benchmarking on {len(gold)} gold sentences ({skipped} without a main_tag skipped)")
+
+    chat_template = get_chat_template_path()
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=args.concurrency,
+        ctx_size=args.slot_ctx * args.concurrency,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=output_dir / "server_logs"
+    )
+    settings = ([] if args.no_fixed else [None]) + sorted(set(args.k))
+    results = []
+    server.start()
+    try:
+        # The example pool (and the embedding model) is loaded once and shared by all the settings
+        pool_knowledge_base = KnowledgeBase()
+        if any(k is not None for k in settings):
+            pool_knowledge_base.create_example_pool(max(k for k in settings if k is not None), args.embedding_model)
+        for k in settings:
+            setting = "fixed" if k is None else f"k={k}"
+            if k is None:
+                knowledge_base = KnowledgeBase()
+            else:
+                knowledge_base = pool_knowledge_base
+                knowledge_base.few_shot_k = k
+            # A new client per setting so the prompt sizes and timings of each setting are counted on their own
+            llm_client = LLMClient(
+                args.server_url,
+                pool_size=max(4, args.concurrency),
+                slot_affinity=args.concurrency == 1,
+                n_slots=args.concurrency,
+                server_manager=server,
+                chat_template=chat_template if args.client_render else None
+            )
+            agent = BroadGrouperAgent(args.server_url, MCQProbHandler(), knowledge_base, llm_client)
+            print(f"Running {setting}")
+            quiet = open(os.devnull, "w") if not args.verbose else None
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(quiet) if quiet is not None else contextlib.nullcontext():
+                records = run_setting(agent, gold, args.concurrency)
+            wall = time.perf_counter() - started
+            if quiet is not None:
+                quiet.close()
+            llm_client.close()
+
+            with (output_dir / f"few_shot_benchmark_{setting.replace('=', '')}.ndjson").open("w", encoding="utf-8") as f:
+                for item, record in zip(gold, records):
+                    f.write(json.dumps({"gold": item, "result": record}, ensure_ascii=False) + "\n")
+            results.append(summarize(setting, gold, records, llm_client, wall))
+    finally:
+        server.stop()
+
+    print("\nFew-shot benchmark:")
+    for result in results:
+        print(
+            f"  {result['setting']:>6}: accuracy {result['accuracy']:.1%} ({result['answered']} of {result['sentences']} answered), "
+            f"{result['prompt_tokens_per_request']:.0f} prompt tokens per request ({result['evaluated_tokens_per_request']:.0f} evaluated), "
+            f"{result['mean_seconds_per_request'] * 1000:.0f} ms per request"
+        )
+    with (output_dir / "few_shot_benchmark.json").open("w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output_dir / 'few_shot_benchmark.json'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+from pathlib import Path
+from importlib import resources
+import argparse
+import contextlib
+import json
+import os
+import random
+import tempfile
+import time
+
+from AICorpusEngineering.llm_server.mock_server import MockLlamaServer
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.agents.adverbs_cascade_agent import CascadeAgent
+from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy, ABLATION_STUDIES
+from AICorpusEngineering.agents.multiword_adverbs_tagger import MWAdverbs
+from AICorpusEngineering.pipelines.tagging_pipeline import TaggingPipeline
+from AICorpusEngineering.pipelines.ablation_adverbs import AblationPipeline
+from AICorpusEngineering.pipelines.mw_adverb_pipeline import MWAdverbsPipeline
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.logger.logger import NDJSONLogger
+from AICorpusEngineering.logger.logger_registry import set_logger
+
+# ----------
+# Vocabulary of the synthetic POS tagged sentences
+# ----------
+SUBJECTS = ["The_DET committee_NOUN", "She_PRON", "The_DET students_NOUN", "We_PRON", "The_DET old_ADJ house_NOUN"]
+VERBS = ["decided_VERB", "finished_VERB", "changed_VERB", "answered_VERB", "needed_VERB"]
+OBJECTS = ["the_DET report_NOUN", "more_ADJ time_NOUN", "the_DET plan_NOUN", "the_DET question_NOUN", "a_DET break_NOUN"]
+ADVERBS = ["quickly", "however", "only", "frankly", "well", "also", "therefore", "probably", "yesterday", "especially"]
+# The agent template each pipeline's server is started with
+CHAT_TEMPLATES = {"tagging": "adverbs.jinja", "ablation": "ablation_adverbs_examples_kb.jinja", "mw": "mw_adverb_analyst.jinja"}
+
+
+class StageTimer:
+    """
+    Times the parsing stages of the agents by wrapping their methods on the instance
+    """
+    def __init__(self):
+        self.stages = {} # stage name -> list of seconds
+
+    def wrap(self, obj, method_name, stage=None):
+        method = getattr(obj, method_name)
+        seconds = self.stages.setdefault(stage or method_name, [])
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                seconds.append(time.perf_counter() - started)
+
+        setattr(obj, method_name, timed)
+
+
+def tagged_sentence(rng):
+    adverb = rng.choice(ADVERBS)
+    words = [rng.choice(SUBJECTS), f"{adverb}_ADV", rng.choice(VERBS), rng.choice(OBJECTS)]
+    if rng.random() < 0.3:
+        words.append(f"{rng.choice(ADVERBS)}_ADV")
+    return " ".join(words) + " ._PUNCT", adverb
+
+def write_synthetic_input(pipeline, n_sentences, input_dir: Path, seed=0, duplicates=0.0):
+    """
+    Writes n_sentences synthetic sentences in the input format of the pipeline and
+    returns the path to pass to the pipeline.
+    duplicates: share of the sentences that repeat an earlier sentence, like headers and boilerplate in a corpus
+    """
+    rng = random.Random(seed)
+    input_dir.mkdir(parents=True, exist_ok=True)
+    written = []
+
+    def next_sentence():
+        if written and rng.random() < duplicates:
+            return rng.choice(written)
+        written.append(tagged_sentence(rng))
+        return written[-1]
+
+    if pipeline == "ablation":
+        file_path = input_dir / "load_test_tagged.ndjson"
+        with file_path.open("w", encoding="utf-8") as f:
+            for i in range(n_sentences):
+                sentence, adverb = next_sentence()
+                f.write(json.dumps({"id": i, "sentence": sentence, "adverb": adverb}) + "\n")
+        return file_path
+    with (input_dir / "load_test.txt").open("w", encoding="utf-8") as f:
+        for _ in range(n_sentences):
+            sentence, _ = next_sentence()
+            f.write(sentence + "\n")
+    return input_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test a pipeline end to end against the mock llama-server (or a running server).")
+    parser.add_argument("--pipeline", choices=["tagging", "ablation", "mw"], default="tagging", help="Pipeline to run (default: tagging)")
+    parser.add_argument("--sentences", type=int, default=50, help="Number of synthetic sentences (default: 50)")
+    parser.add_argument("--duplicates", type=float, default=0.0, help="Share of the synthetic sentences that repeat an earlier one (default: 0)")
+    parser.add_argument(
+        "--input",
+        type=Path,
+        default=None,
+        help="Run on real input instead of synthetic sentences: a directory of .txt files (tagging, mw) or a tagged .ndjson file (ablation)",
+    )
+    parser.add_argument("--output_dir", type=Path, default=None, help="Directory for the pipeline's logs (default: a temporary directory)")
+    parser.add_argument("--json", type=Path, default=None, help="Also write the measurements to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="Show the pipeline's own output")
+
+    # ----------
+    # Server
+    # ----------
+    parser.add_argument("--server_url", default=None, help="Send the requests to an already running llama-server instead of starting the mock")
+    parser.add_argument("--parallel", type=int, default=4, help="Number of slots of the mock server (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Fixed seconds the mock adds to every request (default: 0.02)")
+    parser.add_argument("--tokens_per_second", type=float, default=25.0, help="Generation speed of each mock slot (default: 25)")
+    parser.add_argument("--prompt_tokens_per_second", type=float, default=400.0, help="Prompt evaluation speed of the mock (default: 400)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic sentences and the mock's answers (default: 0)")
+
+    # ----------
+    # Client
+    # ----------
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight in the tagging and ablation pipelines (default: 1)")
+    parser.add_argument("--throttle", choices=["none", "adaptive"], default="none", help="Let an AdaptiveThrottle set the requests in flight, up to --concurrency (default: none)")
+    parser.add_argument("--logprobs_mode", choices=["full", "two_phase"], default="full", help="See run-adverbs (default: full)")
+    parser.add_argument("--answer_top_k", type=int, default=1000, help="See run-adverbs (default: 1000)")
+    parser.add_argument("--stream", action="store_true", help="See run-adverbs")
+    parser.add_argument("--grammar", action="store_true", help="See run-adverbs")
+    parser.add_argument("--non_cot_mode", choices=["score", "generate"], default="generate", help="See run-adverbs-ablation (default: generate)")
+    parser.add_argument("--cascade", action="store_true", help="See run-adverbs (tagging pipeline only)")
+    parser.add_argument("--cascade_min_probability", type=float, default=0.8, help="See run-adverbs (default: 0.8)")
+    parser.add_argument("--cascade_min_margin", type=float, default=0.5, help="See run-adverbs (default: 0.5)")
+    parser.add_argument("--multi_adverb", action="store_true", help="See run-adverbs (tagging pipeline only)")
+    parser.add_argument("--no_dedup", action="store_true", help="See run-adverbs (tagging and ablation pipelines)")
+    parser.add_argument("--few_shot_k", type=int, default=None, help="See run-adverbs (tagging and ablation pipelines)")
+    parser.add_argument("--embedding_model", default=None, help="See run-adverbs")
+    parser.add_argument("--client_render", action="store_true", help="See run-adverbs")
+    parser.add_argument("--self_consistency", type=int, default=1, help="See run-adverbs (tagging and ablation pipelines, default: 1)")
+    parser.add_argument("--self_consistency_temperature", type=float, default=0.7, help="See run-adverbs (default: 0.7)")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.output_dir is None:
+            output_dir = Path(stack.enter_context(tempfile.TemporaryDirectory(prefix="llm-load-test-")))
+        else:
+            output_dir = args.output_dir.expanduser().resolve()
+            output_dir.mkdir(parents=True, exist_ok=True)
+        if args.input is None:
+            pipeline_input = write_synthetic_input(args.pipeline, args.sentences, output_dir / "input", args.seed, args.duplicates)
+        else:
+            pipeline_input = args.input.expanduser().resolve()
+
+        # ----------
+        # Start the mock server
+        # ----------
+        chat_template = resources.files("AICorpusEngineering.agent-templates").joinpath(CHAT_TEMPLATES[args.pipeline])
+        mock = None
+        server_url = args.server_url
+        if server_url is None:
+            mock = MockLlamaServer(
+                port=0,
+                latency=args.latency,
+                tokens_per_second=args.tokens_per_second,
+                prompt_tokens_per_second=args.prompt_tokens_per_second,
+                parallel=args.parallel,
+                seed=args.seed,
+                chat_template=chat_template
+            ).start()
+            stack.callback(mock.stop)
+            server_url = mock.url
+            print(f"Started the mock llama-server on {server_url} with {args.parallel} slots")
+
+        throttle = AdaptiveThrottle(args.concurrency) if args.throttle == "adaptive" else None
+        llm_client = LLMClient(
+            server_url,
+            pool_size=max(4, args.concurrency),
+            slot_affinity=args.pipeline != "mw" and args.concurrency == 1,
+            n_slots=args.parallel,
+            logprobs_mode=args.logprobs_mode,
+            answer_top_k=args.answer_top_k,
+            stream=args.stream,
+            use_grammar=args.grammar,
+            throttle=throttle,
+            chat_template=chat_template if args.client_render else None
+        )
+        stack.callback(llm_client.close)
+        logger = NDJSONLogger(None, None, output_dir / "logs")
+        set_logger(logger)
+
+        # ----------
+        # Build the pipeline and time the parsing stages
+        # ----------
+        timer = StageTimer()
+        quiet = open(os.devnull, "w") if not args.verbose else None
+        if quiet is not None:
+            stack.callback(quiet.close)
+        knowledge_base = KnowledgeBase()
+        if args.few_shot_k is not None:
+            knowledge_base.create_example_pool(args.few_shot_k, args.embedding_model)
+        with contextlib.redirect_stdout(quiet) if quiet is not None else contextlib.nullcontext():
+            if args.pipeline == "tagging":
+                agents = BroadGrouperAgent(server_url, MCQProbHandler(), knowledge_base, llm_client, args.self_consistency, args.self_consistency_temperature)
+                timer.wrap(agents, "parse_sentence_by_syntax" if args.multi_adverb else "parse_by_syntax")
+                if args.cascade:
+                    agents = CascadeAgent(agents, args.cascade_min_probability, args.cascade_min_margin, chat_template=chat_template)
+                    timer.wrap(agents, "parse_cheap")
+                pipeline = TaggingPipeline(agents, logger, concurrency=args.concurrency, throttle=throttle, multi_adverb=args.multi_adverb, dedup=not args.no_dedup)
+                run = lambda: pipeline.run(pipeline_input, output_dir)
+            elif args.pipeline == "ablation":
+                studies = [dict(study, scoring=study.get("scoring", False) and args.non_cot_mode == "score") for study in ABLATION_STUDIES]
+                agents = AdverbsAblationStudy(server_url, MCQProbHandler(), knowledge_base, llm_client, studies, args.self_consistency, args.self_consistency_temperature, chat_template)
+                timer.wrap(agents, "parse_study")
+                # One chunk, so the pipeline never cools down between chunks
+                pipeline = AblationPipeline(agents, logger, chunk_size=max(1, args.sentences if args.input is None else 10**9), throttle=throttle, concurrency=args.concurrency, dedup=not args.no_dedup)
+                run = lambda: pipeline.run(pipeline_input, output_dir)
+            else:
+                agent = MWAdverbs(server_url, llm_client)
+                timer.wrap(llm_client, "get_content_and_logprobs", "get_mw_adverbs content")
+                pipeline = MWAdverbsPipeline(agent)
+                run = lambda: pipeline.run(pipeline_input)
+
+            started = time.perf_counter()
+            run()
+            wall = time.perf_counter() - started
+
+        # ----------
+        # Report
+        # ----------
+        timing = llm_client.timing_stats()
+        overall = timing.get("all", {"requests": 0, "predicted_n": 0, "mean_seconds": 0.0})
+        requests = overall["requests"]
+        sequential = args.pipeline == "mw" or args.concurrency == 1
+        parse = {
+            stage: {"calls": len(seconds), "mean_seconds": sum(seconds) / len(seconds) if seconds else 0.0, "total_seconds": sum(seconds)}
+            for stage, seconds in timer.stages.items()
+        }
+        results = {
+            "pipeline": args.pipeline,
+            "server": "mock" if mock is not None else server_url,
+            "concurrency": args.concurrency,
+            "logprobs_mode": args.logprobs_mode,
+            "stream": args.stream,
+            "multi_adverb": args.multi_adverb,
+            "dedup": not args.no_dedup,
+            "few_shot_k": args.few_shot_k,
+            "client_render": args.client_render,
+            "self_consistency": args.self_consistency,
+            "wall_seconds": wall,
+            "requests": requests,
+            "requests_per_second": requests / wall if wall else 0.0,
+            "generated_tokens_per_second": overall["predicted_n"] / wall if wall else 0.0,
+            "timing": timing,
+            "parse": parse,
+        }
+        if sequential:
+            # Everything the pipeline did outside the requests and the parsing, e.g., logging and file IO
+            busy = overall["mean_seconds"] * requests + sum(stage["total_seconds"] for stage in parse.values())
+            results["other_pipeline_seconds"] = max(0.0, wall - busy)
+
+        print(f"\nLoad test of the {args.pipeline} pipeline against {results['server']}")
+        print(f"End to end: {requests} requests in {wall:.2f} s, {results['requests_per_second']:.2f} requests/s, {results['generated_tokens_per_second']:.1f} generated tokens/s")
+        if getattr(pipeline, "manifest", None) is not None:
+            results["unique_jobs"] = len(pipeline.manifest)
+            results["dedup_ratio"] = pipeline.manifest.dedup_ratio
+            print(pipeline.manifest.report())
+        print(llm_client.timing_report())
+        print("Parsing:")
+        for stage, stats in parse.items():
+            print(f"  {stage}: {stats['calls']} calls, mean {stats['mean_seconds'] * 1000:.2f} ms, total {stats['total_seconds']:.3f} s")
+        if args.pipeline == "tagging" and args.cascade:
+            results["cascade"] = dict(pipeline.grouper_agents.stats)
+            print(pipeline.grouper_agents.report())
+        if throttle is not None:
+            results["throttle"] = throttle.report()
+            print(throttle.report())
+        if "other_pipeline_seconds" in results:
+            print(f"Other pipeline work (logging, file IO): {results['other_pipeline_seconds']:.3f} s")
+        if args.json is not None:
+            with args.json.open("w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+            print(f"Measurements written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+from pathlib import Path
+import argparse
+import csv
+import json
+import os
+import time
+from urllib.parse import urlparse
+import importlib.resources as resources
+
+from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy, ABLATION_STUDIES
+from AICorpusEngineering.pipelines.ablation_adverbs import AblationPipeline
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.logger.logger import NDJSONLogger
+from AICorpusEngineering.logger.logger_registry import set_logger
+from AICorpusEngineering.error_handler.error_handler import error_handler
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+
+
+def repo_root() -> Path:
+    """Return the repository root."""
+    return Path(__file__).resolve().parents[4]
+
+def get_chat_template_path() -> Path:
+    """Return the installed path to the ablation template."""
+    return resources.files("AICorpusEngineering.agent-templates").joinpath("ablation_adverbs_examples_kb.jinja")
+
+def load_ndjson(path: Path):
+    with path.open("r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def normalize_label(label):
+    """
+    Gold labels are e.g. "STANCE", the study categories "STANCE ADVERBS"
+    """
+    return str(label).upper().replace(" ADVERBS", "").strip()
+
+def completed_ids(run_dir: Path):
+    """
+    Returns the ids the ablation pipeline has completed in run_dir, from its run completion logs
+    """
+    ids = set()
+    for run_completion in run_dir.glob("_run_completion_*.ndjson"):
+        ids.update(line["complete_id"] for line in load_ndjson(run_completion))
+    return ids
+
+def run_dir_for(output_dir: Path, model: Path, corpus: Path):
+    """
+    The logs of each (model, corpus) pair go to their own directory, so an interrupted sweep resumes where it stopped
+    """
+    return output_dir / model.stem / corpus.stem
+
+def plan_models(models, corpora, output_dir):
+    """
+    Model-major schedule: every model is loaded at most once and runs every corpus before the next model is loaded.
+    Models that have already completed every corpus are not loaded at all.
+    Returns (models to load, models already complete)
+    """
+    to_load, complete = [], []
+    for model in models:
+        pending = any(
+            {line["id"] for line in lines} - completed_ids(run_dir_for(output_dir, model, corpus))
+            for corpus, lines in corpora.items()
+        )
+        (to_load if pending else complete).append(model)
+    return to_load, complete
+
+def score_run(run_dir: Path, lines, studies):
+    """
+    Returns {study: {"sentences", "answered", "accuracy"}} of the records logged in run_dir against the main_tag of the gold lines.
+    Only lines with a main_tag are scored; a line without a record counts as wrong.
+    """
+    gold = {line["id"]: line["main_tag"] for line in lines if line.get("main_tag")}
+    records = {}
+    for data_log in sorted(run_dir.glob("_data_*.ndjson")):
+        for record in load_ndjson(data_log):
+            records[record["id"]] = record
+    scores = {}
+    for study in studies:
+        agent_type = study["agent_type"]
+        answered = correct = 0
+        for line_id, main_tag in gold.items():
+            output = records.get(line_id, {}).get(agent_type)
+            if not output:
+                continue
+            answered += 1
+            correct += normalize_label(output.get("category")) == normalize_label(main_tag)
+        scores[agent_type] = {"sentences": len(gold), "answered": answered, "accuracy": correct / len(gold) if gold else None}
+    return scores
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run the ablation studies over several corpora with several models, loading each model once, and write one results table"
+    )
+    parser.add_argument("output_dir", type=Path, help="Directory of the results table and of the logs of every model and corpus")
+    parser.add_argument("--models", type=Path, nargs="+", required=True, help="GGUF model files to compare")
+    parser.add_argument("--corpora", type=Path, nargs="+", required=True, help="Gold standard files tagged with manual-tagger (ndjson with id, sentence, adverb and main_tag)")
+    parser.add_argument(
+        "--studies",
+        nargs="+",
+        choices=[study["agent_type"] for study in ABLATION_STUDIES],
+        default=None,
+        help="Studies to run (default: all the studies of run-adverbs-ablation)",
+    )
+    parser.add_argument(
+        "--server_bin",
+        type=Path,
+        default=Path(os.environ.get("LLM_SERVER_BIN", repo_root() / "llama.cpp/build/bin/llama-server")),
+        help="Path to the llama-server binary (env: LLM_SERVER_BIN)",
+    )
+    parser.add_argument("--server_url", default="http://127.0.0.1:8080", help="Server URL (default: http://127.0.0.1:8080)")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads of the server (default: the server profile's threads, else 6)")
+    parser.add_argument("--server_profile", default=None, help="See run-adverbs (default: default)")
+    parser.add_argument("--slots", type=int, default=6, help="See run-adverbs-ablation (default: 6)")
+    parser.add_argument("--slot_ctx", type=int, default=2048, help="See run-adverbs-ablation (default: 2048)")
+    parser.add_argument("--chunk_size", type=int, default=10, help="See run-adverbs-ablation (default: 10)")
+    parser.add_argument("--concurrency", type=int, default=1, help="See run-adverbs-ablation (default: 1)")
+    parser.add_argument("--logprobs_mode", choices=["full", "two_phase"], default="full", help="See run-adverbs-ablation (default: full)")
+    parser.add_argument("--non_cot_mode", choices=["score", "generate"], default="generate", help="See run-adverbs-ablation (default: generate)")
+    parser.add_argument("--client_render", action="store_true", help="See run-adverbs-ablation")
+    parser.add_argument("--slot_cache", type=Path, default=None, help="See run-adverbs-ablation; the saved states are keyed by model, so one directory serves every model")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir.expanduser().resolve()
+    output_dir.mkdir(parents=True, exist_ok=True)
+    models = [model.expanduser().resolve() for model in args.models]
+    for path in models + [corpus.expanduser().resolve() for corpus in args.corpora]:
+        if not path.exists():
+            raise FileNotFoundError(f"Not found: {path}")
+    if len({model.stem for model in models}) < len(models):
+        raise ValueError("The model files must have different names, their logs are stored by name")
+
+    # Every corpus is read once for the whole sweep
+    corpora = {corpus.expanduser().resolve(): load_ndjson(corpus.expanduser().resolve()) for corpus in args.corpora}
+    studies = [
+        dict(study, scoring=study.get("scoring", False) and args.non_cot_mode == "score")
+        for study in ABLATION_STUDIES if args.studies is None or study["agent_type"] in args.studies
+    ]
+    chat_template = get_chat_template_path()
+    slots_per_server = max(args.slots, args.concurrency)
+    stats_path = output_dir / "model_stats.json"
+    model_stats = json.loads(stats_path.read_text(encoding="utf-8")) if stats_path.exists() else {} # Kept from earlier sweeps for the models that are not reloaded
+
+    to_load, complete = plan_models(models, corpora, output_dir)
+    print(f"Sweep of {len(models)} models over {len(corpora)} corpora: {len(to_load)} models to load, {len(complete)} already complete")
+
+    # ----------
+    # Model-major: load each model once and run every corpus on it
+    # ----------
+    for n, model in enumerate(to_load, start=1):
+        print(f"\n###### Model {n}/{len(to_load)}: {model.name} ######")
+        server = ServerManager(
+            args.server_bin,
+            model,
+            chat_template,
+            port=urlparse(args.server_url).port or 8080,
+            parallel=slots_per_server,
+            ctx_size=args.slot_ctx * slots_per_server,
+            threads=args.threads,
+            profile=load_server_profile(args.server_profile),
+            log_dir=output_dir / model.stem / "server_logs",
+            slot_cache_dir=args.slot_cache
+        )
+        stats = {"model": model.name, "load_seconds": None, "run_seconds": 0.0, "requests": 0, "predicted_n": 0, "error": None}
+        started = time.perf_counter()
+        try:
+            server.start()
+            stats["load_seconds"] = time.perf_counter() - started
+            throttle = AdaptiveThrottle(args.concurrency)
+            llm_client = LLMClient(
+                args.server_url,
+                pool_size=max(4, args.concurrency),
+                slot_affinity=args.concurrency == 1,
+                n_slots=slots_per_server,
+                logprobs_mode=args.logprobs_mode,
+                server_manager=server,
+                throttle=throttle,
+                chat_template=chat_template if args.client_render else None
+            )
+            for corpus, lines in corpora.items():
+                print(f"\n====== {model.name} on {corpus.name} ======")
+                run_dir = run_dir_for(output_dir, model, corpus)
+                logger = NDJSONLogger(None, None, run_dir)
+                set_logger(logger)
+                error_handler.logger = logger # Errors of this run go to its own logs
+                agents = AdverbsAblationStudy(args.server_url, MCQProbHandler(), KnowledgeBase(), llm_client, studies, chat_template=chat_template)
+                pipeline = AblationPipeline(agents, logger, studies, chunk_size=args.chunk_size, throttle=throttle, concurrency=args.concurrency)
+                run_started = time.perf_counter()
+                pipeline.run(corpus, run_dir, sentences_data=lines)
+                stats["run_seconds"] += time.perf_counter() - run_started
+            timing = llm_client.timing_stats().get("all", {"requests": 0, "predicted_n": 0})
+            stats["requests"], stats["predicted_n"] = timing["requests"], timing["predicted_n"]
+            print(llm_client.cache_report())
+            print(llm_client.timing_report())
+            llm_client.close()
+        except Exception as e:
+            # One model failing to load or crashing must not stop the sweep
+            print(f"ERROR: the sweep of {model.name} stopped: {e}")
+            stats["error"] = str(e)
+        finally:
+            server.stop()
+        stats["wall_seconds"] = time.perf_counter() - started
+        stats["generated_tokens_per_second"] = stats["predicted_n"] / stats["run_seconds"] if stats["run_seconds"] else 0.0
+        model_stats[model.name] = stats
+        stats_path.write_text(json.dumps(model_stats, indent=2), encoding="utf-8")
+
+    # ----------
+    # Combined results table: one row per model, corpus and study
+    # ----------
+    rows = []
+    for model in models:
+        stats = model_stats.get(model.name, {})
+        for corpus, lines in corpora.items():
+            for study, score in score_run(run_dir_for(output_dir, model, corpus), lines, studies).items():
+                rows.append({
+                    "model": model.name,
+                    "corpus": corpus.name,
+                    "study": study,
+                    "sentences": score["sentences"],
+                    "answered": score["answered"],
+                    "accuracy": score["accuracy"],
+                    "model_wall_seconds": stats.get("wall_seconds"),
+                    "model_load_seconds": stats.get("load_seconds"),
+                    "generated_tokens_per_second": stats.get("generated_tokens_per_second"),
+                })
+    print("\nModel sweep results:")
+    for row in rows:
+        accuracy = f"{row['accuracy']:.1%}" if row["accuracy"] is not None else "-"
+        speed = f"{row['generated_tokens_per_second']:.1f} tokens/s" if row["generated_tokens_per_second"] is not None else "-"
+        wall = f"{row['model_wall_seconds']:.0f} s" if row["model_wall_seconds"] is not None else "-"
+        print(f"  {row['model']} | {row['corpus']} | {row['study']}: accuracy {accuracy} ({row['answered']} of {row['sentences']} answered), model wall {wall}, {speed}")
+    with (output_dir / "sweep_results.csv").open("w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["model", "corpus", "study"])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Results written to {output_dir / 'sweep_results.csv'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 from pathlib import Path
 import argparse
+import math
 import os
+from urllib.parse import urlparse
 import importlib.resources as resources
 
 from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.llm_server.broker import PRIORITIES, connect_broker
 from AICorpusEngineering.agents.multiword_adverbs_tagger import MWAdverbs
 from AICorpusEngineering.pipelines.mw_adverb_pipeline import MWAdverbsPipeline
+from AICorpusEngineering.llm_client.llm_client import LLMClient
 
 def repo_root() -> Path:
     """Return the repository root."""
@@ -43,6 +48,55 @@ def main():
         help="Server URL (default: http://127.0.0.1:8080)",
     )
 
+    parser.add_argument(
+        "--grammar",
+        action="store_true",
+        help="Constrain the output to the JSON object {\"adverbs\": [...]} with a GBNF grammar",
+    )
+
+    # ----------
+    # Server pool
+    # ----------
+    parser.add_argument(
+        "--servers",
+        type=int,
+        default=1,
+        help="Number of llama-server instances, started on consecutive ports from the --server_url port. Requests go to the least busy server (default: 1)",
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Total number of CPU threads, split evenly between the servers (default: the server profile's threads, else 6)",
+    )
+
+    parser.add_argument(
+        "--server_profile",
+        default=None,
+        help="llama-server settings: a built-in profile (default, cpu, cpu-lowmem, gpu) or a profile file written by tune-llama-server (default: default)",
+    )
+
+    parser.add_argument(
+        "--broker",
+        default=None,
+        help="URL of a running inference broker (run-llm-broker) to send the requests to instead of starting llama-server, see run-adverbs (default: start llama-server)",
+    )
+
+    parser.add_argument(
+        "--priority",
+        choices=list(PRIORITIES),
+        default="normal",
+        help="With --broker, the priority of this run's requests (default: normal)",
+    )
+
+    parser.add_argument(
+        "--server_logs",
+        type=Path,
+        default=None,
+        help="Directory for the rotating llama-server log files (default: server output is discarded)",
+    )
+
     args = parser.parse_args()
     input_dir = args.input_dir.expanduser().resolve() # expanduser deals with ~ and resolve deals with relative paths
     if not input_dir.exists() or not input_dir.is_dir():
@@ -54,14 +108,37 @@ def main():
     if not chat_template.exists():
         raise FileNotFoundError(f"Chat template not found at {chat_template}")
 
-    server = ServerManager(args.server_bin, args.model, chat_template)
-    server.start()
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        instances=args.servers,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=args.server_logs
+    )
+    server_urls = server.server_urls if args.servers > 1 else args.server_url
+    broker = None
+    if args.broker is not None:
+        broker = connect_broker(args.broker, chat_template) # The broker's servers are already running
+        server_urls = args.broker
+    else:
+        server.start()
     try:
-        agent = MWAdverbs(args.server_url)
+        llm_client = LLMClient(
+            server_urls,
+            use_grammar=args.grammar,
+            server_manager=server if broker is None else None,
+            priority=args.priority if broker is not None else None,
+            client_name=f"{parser.prog}-{os.getpid()}"
+        )
+        agent = MWAdverbs(args.server_url, llm_client)
         pipeline = MWAdverbsPipeline(agent)
         pipeline.run(input_dir)
     finally:
-        server.stop()
+        if broker is None:
+            server.stop()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
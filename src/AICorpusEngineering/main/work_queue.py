@@ -0,0 +1,218 @@
+from pathlib import Path
+import argparse
+import json
+import os
+import socket
+from urllib.parse import urlparse
+import importlib.resources as resources
+
+from AICorpusEngineering.llm_server.server_manager import ServerManager
+from AICorpusEngineering.llm_server.server_profiles import load_server_profile
+from AICorpusEngineering.llm_server.broker import PRIORITIES, connect_broker
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy, ABLATION_STUDIES
+from AICorpusEngineering.pipelines.work_queue import WorkQueue, QueueWorker, enqueue_tagging, enqueue_ablation, tagging_job, ablation_job, export_results
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.logger.logger import NDJSONLogger
+from AICorpusEngineering.logger.logger_registry import set_logger
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle
+
+
+# The agent template of each pipeline the queue runs
+TEMPLATES = {"tagging": "adverbs.jinja", "ablation": "ablation_adverbs_examples_kb.jinja"}
+
+def repo_root() -> Path:
+    """Return the repository root."""
+    return Path(__file__).resolve().parents[4]
+
+def get_chat_template_path(pipeline: str) -> Path:
+    """Return the installed path to the agent template of the pipeline."""
+    return resources.files("AICorpusEngineering.agent-templates").joinpath(TEMPLATES[pipeline])
+
+
+def enqueue():
+    parser = argparse.ArgumentParser(
+        description="Add the jobs of a tagging or ablation run to a work queue file, for run-adverbs-worker processes to run"
+    )
+    parser.add_argument("queue_file", type=Path, help="SQLite file of the work queue, created if it does not exist")
+    parser.add_argument("--pipeline", choices=list(TEMPLATES), default="tagging", help="tagging: the run-adverbs jobs of the .txt files of --input; ablation: the run-adverbs-ablation jobs of the gold standard file --input (default: tagging)")
+    parser.add_argument("--input", type=Path, default=None, help="Input directory (tagging) or gold standard .ndjson file (ablation); can be left out to only change the queue, e.g., with --retry_failed")
+    parser.add_argument("--multi_adverb", action="store_true", help="See run-adverbs")
+    parser.add_argument("--non_cot_mode", choices=["score", "generate"], default="generate", help="See run-adverbs-ablation (default: generate)")
+    parser.add_argument("--few_shot_k", type=int, default=None, help="See run-adverbs-ablation (default: the fixed examples)")
+    parser.add_argument("--embedding_model", default=None, help="See run-adverbs-ablation (default: lexical overlap only)")
+    parser.add_argument("--self_consistency", type=int, default=1, help="See run-adverbs (default: 1)")
+    parser.add_argument("--self_consistency_temperature", type=float, default=0.7, help="See run-adverbs (default: 0.7)")
+    parser.add_argument("--max_attempts", type=int, default=3, help="Times a job is tried, counting the leases that ran out, before it is marked failed (default: 3)")
+    parser.add_argument("--retry_failed", action="store_true", help="Return the failed jobs of the queue to it with their attempts reset")
+    args = parser.parse_args()
+
+    # The settings every worker runs the jobs with
+    settings = {
+        "pipeline": args.pipeline,
+        "multi_adverb": args.multi_adverb if args.pipeline == "tagging" else False,
+        "non_cot_mode": args.non_cot_mode if args.pipeline == "ablation" else None,
+        "few_shot_k": args.few_shot_k,
+        "embedding_model": args.embedding_model,
+        "self_consistency": args.self_consistency,
+        "self_consistency_temperature": args.self_consistency_temperature,
+        "max_attempts": args.max_attempts
+    }
+    queue = WorkQueue(args.queue_file)
+    try:
+        queue.configure(settings)
+        if args.retry_failed:
+            print(f"{queue.retry_failed()} failed jobs returned to the queue")
+        if args.input is not None:
+            input_path = args.input.expanduser().resolve()
+            if args.pipeline == "tagging":
+                if not input_path.is_dir():
+                    raise FileNotFoundError(f"Input directory not found: {input_path}")
+                new_jobs, new_occurrences = enqueue_tagging(queue, input_path, args.multi_adverb)
+            else:
+                if not input_path.is_file():
+                    raise FileNotFoundError(f"Gold standard tagged sentences not found: {input_path}")
+                with input_path.open("r", encoding="utf-8") as f:
+                    lines = [json.loads(line) for line in f if line.strip()]
+                new_jobs, new_occurrences = enqueue_ablation(queue, lines)
+            print(f"Added {new_jobs} jobs for {new_occurrences} occurrences")
+        print(queue.report())
+    finally:
+        queue.close()
+
+
+def worker():
+    parser = argparse.ArgumentParser(
+        description="Run the jobs of a work queue file until none is left. Any number of workers can run the same queue, each with its own llama-server"
+    )
+    parser.add_argument("queue_file", type=Path, help="SQLite file of the work queue, see enqueue-adverbs")
+    parser.add_argument(
+        "--server_bin",
+        type=Path,
+        default=Path(os.environ.get("LLM_SERVER_BIN", repo_root() / "llama.cpp/build/bin/llama-server")),
+        help="Path to the llama-server binary (env: LLM_SERVER_BIN)",
+    )
+    parser.add_argument(
+        "--model",
+        type=Path,
+        default=Path(os.environ.get("LLM_MODEL", repo_root() / "Meta-Llama-3.1-8B-Instruct-Q4_K_M.gguf")),
+        help="Path to the large language model (env: LLM_MODEL)",
+    )
+    parser.add_argument("--server_url", default="http://127.0.0.1:8080", help="URL of this worker's llama-server; workers on one machine need different ports (default: http://127.0.0.1:8080)")
+    parser.add_argument("--attach", action="store_true", help="Send the requests to a llama-server already running at --server_url, e.g., on another machine, instead of starting one. It must serve the pipeline's agent template")
+    parser.add_argument("--broker", default=None, help="URL of a running inference broker to send the requests to instead of starting llama-server, see run-adverbs")
+    parser.add_argument("--priority", choices=list(PRIORITIES), default="batch", help="With --broker, the priority of this worker's requests (default: batch)")
+    parser.add_argument("--concurrency", type=int, default=1, help="Jobs leased and run at once; the llama-server gets as many slots (default: 1)")
+    parser.add_argument("--throttle", choices=["adaptive", "none"], default="adaptive", help="adaptive: adjust the jobs in flight, up to --concurrency, from the server's latency and tokens/s, see run-adverbs. none: always --concurrency (default: adaptive)")
+    parser.add_argument("--slot_ctx", type=int, default=2048, help="Context window of each slot in tokens (default: 2048)")
+    parser.add_argument("--threads", type=int, default=None, help="Number of CPU threads of the llama-server (default: the server profile's threads, else 6)")
+    parser.add_argument("--server_profile", default=None, help="See run-adverbs (default: default)")
+    parser.add_argument("--logprobs_mode", choices=["full", "two_phase"], default="full", help="See run-adverbs (default: full)")
+    parser.add_argument("--answer_top_k", type=int, default=1000, help="See run-adverbs (default: 1000)")
+    parser.add_argument("--client_render", action="store_true", help="See run-adverbs")
+    parser.add_argument("--stream", action="store_true", help="See run-adverbs")
+    parser.add_argument("--lease_seconds", type=float, default=600, help="Seconds a job stays leased without a renewal; the jobs of a worker that was killed return to the queue after this long (default: 600)")
+    parser.add_argument("--logs_dir", type=Path, default=None, help="Directory of this worker's error logs and llama-server logs (default: worker_logs next to the queue file)")
+    args = parser.parse_args()
+
+    queue_file = args.queue_file.expanduser().resolve()
+    if not queue_file.exists():
+        raise FileNotFoundError(f"Work queue not found: {queue_file}; create it with enqueue-adverbs")
+    queue = WorkQueue(queue_file, lease_seconds=args.lease_seconds)
+    settings = queue.settings
+    logs_dir = (args.logs_dir or queue_file.parent / "worker_logs").expanduser().resolve()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    # Only the error logs are written by the worker, the results go to the queue
+    logger = NDJSONLogger(None, logs_dir / f"_errors_{worker_id}.ndjson", logs_dir)
+    set_logger(logger) # Register a global instance of the logger, now available anywhere.
+
+    chat_template = get_chat_template_path(settings["pipeline"])
+    if not chat_template.exists():
+        raise FileNotFoundError(f"Chat template not found at {chat_template}")
+
+    # With one job in flight each study (or the grouper) keeps its own slot, see run-adverbs-ablation
+    self_consistency = settings["self_consistency"]
+    slots = max(args.concurrency * self_consistency, len(ABLATION_STUDIES) if settings["pipeline"] == "ablation" else 1)
+    server = ServerManager(
+        args.server_bin,
+        args.model,
+        chat_template,
+        port=urlparse(args.server_url).port or 8080,
+        parallel=slots,
+        ctx_size=args.slot_ctx * slots,
+        threads=args.threads,
+        profile=load_server_profile(args.server_profile),
+        log_dir=logs_dir / f"server_logs_{worker_id}"
+    )
+    server_url = args.server_url
+    broker = None
+    if args.broker is not None:
+        broker = connect_broker(args.broker, chat_template) # The broker's servers are already running
+        server_url = args.broker
+    elif not args.attach:
+        server.start()
+    managed = server if broker is None and not args.attach else None
+
+    try:
+        prob_handler = MCQProbHandler()
+        knowledge_base = KnowledgeBase()
+        if settings["few_shot_k"] is not None:
+            knowledge_base.create_example_pool(settings["few_shot_k"], settings["embedding_model"])
+        throttle = AdaptiveThrottle(args.concurrency) if args.throttle == "adaptive" else None
+        llm_client = LLMClient(
+            server_url,
+            pool_size=max(4, args.concurrency),
+            slot_affinity=args.concurrency == 1 and managed is not None, # The slots of a server this worker did not start are unknown
+            n_slots=slots,
+            logprobs_mode=args.logprobs_mode,
+            answer_top_k=args.answer_top_k,
+            stream=args.stream,
+            server_manager=managed,
+            throttle=throttle,
+            chat_template=chat_template if args.client_render else None,
+            priority=args.priority if broker is not None else None,
+            client_name=f"{parser.prog}-{worker_id}"
+        )
+        temperature = settings["self_consistency_temperature"]
+        if settings["pipeline"] == "tagging":
+            agents = BroadGrouperAgent(server_url, prob_handler, knowledge_base, llm_client, self_consistency, temperature)
+            run_job = tagging_job(agents, settings["multi_adverb"])
+        else:
+            studies = [dict(study, scoring=study.get("scoring", False) and settings["non_cot_mode"] == "score") for study in ABLATION_STUDIES]
+            agents = AdverbsAblationStudy(server_url, prob_handler, knowledge_base, llm_client, studies, self_consistency, temperature, chat_template)
+            run_job = ablation_job(agents, studies)
+
+        print(f"Worker {worker_id} runs the {settings['pipeline']} jobs of {queue_file}")
+        completed, failed = QueueWorker(queue, run_job, worker_id, concurrency=args.concurrency, throttle=throttle).run()
+        print(f"Worker {worker_id} finished: {completed} jobs done, {failed} failed attempts")
+        print(llm_client.timing_report())
+    except KeyboardInterrupt:
+        print(f"Worker {worker_id} stopped; its jobs were returned to the queue")
+    finally:
+        queue.close()
+        if managed is not None:
+            server.stop()
+
+
+def export():
+    parser = argparse.ArgumentParser(
+        description="Write the results of a work queue to data logs in the format of run-adverbs or run-adverbs-ablation"
+    )
+    parser.add_argument("queue_file", type=Path, help="SQLite file of the work queue")
+    parser.add_argument("output_dir", type=Path, help="Directory of the data, completion and error logs; occurrences already in its completion logs are skipped, so the export can be repeated while the workers run")
+    args = parser.parse_args()
+
+    queue_file = args.queue_file.expanduser().resolve()
+    if not queue_file.exists():
+        raise FileNotFoundError(f"Work queue not found: {queue_file}")
+    queue = WorkQueue(queue_file)
+    try:
+        logger = NDJSONLogger(None, None, args.output_dir)
+        written, failed = export_results(queue, logger)
+        print(f"Wrote {written} records and {failed} failed occurrences to {logger.logs_dir}")
+        print(queue.report())
+    finally:
+        queue.close()
@@ -1,7 +1,11 @@
+import asyncio
 import json
 from AICorpusEngineering.logger.logger import NDJSONLogger
 from AICorpusEngineering.error_handler.error_handler import error_handler
 from AICorpusEngineering.logger.logger_registry import get_logger
+from AICorpusEngineering.pipelines.dispatch import AsyncDispatcher
+from AICorpusEngineering.pipelines.throttle import FixedCooldown
+from AICorpusEngineering.pipelines.job_planner import JobManifest
 import time
 from datetime import timedelta
 
@@ -10,11 +14,31 @@ class AblationPipeline:
     This class controls the classes and data flow for
     the adverbs ablation study
     """
-    def __init__(self, ablation_agents_interface, logger: NDJSONLogger):
+    def __init__(self, ablation_agents_interface, logger: NDJSONLogger, studies = None, chunk_size: int = 10, throttle = None, concurrency: int = 1, dedup: bool = True):
+        """
+        studies: the declarative study matrix (see ABLATION_STUDIES), defaults to the studies of the agents
+        chunk_size: number of sentences run through each study before moving on to the next study.
+        throttle: AdaptiveThrottle or FixedCooldown (see throttle.py). It should be the throttle of the agents' LLMClient,
+        which feeds it the latency and tokens/s of every request. Defaults to no pauses and concurrency requests in flight.
+        concurrency: maximum number of sentences of a study sent at once. 1 keeps one request at a time.
+        dedup: plan all pending sentences before sending anything (see job_planner.py) and send each
+        unique (sentence, adverb, study) once; its result is reused for every id it occurs with.
+        """
         self.ablation_agents_interface = ablation_agents_interface
         self.logger = get_logger() # Get the global instance of the logger
+        self.studies = studies or ablation_agents_interface.studies
+        self.chunk_size = chunk_size
+        self.throttle = throttle if throttle is not None else FixedCooldown(0, concurrency)
+        self.dispatcher = AsyncDispatcher(concurrency, self.throttle) if concurrency > 1 else None
+        self.dedup = dedup
+        self.manifest = None
+        self.resolved = {} # manifest key -> study output of a unique job, shared by all the chunks of the run
     
-    def run(self, input_dir, output_dir):
+    def run(self, input_dir, output_dir, sentences_data=None):
+        """
+        sentences_data: the lines of the input file when they are already loaded,
+        e.g., by the model sweep, which runs the same corpus against every model
+        """
 
         # ----------
         # Set up data logs and run completion logs
@@ -32,75 +56,164 @@ class AblationPipeline:
         # ----------
         # Load gold standard sentences and append to an array
         # ----------
-        sentences_data = []
-        with input_dir.open("r", encoding="utf-8") as f:
-            for line in f:
-                if line.strip():
-                    sentences_data.append(json.loads(line))
+        if sentences_data is None:
+            sentences_data = []
+            with input_dir.open("r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        sentences_data.append(json.loads(line))
         
         # ----------
-        # Loop through each sentence and send to LLM for ablation study
+        # Run the study matrix chunk by chunk
+        # Within a chunk all sentences are sent through one study before moving on to the next study,
+        # so consecutive requests share the same prompt prefix and the server's cached context is reused.
         # ----------
-        sleep_countdown = 10 # Sleep the program every 10 rounds to let the CPU/GPU cool down
+        pending = [line for line in sentences_data if line["id"] not in completions] # Skip lines that have already been completed
+        if self.dedup:
+            self.manifest = self.plan(pending)
+            print(self.manifest.report())
         start_time = time.time()
-        total_items = len(sentences_data) # For estimating the remaining time to process all items
-        for i, line in enumerate(sentences_data, start = 1):
-            # Check that this line has not already been completed
-            if line["id"] in completions:
-                continue
-            
-            sentence = line["sentence"]
-            words = sentence.split()
-            plain_sentence = " ".join(w.rsplit("_", 1)[0] if "_" in w else w for w in words)
-            adverb = line["adverb"]
-            try:
-                result_by_syntax = self.ablation_agents_interface.base_study(plain_sentence, adverb)
-                if result_by_syntax is None:
-                    continue
-                print(result_by_syntax)
-                study_1_output = self.ablation_agents_interface.kb_oneshot_cot(plain_sentence, adverb)
-                print(study_1_output)
-                study_2_output = self.ablation_agents_interface.kb_zeroshot(plain_sentence, adverb)
-                print(study_2_output)
-                study_3_output = self.ablation_agents_interface.zeroshot(plain_sentence, adverb)
-                print(study_3_output)
-                study_4_output = self.ablation_agents_interface.oneshot_cot(plain_sentence, adverb)
-                print(study_4_output)
-                study_5_output = self.ablation_agents_interface.fewshot_cot(plain_sentence, adverb)
-                print(study_5_output)
-            except Exception as e:
-                if error_handler:
-                    error_handler.handle(e, context={"line": i, "sentence": plain_sentence, "adverb": adverb}) # Logging of the error is handled by the error_handler so no need to log
+        total_items = len(pending) # For estimating the remaining time to process all items
+        done = 0
+        for chunk_start in range(0, total_items, self.chunk_size):
+            chunk = pending[chunk_start:chunk_start + self.chunk_size]
+            results = self._run_chunk(chunk)
+
             # ----------
-            # Record the result and the completion
+            # Record the results and the completions in the original order
             # ----------
-            result = {
-                "base_study": result_by_syntax,
-                "kb_oneshot_cot": study_1_output,
-                "kb_zeroshot": study_2_output,
-                "zeroshot": study_3_output,
-                "oneshot_cot": study_4_output,
-                "fewshot_cot": study_5_output,
-                "id": line["id"]
-            }
-            self.logger.log_record(result)
-            self.logger.log_completion({"complete_id": line["id"]})
+            for line in chunk:
+                result = results.get(line["id"])
+                if result is None:
+                    continue
+                self.logger.log_record(result)
+                self.logger.log_completion({"complete_id": line["id"]})
 
             # ----------
-            # Progress trackoing
+            # Progress tracking
             # ----------
+            done += len(chunk)
             elapsed = time.time() - start_time
-            avg_time = elapsed / i
-            remaining = avg_time * (total_items - i)
+            avg_time = elapsed / done
+            remaining = avg_time * (total_items - done)
             eta = timedelta(seconds=int(remaining))
-            print(f"\nProgress: {i}/{total_items} ({i/total_items:.1%}) | Elapsed: {timedelta(seconds=int(elapsed))} | ETA: {eta}")
+            print(f"\nProgress: {done}/{total_items} ({done/total_items:.1%}) | Elapsed: {timedelta(seconds=int(elapsed))} | ETA: {eta}")
 
             # ----------
-            # Cooling down
+            # Cooling down - only the FixedCooldown policy pauses here, the AdaptiveThrottle pauses between requests when needed
             # ----------
-            sleep_countdown -= 1
-            if sleep_countdown == 0:
-                print("\nCoolin down for 180 seconds...\n")
-                time.sleep(180)
-                sleep_countdown = 10
-            
+            self.throttle.after_chunk(done, total_items)
+        print(self.throttle.report())
+
+    def plan(self, lines):
+        """
+        Builds the JobManifest of the pending lines: one job per (plain_sentence, adverb, study), with the line ids as occurrences
+        """
+        manifest = JobManifest()
+        for line_id, plain_sentence, adverb in self._prepare_items(lines):
+            for study in self.studies:
+                manifest.add(plain_sentence, adverb, study["agent_type"], line_id)
+        return manifest
+
+    @staticmethod
+    def _prepare_items(lines):
+        """
+        Returns the (id, plain_sentence, adverb) items of the lines
+        """
+        items = []
+        for line in lines:
+            words = line["sentence"].split()
+            plain_sentence = " ".join(w.rsplit("_", 1)[0] if "_" in w else w for w in words)
+            items.append((line["id"], plain_sentence, line["adverb"]))
+        return items
+
+    def _run_chunk(self, chunk):
+        """
+        Runs every study over every sentence in the chunk, study by study,
+        and reassembles one result record per id:
+        {"base_study": {...}, "kb_oneshot_cot": {...}, ..., "id": id}
+        Sentences for which the first study fails are left out of the results.
+        With dedup only the unique (sentence, adverb) jobs without a known result are sent.
+        """
+        # Prepare the plain sentences once for the whole chunk
+        items = self._prepare_items(chunk)
+
+        results = {line_id: {} for line_id, _, _ in items}
+        skipped = set()
+        for study_num, study in enumerate(self.studies):
+            agent_type = study["agent_type"]
+            active = [item for item in items if item[0] not in skipped]
+            to_run = active
+            if self.dedup:
+                keys = {line_id: JobManifest.key(plain_sentence, adverb, agent_type) for line_id, plain_sentence, adverb in active}
+                unique = {}
+                for item in active:
+                    if keys[item[0]] not in self.resolved:
+                        unique.setdefault(keys[item[0]], item)
+                to_run = list(unique.values())
+            print(f"\n====== Running {agent_type} over {len(to_run)} sentences ======")
+            if len(to_run) < len(active):
+                print(f"{len(active) - len(to_run)} duplicate sentences reuse another sentence's result")
+
+            if self.dispatcher is not None:
+                outputs = self._run_study_concurrently(study, to_run)
+            else:
+                outputs = self._run_study(study, to_run)
+            outputs = {item[0]: output for item, output in zip(to_run, outputs)}
+            if self.dedup:
+                for line_id, output in outputs.items():
+                    if output is not None:
+                        self.resolved[keys[line_id]] = output # Failed jobs are not stored, so a later occurrence tries again
+                outputs = {line_id: self.resolved.get(keys[line_id]) for line_id, _, _ in active}
+
+            for line_id, _, _ in active:
+                output = outputs.get(line_id)
+                if study_num == 0 and output is None:
+                    skipped.add(line_id)
+                    continue
+                results[line_id][agent_type] = output
+
+        records = {}
+        for line_id, _, _ in items:
+            if line_id in skipped:
+                continue
+            record = dict(results[line_id])
+            record["id"] = line_id
+            records[line_id] = record
+        return records
+
+    def _run_study(self, study, items):
+        """
+        Sends the items through one study one request at a time and returns one output per item, None if it failed
+        """
+        outputs = []
+        for line_id, plain_sentence, adverb in items:
+            output = None
+            try:
+                output = self.ablation_agents_interface.run_study(study, plain_sentence, adverb)
+            except Exception as e:
+                if error_handler:
+                    error_handler.handle(e, context={"id": line_id, "study": study["agent_type"], "sentence": plain_sentence, "adverb": adverb}) # Logging of the error is handled by the error_handler so no need to log
+            outputs.append(output)
+        return outputs
+
+    def _run_study_concurrently(self, study, items):
+        """
+        Sends the items through one study with up to the throttle's limit of requests in flight
+        and returns one output per item, None if it failed.
+        The requests run in worker threads; the responses are parsed on the event loop thread because
+        the agents share one prob_handler.
+        """
+        agent_type = study["agent_type"]
+
+        async def analyze(line_id, plain_sentence, adverb):
+            data = await asyncio.to_thread(self.ablation_agents_interface.request_study, study, plain_sentence, adverb)
+            return self.ablation_agents_interface.parse_study(study, data, plain_sentence, adverb)
+
+        def on_error(job, e):
+            line_id, plain_sentence, adverb = job
+            if error_handler:
+                error_handler.handle(e, context={"id": line_id, "study": agent_type, "sentence": plain_sentence, "adverb": adverb}) # Logging of the error is handled by the error_handler so no need to log
+            return None
+
+        return self.dispatcher.run(items, analyze, on_error)
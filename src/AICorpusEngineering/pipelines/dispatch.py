@@ -0,0 +1,63 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+class AsyncDispatcher:
+    """
+    Keeps a number of LLM requests in flight at once.
+    llama-server started with several parallel slots only works on all of them
+    when the client has that many requests waiting, so jobs are dispatched
+    concurrently and the results are handed back in the same order as the jobs.
+    With a throttle (see throttle.py) the number of requests in flight follows throttle.limit,
+    up to concurrency; without one it is always concurrency.
+    """
+    def __init__(self, concurrency: int = 4, throttle = None):
+        self.concurrency = max(1, concurrency)
+        self.throttle = throttle
+
+    @property
+    def limit(self):
+        if self.throttle is None:
+            return self.concurrency
+        return max(1, min(self.concurrency, self.throttle.limit))
+
+    def run(self, jobs, worker, on_error=None):
+        """
+        jobs: a list of argument tuples, one per request
+        worker: an async function called as worker(*job)
+        on_error: optional function called as on_error(job, exc) from inside the exception handler,
+        so that the error_handler can log (or re-raise) the error. Its return value becomes the job's result.
+        Returns a list of results in the same order as jobs.
+        """
+        if not jobs:
+            return []
+        return asyncio.run(self._run_all(jobs, worker, on_error))
+
+    async def _run_all(self, jobs, worker, on_error):
+        # Blocking requests run in worker threads; one thread per request in flight
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        loop.set_default_executor(executor)
+        # The limit can change while jobs run, so jobs wait for in_flight to drop below the current limit
+        in_flight = 0
+        slot_freed = asyncio.Condition()
+
+        async def bounded(job):
+            nonlocal in_flight
+            async with slot_freed:
+                await slot_freed.wait_for(lambda: in_flight < self.limit)
+                in_flight += 1
+            try:
+                return await worker(*job)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                return on_error(job, e)
+            finally:
+                async with slot_freed:
+                    in_flight -= 1
+                    slot_freed.notify_all()
+
+        try:
+            return await asyncio.gather(*(bounded(job) for job in jobs))
+        finally:
+            executor.shutdown(wait=False)
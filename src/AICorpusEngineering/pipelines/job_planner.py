@@ -0,0 +1,75 @@
+import unicodedata
+
+def normalize_sentence(sentence: str):
+    """
+    Normalizes a plain sentence for deduplication: Unicode NFC and single spaces.
+    Case and punctuation are kept because they can change the classification.
+    """
+    return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+def normalize_adverb(adverb):
+    """
+    Normalizes an adverb, or the tuple of adverbs of a multi-adverb job, for deduplication
+    """
+    if isinstance(adverb, str):
+        return normalize_sentence(adverb)
+    return tuple(normalize_sentence(a) for a in adverb)
+
+
+class JobManifest:
+    """
+    Planning pass run before a pipeline sends anything to the LLM.
+    Corpora repeat headers, boilerplate and quoted sentences, so the same (plain_sentence, adverb, study)
+    job can occur many times. The manifest keeps each unique job once, with back-references
+    to all of its occurrences, so the pipeline can send one request per unique job and
+    fan the result out to every occurrence in the data logs.
+    """
+    def __init__(self):
+        self.jobs = {} # key -> {"sentence", "adverb", "study", "occurrences": [occurrence, ...]}
+        self.occurrences = 0
+
+    @staticmethod
+    def key(sentence: str, adverb, study: str):
+        return (normalize_sentence(sentence), normalize_adverb(adverb), study)
+
+    def add(self, sentence: str, adverb, study: str, occurrence):
+        """
+        Adds one occurrence of a job and returns the job's key.
+        occurrence: anything that identifies where the job came from, e.g., {"filename", "line"} or an id
+        """
+        key = self.key(sentence, adverb, study)
+        job = self.jobs.get(key)
+        if job is None:
+            job = self.jobs[key] = {"sentence": key[0], "adverb": key[1], "study": study, "occurrences": []}
+        job["occurrences"].append(occurrence)
+        self.occurrences += 1
+        return key
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @property
+    def dedup_ratio(self):
+        """
+        Share of the occurrences that need no request of their own
+        """
+        if not self.occurrences:
+            return 0.0
+        return 1 - len(self.jobs) / self.occurrences
+
+    def most_repeated(self, n: int = 3):
+        """
+        Returns the n jobs with the most occurrences
+        """
+        return sorted(self.jobs.values(), key=lambda job: -len(job["occurrences"]))[:n]
+
+    def report(self):
+        lines = [
+            f"Job plan: {self.occurrences} jobs, {len(self.jobs)} unique, "
+            f"{self.occurrences - len(self.jobs)} duplicates answered from the unique jobs ({self.dedup_ratio:.1%})"
+        ]
+        for job in self.most_repeated():
+            if len(job["occurrences"]) < 2:
+                break
+            lines.append(f"  {len(job['occurrences'])}x {job['study']}: {job['adverb']} in \"{job['sentence'][:80]}\"")
+        return "\n".join(lines)
@@ -2,12 +2,55 @@ import json
 from AICorpusEngineering.logger.logger import NDJSONLogger
 from AICorpusEngineering.error_handler.error_handler import error_handler
 from AICorpusEngineering.logger.logger_registry import get_logger
+from AICorpusEngineering.pipelines.dispatch import AsyncDispatcher
+from AICorpusEngineering.pipelines.job_planner import JobManifest
 from pathlib import Path
 
+def read_jobs(input_file, multi_adverb: bool = False):
+    """
+    Returns the (plain_sentence, adverb, line) jobs of a POS tagged file in order.
+    With multi_adverb each job is a whole sentence with the list of its adverbs.
+    """
+    jobs = []
+    with open(input_file, "r", encoding="utf-8") as infile:
+        for i, line in enumerate(infile, start=1):
+            sentence = line.strip()
+            if not sentence:
+                continue
+
+            # Extract tokens and adverbs and make a plain, untagged sentence
+            words = sentence.split()
+            adverbs = [w.rsplit("_", 1)[0] for w in words if "_" in w and w.rsplit("_")[1] in ["ADV"]]
+            plain_sentence = " ".join(w.rsplit("_", 1)[0] if "_" in w else w for w in words)
+            if multi_adverb:
+                if adverbs:
+                    jobs.append((plain_sentence, adverbs, i))
+                continue
+            for adverb in adverbs:
+                jobs.append((plain_sentence, adverb, i))
+    return jobs
+
 class TaggingPipeline:
-    def __init__(self, grouper_agents, logger: NDJSONLogger):
+    def __init__(self, grouper_agents, logger: NDJSONLogger, concurrency: int = 1, throttle = None, multi_adverb: bool = False, dedup: bool = True):
+        """
+        concurrency: number of requests kept in flight across all the adverbs of a file.
+        1 keeps the original one-request-at-a-time loop.
+        throttle: optional AdaptiveThrottle (see throttle.py) which lowers the number of requests
+        in flight below concurrency when the server slows down
+        multi_adverb: classify all the adverbs of a sentence in one request (analyze_sentence_by_syntax)
+        instead of one request per adverb. The logged records are the same.
+        dedup: plan the whole input_dir before sending anything (see job_planner.py) and send
+        each unique (sentence, adverb) once; its result is logged for every occurrence.
+        """
         self.grouper_agents = grouper_agents
         self.logger = get_logger() # Get the global instance of the logger
+        self.concurrency = concurrency
+        self.multi_adverb = multi_adverb
+        self.dedup = dedup
+        self.study = "syntactic-grouper-multi" if multi_adverb else "syntactic-grouper"
+        self.dispatcher = AsyncDispatcher(concurrency, throttle) if concurrency > 1 else None
+        self.manifest = None
+        self.resolved = {} # manifest key -> result of a unique job, shared by all the files of the run
 
     def run(self, input_dir, output_dir):
         # Find the _run_completion logs to know which files should be excluded
@@ -22,44 +65,117 @@ class TaggingPipeline:
                     completed_files.append(json_line["filepath"])
         print(f"The completed files are {completed_files}")
 
+        # Plan every pending file up front so duplicates across files are only sent once
+        input_files = list(input_dir.glob("*.txt"))
+        if self.dedup:
+            self.manifest = self.plan([f for f in input_files if str(f) not in completed_files])
+            print(self.manifest.report())
+
         # Loop through all the files in the input_dir
-        for input_file in input_dir.glob("*.txt"):
-            results = []
+        for input_file in input_files:
             # First make sure the file has not already been processed, and skip if it has.
             filename = input_file.name
             print(f"The filename being explored is: {str(input_file)}")
             if str(input_file) in completed_files:
                 continue
 
-            with open(input_file, "r", encoding="utf-8") as infile:
-                for i, line in enumerate(infile, start=1):
-                    sentence = line.strip()
-                    if not sentence:
-                        continue
-
-                    # Extract tokens and adverbs and make a plain, untagged sentence
-                    words = sentence.split()
-                    adverbs = [w.rsplit("_", 1)[0] for w in words if "_" in w and w.rsplit("_")[1] in ["ADV"]]
-                    plain_sentence = " ".join(w.rsplit("_", 1)[0] if "_" in w else w for w in words)
-
-                    # Loop through each adverb in adverbs and send to grouper_agents for analysis
-                    for adverb in adverbs:
-                        try:
-                            result_by_syntax = self.grouper_agents.analyze_by_syntax(plain_sentence, adverb)
-                            if result_by_syntax:
-                                result = {"filename": filename, "result": result_by_syntax}
-                                # Store the result in an array
-                                results.append(result)
-                        except Exception as e:
-                            if error_handler:
-                                error_handler.handle(e, context={"filename": filename, "line": i, "sentence": plain_sentence, "adverb": adverb}) # Logging of the error is handled by the error_handler so no need to log
+            jobs = self._read_jobs(input_file)
+            if self.dedup:
+                results = self._run_jobs_deduplicated(jobs, filename)
+            else:
+                results = self._to_records(filename, self._run_jobs(jobs, filename))
             completion_log = {"filepath": str(input_file)}
-            
+
             # Log all the results from this file's run
             for result in results:
                 self.logger.log_record(result)
-            
+
             # Log the completion of the run
             self.logger.log_completion(completion_log)
 
-        print(f"Done! Enhanced sentences saved to {output_dir}")
\ No newline at end of file
+        print(f"Done! Enhanced sentences saved to {output_dir}")
+
+    def plan(self, input_files):
+        """
+        Builds the JobManifest of the files: one job per (plain_sentence, adverb),
+        or per (plain_sentence, adverbs) with multi_adverb, with {"filename", "line"} occurrences
+        """
+        manifest = JobManifest()
+        for input_file in input_files:
+            for plain_sentence, adverb, line_num in self._read_jobs(input_file):
+                manifest.add(plain_sentence, adverb, self.study, {"filename": input_file.name, "line": line_num})
+        return manifest
+
+    def _read_jobs(self, input_file):
+        return read_jobs(input_file, self.multi_adverb)
+
+    def _to_records(self, filename, outputs):
+        """
+        Turns the outputs of _run_jobs into the records logged for a file
+        """
+        if self.multi_adverb:
+            outputs = [record for records in outputs if records for record in records]
+        return [{"filename": filename, "result": output} for output in outputs if output]
+
+    def _run_jobs_deduplicated(self, jobs, filename):
+        """
+        Sends only the jobs of the file whose result is not known yet, once per unique job,
+        and fans the results out to every job of the file in order
+        """
+        keys = [JobManifest.key(plain_sentence, adverb, self.study) for plain_sentence, adverb, _ in jobs]
+        unique = {}
+        for key, job in zip(keys, jobs):
+            if key not in self.resolved and key not in unique:
+                unique[key] = job
+        if len(unique) < len(jobs):
+            print(f"{len(jobs) - len(unique)} of the {len(jobs)} jobs in {filename} are duplicates and reuse another job's result")
+        outputs = self._run_jobs(list(unique.values()), filename)
+        for key, output in zip(unique, outputs):
+            if output:
+                self.resolved[key] = output # Failed jobs are not stored, so a later occurrence tries again
+        return self._to_records(filename, [self.resolved.get(key) for key in keys])
+
+    def _run_jobs(self, jobs, filename):
+        """
+        Sends the jobs to the grouper_agents and returns one output per job, in order;
+        None for a job that failed
+        """
+        if self.dispatcher is not None:
+            return self._run_jobs_concurrently(jobs, filename)
+        outputs = []
+        for plain_sentence, adverb, line_num in jobs:
+            output = None
+            try:
+                if self.multi_adverb:
+                    # Send all the adverbs of the sentence to grouper_agents in one request
+                    output = self.grouper_agents.analyze_sentence_by_syntax(plain_sentence, adverb)
+                else:
+                    output = self.grouper_agents.analyze_by_syntax(plain_sentence, adverb)
+            except Exception as e:
+                self._handle_error(e, filename, plain_sentence, adverb, line_num)
+            outputs.append(output)
+        return outputs
+
+    def _run_jobs_concurrently(self, jobs, filename):
+        """
+        Dispatches the jobs with up to self.concurrency requests in flight.
+        Results come back in the same order as the jobs.
+        """
+        async def analyze(plain_sentence, adverb, line_num):
+            if self.multi_adverb:
+                return await self.grouper_agents.analyze_sentence_by_syntax_async(plain_sentence, adverb)
+            return await self.grouper_agents.analyze_by_syntax_async(plain_sentence, adverb)
+
+        def on_error(job, e):
+            plain_sentence, adverb, line_num = job
+            self._handle_error(e, filename, plain_sentence, adverb, line_num)
+            return None
+
+        unit = "sentences" if self.multi_adverb else "adverbs"
+        print(f"Dispatching {len(jobs)} {unit} from {filename} with up to {self.concurrency} requests in flight")
+        return self.dispatcher.run(jobs, analyze, on_error)
+
+    def _handle_error(self, e, filename, plain_sentence, adverb, line_num):
+        key = "adverbs" if self.multi_adverb else "adverb"
+        if error_handler:
+            error_handler.handle(e, context={"filename": filename, "line": line_num, "sentence": plain_sentence, key: adverb}) # Logging of the error is handled by the error_handler so no need to log
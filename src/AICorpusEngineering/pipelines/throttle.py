@@ -0,0 +1,242 @@
+import glob
+import threading
+import time
+
+# ----------
+# Throttling policies.
+# Both policies share the same interface, used by the LLMClient and the pipelines:
+#   limit - number of requests the pipeline may keep in flight
+#   wait() - called before each request is sent
+#   record(key, seconds, timings) - called after each request with its round trip time and the server's timings
+#   record_error(key) - called when a request fails
+#   after_chunk(done, total) - called by the AblationPipeline after each chunk of sentences
+#   report() - printable summary
+# ----------
+
+class FixedCooldown:
+    """
+    The original policy: a fixed number of requests in flight and a fixed pause after every chunk,
+    whatever the hardware
+    """
+    def __init__(self, seconds: float = 180, concurrency: int = 1):
+        self.seconds = seconds
+        self.concurrency = max(1, concurrency)
+        self.cooldowns = 0
+
+    @property
+    def limit(self):
+        return self.concurrency
+
+    def wait(self):
+        pass
+
+    def record(self, key, seconds, timings=None):
+        pass
+
+    def record_error(self, key):
+        pass
+
+    def after_chunk(self, done, total):
+        if done < total and self.seconds > 0:
+            print(f"\nCooling down for {self.seconds} seconds...\n")
+            self.cooldowns += 1
+            time.sleep(self.seconds)
+
+    def report(self):
+        return f"Fixed cooldown: {self.cooldowns} pauses of {self.seconds} seconds with {self.concurrency} requests in flight"
+
+
+class AdaptiveThrottle:
+    """
+    Adjusts the number of requests in flight from measured signals instead of pausing on a timer.
+    Additive increase, multiplicative decrease (AIMD): after every window of completed requests
+    the limit grows by one while the server is healthy, and is multiplied by decrease_factor when it is not.
+    The server counts as degraded when any of these is true over the window:
+    - latency drift: the average server time per generated token of an agent_type has grown to more than
+      latency_drift times the best average seen for that agent_type
+    - tokens/s drop: the generation speed reported in the server's timings (predicted_per_second)
+      has fallen below tokens_per_second_drop times the best speed seen
+    - temperature: the hottest /sys/class/thermal zone is at or above max_temperature (off when None)
+    - a request failed
+    The latency is read from the server's timings, not the client's round trip, which also counts the time a request
+    waited behind the others in flight. Baselines are kept per agent_type, because the studies generate very
+    different amounts of text, and per number of requests in flight, because a server batching more requests
+    is slower per request while it is faster in total; so only a slowdown at the same load counts as drift.
+    When the server is still degraded at min_concurrency the pipeline pauses before the next request,
+    starting with min_cooldown seconds and doubling up to max_cooldown while the signals stay bad.
+    """
+    def __init__(
+            self,
+            max_concurrency: int = 1,
+            min_concurrency: int = 1,
+            latency_drift: float = 1.5,
+            tokens_per_second_drop: float = 0.7,
+            max_temperature: float = None,
+            decrease_factor: float = 0.5,
+            window: int = 4,
+            smoothing: float = 0.2,
+            min_cooldown: float = 5,
+            max_cooldown: float = 180,
+            thermal_glob: str = "/sys/class/thermal/thermal_zone*/temp"
+        ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.latency_drift = latency_drift
+        self.tokens_per_second_drop = tokens_per_second_drop
+        self.max_temperature = max_temperature
+        self.decrease_factor = decrease_factor
+        self.window = max(1, window)
+        self.smoothing = smoothing
+        self.min_cooldown = min_cooldown
+        self.max_cooldown = max_cooldown
+        self.thermal_glob = thermal_glob
+
+        self._limit = self.min_concurrency
+        self.latency = {} # (agent_type, requests in flight) -> {"average": smoothed seconds per token, "best": lowest average}
+        self.speed = {} # (agent_type, requests in flight) -> {"average": smoothed tokens/s, "best": highest average}
+        self.completed = 0 # requests completed since the last adjustment
+        self.in_flight = 0 # requests sent (wait) and not recorded yet
+        self.degraded_reasons = set()
+        self.cooldown = 0.0 # length of the latest pause, doubled while the server stays degraded, 0 while healthy
+        self.pause_pending = False
+        self.stats = {"increases": 0, "decreases": 0, "cooldowns": 0, "cooldown_seconds": 0.0, "max_temperature_seen": None}
+        self._temperature = (0.0, None) # time of the last reading, reading
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return self._limit
+
+    # ----------
+    # Signals
+    # ----------
+    def read_temperature(self):
+        """
+        Returns the hottest thermal zone in degrees Celsius, or None if there are none.
+        Read at most every 2 seconds.
+        """
+        checked, reading = self._temperature
+        if time.time() - checked < 2:
+            return reading
+        temperatures = []
+        for path in glob.glob(self.thermal_glob):
+            try:
+                with open(path, "r") as f:
+                    temperatures.append(int(f.read().strip()) / 1000)
+            except (OSError, ValueError):
+                continue
+        reading = max(temperatures) if temperatures else None
+        self._temperature = (time.time(), reading)
+        if reading is not None and (self.stats["max_temperature_seen"] is None or reading > self.stats["max_temperature_seen"]):
+            self.stats["max_temperature_seen"] = reading
+        return reading
+
+    def _smooth(self, signals, key, value, better):
+        """
+        Updates the smoothed value and its best level for one agent_type and load, and returns both
+        """
+        signal = signals.get(key)
+        if signal is None:
+            signal = signals[key] = {"average": value, "best": value, "samples": 0}
+        else:
+            signal["average"] = (1 - self.smoothing) * signal["average"] + self.smoothing * value
+        signal["samples"] += 1
+        # The first samples include the cold prompt cache, so the best level is only set after a few
+        if signal["samples"] >= 3:
+            signal["best"] = better(signal["best"], signal["average"])
+        return signal["average"], signal["best"]
+
+    @staticmethod
+    def seconds_per_token(seconds, timings):
+        """
+        Returns the server's time per generated token of a request, from its timings when the server returned them,
+        else from the round trip (a stream stopped at the final answer has no timings)
+        """
+        generated = timings.get("predicted_n") or 0
+        if generated and timings.get("predicted_ms") is not None:
+            return timings["predicted_ms"] / 1000 / generated
+        if "prompt_ms" in timings or "predicted_ms" in timings:
+            seconds = ((timings.get("prompt_ms") or 0) + (timings.get("predicted_ms") or 0)) / 1000 # A scored answer generates nothing
+        return seconds / max(1, generated)
+
+    def record(self, key, seconds, timings=None):
+        timings = timings or {}
+        with self._lock:
+            load = (key, max(1, self.in_flight)) # The request itself is still counted in flight
+            self.in_flight = max(0, self.in_flight - 1)
+            average, best = self._smooth(self.latency, load, self.seconds_per_token(seconds, timings), min)
+            if average > self.latency_drift * best:
+                self.degraded_reasons.add("latency drift")
+            if timings.get("predicted_per_second"):
+                average, best = self._smooth(self.speed, load, timings["predicted_per_second"], max)
+                if average < self.tokens_per_second_drop * best:
+                    self.degraded_reasons.add("tokens/s drop")
+            self.completed += 1
+            if self.completed >= max(self.window, self._limit):
+                self._adjust()
+
+    def record_error(self, key):
+        with self._lock:
+            self.in_flight = max(0, self.in_flight - 1)
+            self.degraded_reasons.add("request error")
+            self.completed += 1
+            self._adjust()
+
+    # ----------
+    # AIMD
+    # ----------
+    def _adjust(self):
+        if self.max_temperature is not None:
+            temperature = self.read_temperature()
+            if temperature is not None and temperature >= self.max_temperature:
+                self.degraded_reasons.add(f"temperature {temperature:.0f}C")
+        if self.degraded_reasons:
+            reasons = ", ".join(sorted(self.degraded_reasons))
+            if self._limit > self.min_concurrency:
+                self._limit = max(self.min_concurrency, int(self._limit * self.decrease_factor))
+                self.stats["decreases"] += 1
+                print(f"Throttle: {reasons}; reducing to {self._limit} requests in flight")
+            else:
+                self.cooldown = min(self.max_cooldown, max(self.min_cooldown, self.cooldown * 2))
+                self.pause_pending = True
+                print(f"Throttle: {reasons}; pausing for {self.cooldown:.1f} seconds")
+        else:
+            self.cooldown = 0.0
+            self.pause_pending = False
+            if self._limit < self.max_concurrency:
+                self._limit += 1
+                self.stats["increases"] += 1
+        self.completed = 0
+        self.degraded_reasons = set()
+
+    def wait(self):
+        """
+        Pauses before the next request while the server is degraded at the lowest limit.
+        The smoothed latencies and speeds are restarted after a pause, so the next window
+        is judged on fresh measurements.
+        """
+        with self._lock:
+            self.in_flight += 1
+            if not self.pause_pending:
+                return
+            self.pause_pending = False # Only the first waiting request pauses
+            cooldown = self.cooldown
+            self.stats["cooldowns"] += 1
+            self.stats["cooldown_seconds"] += cooldown
+        time.sleep(cooldown)
+        with self._lock:
+            for signals in (self.latency, self.speed):
+                for signal in signals.values():
+                    signal["average"] = signal["best"]
+
+    def after_chunk(self, done, total):
+        pass
+
+    def report(self):
+        temperature = self.stats["max_temperature_seen"]
+        return (
+            f"Adaptive throttle: {self._limit} requests in flight (range {self.min_concurrency}-{self.max_concurrency}), "
+            f"{self.stats['increases']} increases, {self.stats['decreases']} decreases, "
+            f"{self.stats['cooldowns']} pauses totalling {self.stats['cooldown_seconds']:.0f} seconds"
+            + (f", hottest thermal zone {temperature:.0f}C" if temperature is not None else "")
+        )
@@ -0,0 +1,415 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from AICorpusEngineering.error_handler.error_handler import error_handler
+from AICorpusEngineering.pipelines.dispatch import AsyncDispatcher
+from AICorpusEngineering.pipelines.job_planner import JobManifest
+from AICorpusEngineering.pipelines.tagging_pipeline import read_jobs
+from AICorpusEngineering.pipelines.ablation_adverbs import AblationPipeline
+
+class WorkQueue:
+    """
+    Crash-safe queue of the jobs of a run in a SQLite file, shared by any number of worker processes.
+    Like the JobManifest, the queue holds each unique (sentence, adverb) job once with all of its occurrences
+    (file and line, or gold standard id), so a result is computed once and exported for every occurrence.
+
+    A worker leases jobs for lease_seconds and renews the lease while it works on them. The lease of a worker
+    that was killed runs out and its jobs are leased again by another worker, so no job is lost.
+    A job that fails, or whose lease ran out, is tried again up to max_attempts times before it is marked failed.
+    Job states: pending -> leased -> done, or back to pending, or failed after max_attempts.
+
+    The settings of the run (pipeline, studies, few-shot examples, ...) are stored with the jobs,
+    so every worker computes the results the same way.
+    """
+    def __init__(self, path, lease_seconds: float = 600.0):
+        self.path = Path(path).expanduser().resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        # Transactions are explicit (isolation_level=None), so leasing is one BEGIN IMMEDIATE transaction across processes
+        self.conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL") # Workers read the queue while another one writes
+        self.conn.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL, payload TEXT NOT NULL, "
+            "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_until REAL, result TEXT, error TEXT, updated REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+        # source: unique name of an occurrence, so enqueueing the same input twice adds nothing
+        self.conn.execute("CREATE TABLE IF NOT EXISTS occurrences (source TEXT PRIMARY KEY, job_id INTEGER NOT NULL, data TEXT NOT NULL)")
+
+    def _transaction(self, work):
+        """
+        Runs work(conn) in one write transaction and returns its result
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = work(self.conn)
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+            return result
+
+    # ----------
+    # Settings
+    # ----------
+    @property
+    def settings(self):
+        with self._lock:
+            return {name: json.loads(value) for name, value in self.conn.execute("SELECT name, value FROM settings")}
+
+    def configure(self, settings: dict):
+        """
+        Stores the settings of the run. Raises a ValueError when the queue already holds jobs of other settings.
+        """
+        current = self.settings
+        if current and current != settings:
+            changed = sorted(name for name in set(current) | set(settings) if current.get(name) != settings.get(name))
+            raise ValueError(f"{self.path} holds jobs with other settings ({', '.join(changed)}); use a new queue file")
+        if not current:
+            self._transaction(lambda conn: conn.executemany("INSERT INTO settings VALUES (?, ?)", [(name, json.dumps(value)) for name, value in settings.items()]))
+
+    # ----------
+    # Producing
+    # ----------
+    def enqueue(self, items):
+        """
+        Adds jobs and their occurrences in one transaction.
+        items: (key, payload, source, occurrence) tuples; key identifies the unique job (see JobManifest.key),
+        source the occurrence, e.g., "path/file.txt:12:0"
+        Returns (new jobs, new occurrences)
+        """
+        def work(conn):
+            new_jobs = new_occurrences = 0
+            now = time.time()
+            for key, payload, source, occurrence in items:
+                key = json.dumps(key, ensure_ascii=False)
+                cursor = conn.execute("INSERT OR IGNORE INTO jobs (key, payload, updated) VALUES (?, ?, ?)", (key, json.dumps(payload, ensure_ascii=False), now))
+                new_jobs += cursor.rowcount
+                job_id = conn.execute("SELECT id FROM jobs WHERE key = ?", (key,)).fetchone()[0]
+                cursor = conn.execute("INSERT OR IGNORE INTO occurrences VALUES (?, ?, ?)", (source, job_id, json.dumps(occurrence, ensure_ascii=False)))
+                new_occurrences += cursor.rowcount
+            return new_jobs, new_occurrences
+        return self._transaction(work)
+
+    def retry_failed(self):
+        """
+        Returns the failed jobs to the queue with their attempts reset, and returns how many there were
+        """
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'pending', attempts = 0, worker = NULL, lease_until = NULL, updated = ? WHERE status = 'failed'", (time.time(),)
+        ).rowcount)
+
+    # ----------
+    # Consuming
+    # ----------
+    def lease(self, worker: str, n: int = 1):
+        """
+        Leases up to n pending jobs, or jobs whose lease ran out, to a worker, oldest first.
+        Jobs whose lease ran out after their last attempt are marked failed instead.
+        Returns [(job id, payload)]
+        """
+        max_attempts = self.settings.get("max_attempts", 3)
+
+        def work(conn):
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', error = COALESCE(error, 'The lease ran out ' || attempts || ' times'), worker = NULL, lease_until = NULL, updated = ? "
+                "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?", (now, now, max_attempts)
+            )
+            rows = conn.execute(
+                "SELECT id, payload FROM jobs WHERE status = 'pending' OR (status = 'leased' AND lease_until < ?) ORDER BY id LIMIT ?", (now, n)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                [(worker, now + self.lease_seconds, now, job_id) for job_id, _ in rows]
+            )
+            return [(job_id, json.loads(payload)) for job_id, payload in rows]
+        return self._transaction(work)
+
+    def renew(self, worker: str, job_ids):
+        """
+        Extends the leases the worker still holds
+        """
+        now = time.time()
+        self._transaction(lambda conn: conn.executemany(
+            "UPDATE jobs SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            [(now + self.lease_seconds, now, job_id, worker) for job_id in job_ids]
+        ))
+
+    def complete(self, job_id: int, worker: str, result):
+        """
+        Stores the result of a job. The results are deterministic, so a result that arrives after
+        the lease was taken over by another worker is kept too.
+        """
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, worker = ?, lease_until = NULL, updated = ? WHERE id = ? AND status != 'done'",
+            (json.dumps(result, ensure_ascii=False), worker, time.time(), job_id)
+        ))
+
+    def fail(self, job_id: int, worker: str, error: str):
+        """
+        Returns a failed job to the queue, or marks it failed after its last attempt
+        """
+        max_attempts = self.settings.get("max_attempts", 3)
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?, worker = NULL, lease_until = NULL, updated = ? "
+            "WHERE id = ? AND worker = ? AND status = 'leased'",
+            (max_attempts, error, time.time(), job_id, worker)
+        ))
+
+    def release(self, worker: str, job_ids):
+        """
+        Returns the jobs a worker still holds to the queue without counting the attempt, e.g., when the worker is stopped
+        """
+        self._transaction(lambda conn: conn.executemany(
+            "UPDATE jobs SET status = 'pending', attempts = MAX(0, attempts - 1), worker = NULL, lease_until = NULL, updated = ? WHERE id = ? AND worker = ? AND status = 'leased'",
+            [(time.time(), job_id, worker) for job_id in job_ids]
+        ))
+
+    # ----------
+    # Progress and results
+    # ----------
+    def counts(self):
+        """
+        Returns {status: jobs}, with the jobs whose lease ran out counted as pending
+        """
+        counts = {status: 0 for status in ("pending", "leased", "done", "failed")}
+        with self._lock:
+            for status, expired, n in self.conn.execute("SELECT status, status = 'leased' AND lease_until < ?, COUNT(*) FROM jobs GROUP BY 1, 2", (time.time(),)):
+                counts["pending" if expired else status] += n
+        return counts
+
+    def is_finished(self):
+        counts = self.counts()
+        return counts["pending"] == 0 and counts["leased"] == 0
+
+    def occurrences(self):
+        """
+        Yields (occurrence, status, result, error) for every occurrence in the order it was enqueued
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT o.data, j.status, j.result, j.error FROM occurrences o JOIN jobs j ON j.id = o.job_id ORDER BY o.rowid"
+            ).fetchall()
+        for data, status, result, error in rows:
+            yield json.loads(data), status, json.loads(result) if result is not None else None, error
+
+    def report(self):
+        counts = self.counts()
+        with self._lock:
+            occurrences = self.conn.execute("SELECT COUNT(*) FROM occurrences").fetchone()[0]
+            workers = [row[0] for row in self.conn.execute("SELECT DISTINCT worker FROM jobs WHERE status = 'leased' AND lease_until >= ?", (time.time(),))]
+        total = sum(counts.values())
+        return (
+            f"Queue {self.path.name}: {total} unique jobs for {occurrences} occurrences: "
+            f"{counts['done']} done, {counts['leased']} leased, {counts['pending']} pending, {counts['failed']} failed"
+            + (f"; workers: {', '.join(workers)}" if workers else "")
+        )
+
+    def close(self):
+        self.conn.close()
+
+
+# ----------
+# Producing the jobs of the pipelines
+# ----------
+def enqueue_tagging(queue: WorkQueue, input_dir: Path, multi_adverb: bool = False):
+    """
+    Adds the jobs of the .txt files of input_dir, like TaggingPipeline.plan: one job per unique (plain_sentence, adverb),
+    or (plain_sentence, adverbs) with multi_adverb, with a {"filepath", "filename", "line"} occurrence for each time it occurs
+    """
+    study = "syntactic-grouper-multi" if multi_adverb else "syntactic-grouper"
+    items = []
+    for input_file in sorted(Path(input_dir).glob("*.txt")):
+        per_line = {}
+        for plain_sentence, adverb, line_num in read_jobs(input_file, multi_adverb):
+            n = per_line[line_num] = per_line.get(line_num, -1) + 1 # The same adverb can occur twice in a line
+            items.append((
+                JobManifest.key(plain_sentence, adverb, study),
+                {"sentence": plain_sentence, "adverb": adverb},
+                f"{input_file}:{line_num}:{n}",
+                {"filepath": str(input_file), "filename": input_file.name, "line": line_num}
+            ))
+    return queue.enqueue(items)
+
+def enqueue_ablation(queue: WorkQueue, lines):
+    """
+    Adds one job per unique (plain_sentence, adverb) of the gold standard lines, which runs every study of the queue, with the line ids as occurrences
+    """
+    items = [
+        (JobManifest.key(plain_sentence, adverb, "ablation"), {"sentence": plain_sentence, "adverb": adverb}, f"id:{line_id}", {"id": line_id})
+        for line_id, plain_sentence, adverb in AblationPipeline._prepare_items(lines)
+    ]
+    return queue.enqueue(items)
+
+# ----------
+# Running the jobs
+# ----------
+def tagging_job(agents, multi_adverb: bool = False):
+    """
+    Returns the async function running one tagging job with the grouper agents (or CascadeAgent)
+    """
+    async def run(payload):
+        if multi_adverb:
+            return await agents.analyze_sentence_by_syntax_async(payload["sentence"], payload["adverb"])
+        return await agents.analyze_by_syntax_async(payload["sentence"], payload["adverb"])
+    return run
+
+def ablation_job(agents, studies):
+    """
+    Returns the async function running one sentence through every study, like AblationPipeline:
+    the job fails when the first study fails, a later study that fails is recorded as None.
+    The agents log a failed request and return None, so the first study fails on a None result as well
+    as on an exception, and the job is retried instead of being stored without it.
+    The requests run in worker threads and the responses are parsed on the event loop thread,
+    because the agents share one prob_handler.
+    """
+    async def run(payload):
+        sentence, adverb = payload["sentence"], payload["adverb"]
+        record = {}
+        for study_num, study in enumerate(studies):
+            try:
+                data = await asyncio.to_thread(agents.request_study, study, sentence, adverb)
+                record[study["agent_type"]] = agents.parse_study(study, data, sentence, adverb)
+                if study_num == 0 and record[study["agent_type"]] is None:
+                    raise RuntimeError(f"The first study {study['agent_type']} failed for adverb '{adverb}', see error logs")
+            except Exception as e:
+                if study_num == 0:
+                    raise
+                if error_handler:
+                    error_handler.handle(e, context={"study": study["agent_type"], "sentence": sentence, "adverb": adverb})
+                record[study["agent_type"]] = None
+        return record
+    return run
+
+
+class QueueWorker:
+    """
+    Leases jobs from a WorkQueue, runs them and stores their results, until every job of the queue is done or failed.
+    Each round leases as many jobs as there are requests in flight (concurrency), so the queue is not locked for every job.
+    A background thread renews the leases of the jobs in progress, so only the jobs of a worker that stopped renewing run out.
+    When the queue has no job to lease while other workers still hold leases, the worker waits for them to
+    finish or to run out instead of exiting.
+    """
+    def __init__(self, queue: WorkQueue, run_job, worker_id: str, concurrency: int = 1, throttle = None, poll_seconds: float = 5.0):
+        """
+        run_job: async function computing the result of a job payload, see tagging_job and ablation_job
+        """
+        self.queue = queue
+        self.run_job = run_job
+        self.worker_id = worker_id
+        self.concurrency = max(1, concurrency)
+        self.dispatcher = AsyncDispatcher(self.concurrency, throttle)
+        self.poll_seconds = poll_seconds
+        self.held = set() # ids of the leased jobs in progress
+        self.completed = 0
+        self.failed = 0
+        self._held_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def _renew_leases(self):
+        while not self._stopping.wait(self.queue.lease_seconds / 3):
+            with self._held_lock:
+                held = list(self.held)
+            if held:
+                try:
+                    self.queue.renew(self.worker_id, held)
+                except sqlite3.Error as e:
+                    print(f"Could not renew the leases of {self.worker_id}: {e}") # The next renewal tries again
+
+    def run(self):
+        renewer = threading.Thread(target=self._renew_leases, daemon=True)
+        renewer.start()
+        started = time.perf_counter()
+        try:
+            while True:
+                jobs = self.queue.lease(self.worker_id, self.concurrency)
+                if not jobs:
+                    if self.queue.is_finished():
+                        break
+                    time.sleep(self.poll_seconds) # Other workers hold the remaining jobs
+                    continue
+                with self._held_lock:
+                    self.held.update(job_id for job_id, _ in jobs)
+                self._run_jobs(jobs)
+                elapsed = time.perf_counter() - started
+                print(f"{self.worker_id}: {self.completed} jobs done, {self.failed} failed ({self.completed / elapsed:.2f} jobs/s) | {self.queue.report()}")
+        finally:
+            self._stopping.set()
+            with self._held_lock:
+                held = list(self.held)
+            if held:
+                self.queue.release(self.worker_id, held) # Stopped mid-round, e.g., with Ctrl+C: the jobs go back to the queue
+        return self.completed, self.failed
+
+    def _run_jobs(self, jobs):
+        async def run(job_id, payload):
+            try:
+                result = await self.run_job(payload)
+            except Exception as e:
+                self.queue.fail(job_id, self.worker_id, f"{type(e).__name__}: {e}")
+                self.failed += 1
+            else:
+                self.queue.complete(job_id, self.worker_id, result)
+                self.completed += 1
+            # A job cancelled by Ctrl+C stays held, so run() returns it to the queue
+            with self._held_lock:
+                self.held.discard(job_id)
+
+        self.dispatcher.run(jobs, run)
+
+
+# ----------
+# Exporting the results
+# ----------
+def export_results(queue: WorkQueue, logger):
+    """
+    Writes the results of the queue to the data logs and completion logs of the logger, in the format
+    of the pipeline the queue runs, so the analysis scripts read them like the logs of a pipeline run.
+    Occurrences already in the completion logs of the logger's directory are skipped, so the export can be repeated
+    while the workers run. Failed jobs are written to the error logs.
+    Returns (records written, failed occurrences)
+    """
+    settings = queue.settings
+    tagging = settings["pipeline"] == "tagging"
+    completed = set()
+    for run_completion in logger.logs_dir.glob("_run_completion_*.ndjson"):
+        with open(run_completion, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    completed.add(entry["filepath"] if tagging else entry["complete_id"])
+
+    occurrences = [entry for entry in queue.occurrences() if (entry[0]["filepath"] if tagging else entry[0]["id"]) not in completed]
+    # A file is exported once none of its jobs is waiting, so its records are written once; like TaggingPipeline, failed jobs do not keep it open
+    unfinished = {occurrence["filepath"] for occurrence, status, _, _ in occurrences if tagging and status in ("pending", "leased")}
+    written = failed = 0
+    finished_files = []
+    for occurrence, status, result, error in occurrences:
+        if status in ("pending", "leased") or (tagging and occurrence["filepath"] in unfinished):
+            continue
+        if status == "failed":
+            logger.log_error([{"error": {"type": "QueueJobFailed", "message": error, "context": occurrence}}])
+            failed += 1
+        elif tagging:
+            for record in (result or [] if settings.get("multi_adverb") else [result]):
+                if record:
+                    logger.log_record({"filename": occurrence["filename"], "result": record})
+                    written += 1
+        else:
+            logger.log_record(dict(result, id=occurrence["id"]))
+            logger.log_completion({"complete_id": occurrence["id"]})
+            written += 1
+        if tagging and occurrence["filepath"] not in finished_files:
+            finished_files.append(occurrence["filepath"])
+    for filepath in finished_files:
+        logger.log_completion({"filepath": filepath})
+    return written, failed
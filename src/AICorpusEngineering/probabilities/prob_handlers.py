@@ -1,4 +1,5 @@
 import math
+import re
 
 class MCQProbHandler:
     def __init__(self, logprobs = None):
@@ -59,6 +60,38 @@ class MCQProbHandler:
 
     def return_final_answer_token_index(self):
         return self.final_answer_token_index
+
+    def return_final_answer_token_indices(self):
+        """
+        Finds the index of every answer token written after "Final answer:", in order.
+        Used when one generation answers several questions, e.g., one answer per adverb of a sentence.
+        """
+        content = self.logprobs["content"]
+        indices = []
+        text = "" # Text generated since the previous answer
+        for i, entry in enumerate(content):
+            token = entry["token"]
+            if token.strip() in ("A", "B", "C", "D", "E", "F", "G", "H", "I", 'J') and re.search(r"final\s*answer\s*:\s*$", text, re.IGNORECASE):
+                indices.append(i)
+                text = ""
+                continue
+            text += token
+        return indices
+
+    def split_by_final_answers(self):
+        """
+        Splits the logprobs of a generation with several final answers into one logprobs object per answer:
+        each contains the reasoning tokens after the previous answer up to and including its own answer token,
+        so set_logprobs() on one part calculates that answer's perplexity and probability distribution
+        exactly as for a single question.
+        """
+        content = self.logprobs["content"]
+        parts = []
+        start = 0
+        for index in self.return_final_answer_token_indices():
+            parts.append({"content": content[start:index + 1]})
+            start = index + 1
+        return parts
         
 
     def calculate_reasoning_perplexity(self):
@@ -128,4 +161,52 @@ class MCQProbHandler:
         else:
             # Fallback if none of the choices were found
             answer_probs = {k: 0.0 for k in choice_selections}
-        return answer_probs
\ No newline at end of file
+        return answer_probs
+
+    @staticmethod
+    def aggregate_chains(chains):
+        """
+        Self-consistency: aggregates several sampled reasoning chains for the same question by majority vote.
+        chains: one {"final_answer", "ppl", "probdist"} per chain that reached a final answer
+        Returns {
+            "final_answer": the answer most chains voted for; a tie goes to the answer with the highest mean probability,
+            "votes": {answer: number of chains},
+            "vote_share": share of the chains that voted for the final answer,
+            "probdist": the mean probability distribution of the chains,
+            "ppl": the mean reasoning perplexity of the chains (None when no chain has one),
+            "best_chain": index of the chain with the lowest perplexity among those that voted for the final answer
+        }
+        """
+        if not chains:
+            raise ValueError("No chain reached a final answer")
+        votes = {}
+        for chain in chains:
+            votes[chain["final_answer"]] = votes.get(chain["final_answer"], 0) + 1
+        # calculate_prob_distribution keys its fallback distributions by the choice tokens (" A") and the others
+        # by the answers ("A"), so the choices are stripped before the mass of the chains is added up
+        distributions = []
+        for chain in chains:
+            distribution = {}
+            for choice, probability in chain["probdist"].items():
+                distribution[choice.strip()] = distribution.get(choice.strip(), 0.0) + probability
+            distributions.append(distribution)
+        choices = sorted({choice for distribution in distributions for choice in distribution})
+        probdist = {choice: sum(distribution.get(choice, 0.0) for distribution in distributions) / len(chains) for choice in choices}
+        final_answer = max(votes, key=lambda answer: (votes[answer], probdist.get(answer.strip(), 0.0)))
+
+        # Perplexity is a string when it could not be computed, and inf without reasoning tokens
+        def perplexity(chain):
+            ppl = chain.get("ppl")
+            return ppl if isinstance(ppl, (int, float)) and math.isfinite(ppl) else None
+
+        ppls = [perplexity(chain) for chain in chains if perplexity(chain) is not None]
+        winners = [i for i, chain in enumerate(chains) if chain["final_answer"] == final_answer]
+        best_chain = min(winners, key=lambda i: perplexity(chains[i]) if perplexity(chains[i]) is not None else math.inf)
+        return {
+            "final_answer": final_answer,
+            "votes": votes,
+            "vote_share": votes[final_answer] / len(chains),
+            "probdist": probdist,
+            "ppl": sum(ppls) / len(ppls) if ppls else None,
+            "best_chain": best_chain
+        }
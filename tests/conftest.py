@@ -0,0 +1,17 @@
+import importlib.resources as resources
+import pytest
+
+from AICorpusEngineering.llm_server.mock_server import MockLlamaServer
+
+
+def template_path(name):
+    """Returns the installed path of an agent template"""
+    return resources.files("AICorpusEngineering.agent-templates").joinpath(name)
+
+
+@pytest.fixture(scope="module")
+def mock_server():
+    """A fast mock llama-server rendering adverbs.jinja"""
+    server = MockLlamaServer(port=0, latency=0.0, tokens_per_second=5000, prompt_tokens_per_second=1e6, parallel=2, chat_template=template_path("adverbs.jinja")).start()
+    yield server
+    server.stop()
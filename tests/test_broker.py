@@ -0,0 +1,120 @@
+import threading
+import time
+
+import pytest
+
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.llm_client.prompt_renderer import PromptRenderer
+from AICorpusEngineering.llm_server.broker import FairScheduler, combine_templates, template_agent_types
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.agents.ablation_adverbs import AdverbsAblationStudy, ABLATION_STUDIES
+from AICorpusEngineering.agents.multiword_adverbs_tagger import MWAdverbs
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from conftest import template_path
+
+TEMPLATES = ["adverbs.jinja", "ablation_adverbs_examples_kb.jinja", "mw_adverb_analyst.jinja"]
+SENTENCE, ADVERB = "She quickly left the room.", "quickly"
+
+
+class RecordingClient(LLMClient):
+    """Records the payload of every chat request instead of sending it"""
+    def __init__(self):
+        super().__init__("http://127.0.0.1:1")
+        self.payloads = []
+
+    def chat(self, chat_template_kwargs, messages=None, temperature=0.001, n_predict=128, agent_type=None, **options):
+        self.payloads.append(self.build_payload(chat_template_kwargs, messages, temperature, n_predict, agent_type))
+        return None
+
+
+def pipeline_payloads():
+    """Returns (template name, payload) for every request the pipelines send"""
+    client = RecordingClient()
+    knowledge_base = KnowledgeBase()
+    grouper = BroadGrouperAgent(client.server_url, MCQProbHandler(), knowledge_base, client)
+    grouper.request_by_syntax(SENTENCE, ADVERB)
+    grouper.request_sentence_by_syntax(SENTENCE, [ADVERB, "away"])
+    studies = AdverbsAblationStudy(client.server_url, MCQProbHandler(), knowledge_base, client, ABLATION_STUDIES)
+    for study in ABLATION_STUDIES:
+        studies.request_study(study, SENTENCE, ADVERB)
+    MWAdverbs(client.server_url, client)._send_request("", SENTENCE)
+    names = ["adverbs.jinja"] * 2 + ["ablation_adverbs_examples_kb.jinja"] * len(ABLATION_STUDIES) + ["mw_adverb_analyst.jinja"]
+    assert len(client.payloads) == len(names)
+    return list(zip(names, client.payloads))
+
+
+@pytest.fixture(scope="module")
+def combined_renderer(tmp_path_factory):
+    output_path = tmp_path_factory.mktemp("broker") / "combined.jinja"
+    combine_templates([template_path(name) for name in TEMPLATES], output_path)
+    return PromptRenderer(output_path)
+
+
+@pytest.mark.parametrize("name,payload", pipeline_payloads(), ids=lambda value: value if isinstance(value, str) else value["chat_template_kwargs"].get("agent_type", "no agent_type"))
+def test_combined_template_renders_every_pipeline(combined_renderer, name, payload):
+    kwargs, messages = payload["chat_template_kwargs"], payload["messages"]
+    prompt = combined_renderer.render(kwargs, messages)
+    assert prompt.strip()
+    assert prompt == PromptRenderer(template_path(name)).render(kwargs, messages)
+
+
+def test_combine_templates_rejects_shared_agent_types(tmp_path):
+    with pytest.raises(ValueError):
+        combine_templates([template_path("ablation_adverbs_examples_kb.jinja"), template_path("ablation_adverbs_descriptive_kb.jinja")], tmp_path / "combined.jinja")
+
+
+def test_build_payload_adds_agent_type_to_the_kwargs():
+    client = LLMClient("http://127.0.0.1:1")
+    payload = client.build_payload({"sentence": SENTENCE}, agent_type="mw_adverb_analyst")
+    assert payload["chat_template_kwargs"]["agent_type"] == "mw_adverb_analyst"
+    kwargs = {"sentence": SENTENCE, "agent_type": "syntactic-grouper"}
+    payload = client.build_payload(kwargs, agent_type="mw_adverb_analyst")
+    assert payload["chat_template_kwargs"]["agent_type"] == "syntactic-grouper"
+    assert client.build_payload({"sentence": SENTENCE})["chat_template_kwargs"] == {"sentence": SENTENCE}
+
+
+def test_template_without_branches_serves_its_file_name():
+    assert template_agent_types(template_path("mw_adverb_analyst.jinja")) == ["mw_adverb_analyst"]
+    assert "syntactic-grouper" in template_agent_types(template_path("adverbs.jinja"))
+
+
+def admit_order(scheduler, requests):
+    """
+    Queues (priority, client) requests while every slot is taken, frees the slots one at a time
+    and returns the order in which the requests were admitted
+    """
+    scheduler.acquire("batch", "holder", scheduler.capacity)
+    order, threads = [], []
+    for priority, client in requests:
+        def run(priority=priority, client=client):
+            scheduler.acquire(priority, client)
+            order.append((priority, client))
+        thread = threading.Thread(target=run)
+        thread.start()
+        threads.append(thread)
+        while scheduler.stats()["clients"][client]["waiting"] < sum(1 for _, c in requests[:len(threads)] if c == client):
+            time.sleep(0.001) # Queue the requests in a known order
+    scheduler.release("holder", scheduler.capacity)
+    for n, thread in enumerate(threads):
+        while len(order) <= n:
+            time.sleep(0.001)
+        scheduler.release(order[n][1])
+    for thread in threads:
+        thread.join(timeout=5)
+    return order
+
+
+def test_fair_scheduler_serves_higher_priority_first():
+    order = admit_order(FairScheduler(1), [("batch", "corpus"), ("normal", "ablation"), ("interactive", "manual")])
+    assert [client for _, client in order] == ["manual", "ablation", "corpus"]
+
+
+def test_fair_scheduler_shares_slots_between_clients():
+    order = admit_order(FairScheduler(1), [("batch", "a")] * 3 + [("batch", "b")] * 2)
+    assert [client for _, client in order] == ["a", "b", "a", "b", "a"]
+
+
+def test_fair_scheduler_rejects_unknown_priority():
+    with pytest.raises(ValueError):
+        FairScheduler(1).acquire("urgent", "client")
@@ -0,0 +1,58 @@
+import pytest
+
+from AICorpusEngineering.agents.adverbs_broad_grouper_agent import BroadGrouperAgent
+from AICorpusEngineering.agents.adverbs_cascade_agent import CascadeAgent
+from AICorpusEngineering.knowledge_base.knowledge_base import KnowledgeBase
+from AICorpusEngineering.llm_client.llm_client import LLMClient
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+
+SENTENCE = "Now, she surely left the room quickly."
+
+
+def cascade(server_url, **options):
+    grouper = BroadGrouperAgent(server_url, MCQProbHandler(), KnowledgeBase(), LLMClient(server_url))
+    return CascadeAgent(grouper, **options)
+
+
+@pytest.mark.parametrize("probdist,confident", [
+    ({"A": 0.9, "B": 0.05, "C": 0.05}, True),
+    ({"A": 0.7, "B": 0.2, "C": 0.1}, False), # Below min_probability
+    ({"A": 0.85, "B": 0.0}, True),
+    ({"A": 1.0}, True),
+])
+def test_is_confident(probdist, confident):
+    assert cascade("http://127.0.0.1:1").is_confident(probdist) == confident
+
+
+def test_is_confident_checks_the_margin():
+    agent = cascade("http://127.0.0.1:1", min_probability=0.5, min_margin=0.3)
+    assert agent.is_confident({"A": 0.6, "B": 0.4}) is False
+    assert agent.is_confident({"A": 0.6, "B": 0.2}) is True
+
+
+def test_merge_records_the_tier_that_answered():
+    cheap = [{"tier": "syntactic-zeroshot", "final_answer": "E", "probdist": {"E": 0.95}}, None, {"tier": "syntactic-zeroshot", "final_answer": "B", "probdist": {"B": 0.5}}]
+    escalated = [{"final_answer": "A"}, {"final_answer": "C"}]
+    records = cascade("http://127.0.0.1:1")._merge(cheap, [1, 2], escalated, single=[1])
+    assert [record["tier"] for record in records] == ["syntactic-zeroshot", "syntactic-grouper-multi", "syntactic-grouper"]
+    assert "cascade" not in records[1] # The cheap tier gave no answer
+    assert records[2]["cascade"] == {"tier": "syntactic-zeroshot", "final_answer": "B", "probdist": {"B": 0.5}}
+
+
+def test_unreadable_cheap_answer_is_escalated():
+    agent = cascade("http://127.0.0.1:1")
+    assert agent._cheap_or_none(ValueError("No answer letter among the top 1000 next tokens"), SENTENCE, "surely") is None
+    assert agent.stats["cheap_failures"] == 1
+
+
+def test_server_error_of_the_cheap_tier_is_raised():
+    with pytest.raises(RuntimeError):
+        cascade("http://127.0.0.1:1")._cheap_or_none(RuntimeError("llama-server returned 500"), SENTENCE, "surely")
+
+
+def test_sentence_records_come_back_in_order(mock_server):
+    agent = cascade(mock_server.url, min_probability=0.99, min_margin=0.99) # Escalate every adverb
+    records = agent.analyze_sentence_by_syntax(SENTENCE, ["Now", "surely", "quickly"])
+    assert [record["adverb"] for record in records] == ["Now", "surely", "quickly"]
+    assert {record["tier"] for record in records} == {"syntactic-grouper-multi"}
+    assert agent.stats == {"adverbs": 3, "escalated": 3, "cheap_failures": 0}
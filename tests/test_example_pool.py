@@ -0,0 +1,48 @@
+from AICorpusEngineering.knowledge_base.example_pool import ExamplePool
+
+
+def example(sentence, adverb, answer="A"):
+    return {"sentence": sentence, "adverb": adverb, "reasoning": [f'The adverb "{adverb}" modifies the verb.'], "answer": answer, "category": "CIRCUMSTANCE"}
+
+
+POOL = [
+    example("The meeting ended quickly.", "quickly"),
+    example("Frankly, the plan failed.", "Frankly", "B"),
+    example("She only wanted tea.", "only", "C"),
+    example("He drove very quickly home.", "quickly"),
+    example("However, nobody came.", "However", "D"),
+]
+
+
+def test_most_similar_example_comes_last():
+    selected = ExamplePool(POOL).select("They left the meeting quickly.", "quickly", 2)
+    assert [e["sentence"] for e in selected] == ["He drove very quickly home.", "The meeting ended quickly."]
+
+
+def test_examples_without_overlap_fill_up_to_k_in_pool_order():
+    selected = ExamplePool(POOL).select("It rains there.", "there", 3)
+    assert [e["sentence"] for e in selected] == ["She only wanted tea.", "Frankly, the plan failed.", "The meeting ended quickly."]
+
+
+def test_the_request_itself_is_never_selected():
+    selected = ExamplePool(POOL).select("the meeting  ended quickly.", "Quickly", len(POOL))
+    assert "The meeting ended quickly." not in [e["sentence"] for e in selected]
+    assert len(selected) == len(POOL) - 1
+
+
+def test_no_examples_for_k_zero():
+    assert ExamplePool(POOL).select("They left quickly.", "quickly", 0) == []
+
+
+def test_embedding_similarity_is_added():
+    vectors = {"quickly": [1.0, 0.0], "Frankly": [0.0, 1.0]}
+    def embedder(texts):
+        return [vectors.get(text.split(":")[0], [0.5, 0.5]) for text in texts]
+    pool = ExamplePool(POOL, embedder=embedder, adverb_weight=0.0, sentence_weight=0.0)
+    assert pool.select("Honestly, it works.", "Frankly", 1)[0]["adverb"] == "Frankly"
+
+
+def test_bundled_pool_loads():
+    pool = ExamplePool.from_file()
+    assert len(pool) > 0
+    assert all(e["answer"] in "ABCDE" for e in pool.select("It was partly cloudy.", "partly", 3))
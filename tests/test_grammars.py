@@ -0,0 +1,56 @@
+import re
+import pytest
+
+from AICorpusEngineering.llm_client.grammars import COT_FINAL_ANSWER, COT_FINAL_ANSWERS, FINAL_ANSWER_ONLY
+
+TOKEN = re.compile(r'\s*("(?:[^"\\]|\\.)*"|\[(?:[^\]\\]|\\.)*\]|[A-Za-z-]+|[()|*?+])')
+
+
+def grammar_regex(grammar: str):
+    """Translates a non-recursive GBNF grammar into a regular expression matching the same strings"""
+    rules = dict(line.split(" ::= ", 1) for line in grammar.strip().splitlines())
+
+    def translate(name):
+        parts = []
+        for token in TOKEN.findall(rules[name]):
+            if token.startswith('"'):
+                parts.append(re.escape(token[1:-1].encode().decode("unicode_escape")))
+            elif token.startswith("["):
+                parts.append(token)
+            elif token in "()|*?+":
+                parts.append("(?:" if token == "(" else token)
+            else:
+                parts.append(f"(?:{translate(token)})")
+        return "".join(parts)
+    return re.compile(translate("root"))
+
+
+@pytest.mark.parametrize("text", [
+    "1. The adverb modifies the verb.\nFinally, it shows manner.\nFinal answer: A",
+    "Final answer\nFinal answer: B",
+    "Fin.\nFinal answer: C",
+    "Final answer: E",
+])
+def test_reasoning_lines_may_start_like_the_answer_line(text):
+    assert grammar_regex(COT_FINAL_ANSWER).fullmatch(text)
+
+
+@pytest.mark.parametrize("text", [
+    "Final answer: A\nFinal answer: B",
+    "It modifies the verb.\nFinal answer: F",
+    "It modifies the verb.",
+])
+def test_only_the_last_line_is_the_answer(text):
+    assert not grammar_regex(COT_FINAL_ANSWER).fullmatch(text)
+
+
+def test_one_answer_per_block():
+    regex = grammar_regex(COT_FINAL_ANSWERS)
+    assert regex.fullmatch('Adverb 1: "Now"\nFinally, a discourse marker.\nFinal answer: E\nAdverb 2: "surely"\nFinal answer: B')
+    assert not regex.fullmatch('Adverb 1: "Now"\nFinal answer: E\nFinal answer: B extra')
+
+
+def test_answer_only_grammar():
+    regex = grammar_regex(FINAL_ANSWER_ONLY)
+    assert regex.fullmatch("<|assistant|>\nFinal answer: D")
+    assert not regex.fullmatch("<|assistant|>\nIt is D.\nFinal answer: D")
@@ -0,0 +1,34 @@
+from AICorpusEngineering.pipelines.job_planner import JobManifest, normalize_sentence
+
+
+def test_normalize_sentence_keeps_case_and_punctuation():
+    assert normalize_sentence("  Well,\tthat  was\nquick. ") == "Well, that was quick."
+    assert normalize_sentence("Café") == "Café"
+    assert normalize_sentence("Well.") != normalize_sentence("well.")
+
+
+def test_manifest_keeps_one_job_per_sentence_adverb_and_study():
+    manifest = JobManifest()
+    first = manifest.add("It is  clearly wrong.", "clearly", "base_study", 1)
+    assert manifest.add("It is clearly wrong.", "clearly", "base_study", 2) == first
+    manifest.add("It is clearly wrong.", "clearly", "zeroshot", 3)
+    manifest.add("It is clearly wrong.", "wrong", "base_study", 4)
+    assert len(manifest) == 3
+    assert manifest.occurrences == 4
+    assert manifest.jobs[first]["occurrences"] == [1, 2]
+    assert manifest.dedup_ratio == 0.25
+    assert manifest.most_repeated(1)[0]["occurrences"] == [1, 2]
+
+
+def test_multi_adverb_jobs_are_keyed_by_all_their_adverbs():
+    manifest = JobManifest()
+    manifest.add("Now, surely not.", ["Now", "surely"], "syntactic-grouper-multi", 1)
+    manifest.add("Now, surely not.", ("Now", "surely"), "syntactic-grouper-multi", 2)
+    manifest.add("Now, surely not.", ["surely", "Now"], "syntactic-grouper-multi", 3)
+    assert len(manifest) == 2
+
+
+def test_empty_manifest_reports_no_deduplication():
+    manifest = JobManifest()
+    assert manifest.dedup_ratio == 0.0
+    assert manifest.report().startswith("Job plan: 0 jobs")
@@ -0,0 +1,102 @@
+import pytest
+
+from AICorpusEngineering.llm_client.llm_client import LLMClient, ANSWER_LETTERS, ANSWER_PREFIX, answer_prefix_for
+from AICorpusEngineering.llm_client.prompt_renderer import PromptRenderer
+from conftest import template_path
+
+KWARGS = {"agent_type": "syntactic-grouper", "knowledge_base": "CATEGORIES OF ADVERBS", "sentence": "She quickly left the room.", "adverb": "quickly"}
+MESSAGES = [{"role": "user", "content": ""}]
+
+
+def final_answer(data):
+    """Returns the answer letter and the answer letters' logprobs at the final answer token of a response"""
+    entries = [entry for entry in data["choices"][0]["logprobs"]["content"] if entry["token"].strip() in ANSWER_LETTERS]
+    answer = entries[-1]
+    return answer["token"].strip(), {entry["token"].strip(): entry["logprob"] for entry in answer["top_logprobs"] if entry["token"].strip() in ANSWER_LETTERS}
+
+
+def assert_same_answer(data, expected):
+    content, _ = LLMClient.get_content_and_logprobs(data)
+    answer, logprobs = final_answer(data)
+    expected_answer, expected_logprobs = final_answer(expected)
+    assert content.endswith(f"Final answer: {expected_answer}")
+    assert answer == expected_answer
+    assert logprobs == pytest.approx(expected_logprobs)
+
+
+@pytest.fixture(scope="module")
+def full_response(mock_server):
+    return LLMClient(mock_server.url).chat(KWARGS, MESSAGES, temperature=0.0)
+
+
+def test_two_phase_returns_the_full_mode_answer(mock_server, full_response):
+    data = LLMClient(mock_server.url, logprobs_mode="two_phase", answer_top_k=20).chat(KWARGS, MESSAGES, temperature=0.0)
+    assert_same_answer(data, full_response)
+
+
+def test_two_phase_response_is_smaller(mock_server, full_response):
+    data = LLMClient(mock_server.url, logprobs_mode="two_phase", answer_top_k=20).chat(KWARGS, MESSAGES, temperature=0.0)
+    def top_entries(response):
+        return sum(len(entry.get("top_logprobs", [])) for entry in response["choices"][0]["logprobs"]["content"])
+    assert top_entries(data) < top_entries(full_response)
+
+
+def test_unknown_logprobs_mode_is_refused():
+    with pytest.raises(ValueError):
+        LLMClient("http://127.0.0.1:1", logprobs_mode="sparse")
+
+
+def test_stream_returns_the_full_mode_answer(mock_server, full_response):
+    data = LLMClient(mock_server.url, stream=True).chat(KWARGS, MESSAGES, temperature=0.0)
+    assert_same_answer(data, full_response)
+
+
+def test_stream_waits_for_every_expected_answer(mock_server):
+    kwargs = {"agent_type": "syntactic-grouper-multi", "knowledge_base": "CATEGORIES OF ADVERBS", "sentence": "Now, she surely left.", "adverbs": ["Now", "surely"]}
+    data = LLMClient(mock_server.url, stream=True).chat(kwargs, MESSAGES, temperature=0.0, n_predict=256, expected_answers=2)
+    content, _ = LLMClient.get_content_and_logprobs(data)
+    assert content.count("Final answer:") == 2
+
+
+def test_scoring_reads_the_answer_from_the_next_token(mock_server):
+    data = LLMClient(mock_server.url, answer_top_k=20).chat(KWARGS, MESSAGES, temperature=0.0, answer_prefix=ANSWER_PREFIX, answer_letters="ABCDE")
+    choice = data["choices"][0]
+    assert choice["finish_reason"] == "scored"
+    assert choice["message"]["content"] == ANSWER_PREFIX + choice["logprobs"]["content"][0]["token"]
+    answer, logprobs = final_answer(data)
+    assert logprobs[answer] == max(logprobs.values())
+
+
+def test_scored_answer_is_one_of_the_answer_letters():
+    top = [{"token": " F", "logprob": -0.2}, {"token": " B", "logprob": -1.5}, {"token": " A", "logprob": -2.0}]
+    data = LLMClient("http://127.0.0.1:1").answer_response(top, ANSWER_PREFIX, None, ("A", "B", "C", "D", "E"))
+    assert data["choices"][0]["message"]["content"] == ANSWER_PREFIX + " B"
+    assert data["choices"][0]["logprobs"]["content"][0]["top_logprobs"] == top
+
+
+def test_scoring_without_an_answer_letter_raises_value_error():
+    with pytest.raises(ValueError):
+        LLMClient("http://127.0.0.1:1").answer_response([{"token": " the", "logprob": -0.1}, {"token": " F", "logprob": -0.5}], ANSWER_PREFIX, None, "ABCDE")
+
+
+def test_answer_prefix_is_read_from_the_template_examples(tmp_path):
+    assert answer_prefix_for(str(template_path("ablation_adverbs_examples_kb.jinja")), "zeroshot") == "<|assistant|> \nFinal answer:"
+    template = tmp_path / "no_examples.jinja"
+    template.write_text('{% if agent_type == "zeroshot" %}Answer with a letter.{% endif %}', encoding="utf-8")
+    assert answer_prefix_for(str(template), "zeroshot") == ANSWER_PREFIX
+
+
+def test_client_render_returns_the_full_mode_answer(mock_server, full_response):
+    client = LLMClient(mock_server.url, chat_template=template_path("adverbs.jinja"))
+    data = client.chat(KWARGS, MESSAGES, temperature=0.0)
+    assert_same_answer(data, full_response)
+    prefix = client.renderer.static_prefix(KWARGS, MESSAGES)
+    assert client.prefix_tokens[prefix] # The static prefix was tokenized once and is sent as token ids
+
+
+def test_static_prefix_ends_before_the_sentence():
+    renderer = PromptRenderer(template_path("adverbs.jinja"))
+    prefix, suffix = renderer.split(KWARGS, MESSAGES)
+    assert prefix + suffix == renderer.render(KWARGS, MESSAGES)
+    assert KWARGS["sentence"] not in prefix and prefix.endswith("\n")
+    assert renderer.static_prefix(dict(KWARGS, sentence="Well, fine."), MESSAGES) == prefix
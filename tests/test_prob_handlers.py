@@ -0,0 +1,73 @@
+import math
+
+import pytest
+
+from AICorpusEngineering.probabilities.prob_handlers import MCQProbHandler
+
+
+def chain(final_answer, probdist, ppl=1.5):
+    return {"final_answer": final_answer, "probdist": probdist, "ppl": ppl}
+
+
+def test_majority_vote_wins():
+    result = MCQProbHandler.aggregate_chains([
+        chain("A", {"A": 0.6, "B": 0.4}),
+        chain("B", {"A": 0.1, "B": 0.9}),
+        chain("A", {"A": 0.7, "B": 0.3}),
+    ])
+    assert result["final_answer"] == "A"
+    assert result["votes"] == {"A": 2, "B": 1}
+    assert result["vote_share"] == pytest.approx(2 / 3)
+    assert result["probdist"] == pytest.approx({"A": 1.4 / 3, "B": 1.6 / 3})
+
+
+def test_tie_goes_to_the_highest_mean_probability():
+    result = MCQProbHandler.aggregate_chains([
+        chain("A", {"A": 0.6, "B": 0.4}),
+        chain("B", {"A": 0.05, "B": 0.95}),
+    ])
+    assert result["final_answer"] == "B"
+
+
+def test_token_keys_are_merged_with_answer_keys():
+    # The fallback distributions of calculate_prob_distribution are keyed by the choice tokens
+    result = MCQProbHandler.aggregate_chains([
+        chain("A", {"A": 0.8, "B": 0.2}),
+        chain("B", {" A": 0.0, " B": 0.0}),
+        chain("B", {"A": 0.4, "B": 0.6}),
+        chain("A", {"A": 0.9, "B": 0.1}),
+    ])
+    assert set(result["probdist"]) == {"A", "B"}
+    assert result["probdist"] == pytest.approx({"A": 2.1 / 4, "B": 0.9 / 4})
+    assert result["final_answer"] == "A"
+
+
+def test_mean_perplexity_ignores_uncomputed_values():
+    result = MCQProbHandler.aggregate_chains([
+        chain("A", {"A": 1.0}, ppl=2.0),
+        chain("A", {"A": 1.0}, ppl=math.inf),
+        chain("A", {"A": 1.0}, ppl="Perplexity could not be calculated"),
+        chain("A", {"A": 1.0}, ppl=4.0),
+    ])
+    assert result["ppl"] == pytest.approx(3.0)
+
+
+def test_no_perplexity_gives_none():
+    result = MCQProbHandler.aggregate_chains([chain("A", {"A": 1.0}, ppl=math.inf)])
+    assert result["ppl"] is None
+    assert result["best_chain"] == 0
+
+
+def test_best_chain_is_the_most_fluent_winner():
+    result = MCQProbHandler.aggregate_chains([
+        chain("B", {"A": 0.2, "B": 0.8}, ppl=1.1),
+        chain("A", {"A": 0.7, "B": 0.3}, ppl=3.0),
+        chain("A", {"A": 0.6, "B": 0.4}, ppl=2.0),
+    ])
+    assert result["final_answer"] == "A"
+    assert result["best_chain"] == 2
+
+
+def test_no_chains_raises():
+    with pytest.raises(ValueError):
+        MCQProbHandler.aggregate_chains([])
@@ -0,0 +1,50 @@
+import pytest
+
+from AICorpusEngineering.llm_client.llm_client import LLMClient, ANSWER_PREFIX
+from AICorpusEngineering.llm_client.response_cache import ResponseCache
+
+KWARGS = {"agent_type": "syntactic-grouper", "knowledge_base": "CATEGORIES OF ADVERBS", "sentence": "She quickly left the room.", "adverb": "quickly"}
+MESSAGES = [{"role": "user", "content": ""}]
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(tmp_path)
+    yield cache
+    cache.close()
+
+
+def test_cached_response_is_reused(mock_server, cache):
+    client = LLMClient(mock_server.url, response_cache=cache)
+    first = client.chat(KWARGS, MESSAGES, temperature=0.0)
+    served = mock_server.requests_served
+    assert client.chat(KWARGS, MESSAGES, temperature=0.0) == first
+    assert mock_server.requests_served == served
+
+
+def test_sampled_requests_are_not_cached(mock_server, cache):
+    client = LLMClient(mock_server.url, response_cache=cache)
+    client.chat(KWARGS, MESSAGES, temperature=0.7)
+    served = mock_server.requests_served
+    client.chat(KWARGS, MESSAGES, temperature=0.7)
+    assert mock_server.requests_served > served
+
+
+@pytest.mark.parametrize("options,answer_prefix", [
+    ({"answer_top_k": 20}, None),
+    ({"logprobs_mode": "two_phase"}, None),
+    ({}, ANSWER_PREFIX),
+], ids=["answer_top_k", "logprobs_mode", "scoring"])
+def test_cache_key_depends_on_client_settings(cache, options, answer_prefix):
+    default = LLMClient("http://127.0.0.1:1", response_cache=cache)
+    changed = LLMClient("http://127.0.0.1:1", response_cache=cache, **options)
+    payload = default.build_payload(KWARGS, MESSAGES, 0.0)
+    changed_payload = dict(payload, answer_prefix=answer_prefix) if answer_prefix else payload
+    assert cache.make_key(default.response_namespace(), payload) != cache.make_key(changed.response_namespace(answer_prefix), changed_payload)
+
+
+def test_cache_key_ignores_the_order_of_the_kwargs(cache):
+    client = LLMClient("http://127.0.0.1:1")
+    payload = client.build_payload(KWARGS, MESSAGES, 0.0)
+    reordered = client.build_payload(dict(reversed(list(KWARGS.items()))), MESSAGES, 0.0)
+    assert cache.make_key("model", payload) == cache.make_key("model", reordered)
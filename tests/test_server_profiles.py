@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+from AICorpusEngineering.llm_server.server_profiles import (
+    SERVER_PROFILES, load_server_profile, profile_arguments, validate_profile
+)
+
+
+def test_value_settings_become_flags():
+    arguments = profile_arguments({"batch_size": 512, "cache_type_k": "q8_0", "n_gpu_layers": 0})
+    assert arguments == ["--batch-size", "512", "--cache-type-k", "q8_0", "--n-gpu-layers", "0"]
+
+
+def test_switches_only_add_the_flag_they_have():
+    assert profile_arguments({"cont_batching": True}) == ["--cont-batching"]
+    assert profile_arguments({"cont_batching": False}) == ["--no-cont-batching"]
+    assert profile_arguments({"mlock": True}) == ["--mlock"]
+    assert profile_arguments({"mlock": False}) == []
+    assert profile_arguments({"mmap": False}) == ["--no-mmap"]
+    assert profile_arguments({"mmap": True}) == []
+
+
+def test_unset_settings_keep_the_server_default():
+    assert profile_arguments({}) == []
+    assert profile_arguments({"batch_size": None, "cont_batching": None}) == []
+
+
+def test_generation_threads_are_left_to_the_server_manager():
+    assert profile_arguments({"threads": 8}) == []
+
+
+@pytest.mark.parametrize("instances, expected", [(1, "8"), (2, "4"), (3, "2"), (16, "1"), (0, "8")])
+def test_batch_threads_are_split_between_the_instances(instances, expected):
+    assert profile_arguments({"threads_batch": 8}, instances=instances) == ["--threads-batch", expected]
+
+
+@pytest.mark.parametrize("name", sorted(SERVER_PROFILES))
+def test_built_in_profiles_are_valid(name):
+    assert validate_profile(SERVER_PROFILES[name]) == SERVER_PROFILES[name]
+    profile_arguments(SERVER_PROFILES[name])
+
+
+def test_unknown_settings_raise():
+    with pytest.raises(ValueError, match="n_threads"):
+        validate_profile({"n_threads": 4})
+    with pytest.raises(ValueError):
+        profile_arguments({"batch_size": 512, "n_threads": 4})
+
+
+def test_load_built_in_profile_returns_a_copy():
+    settings = load_server_profile("cpu")
+    settings["batch_size"] = 1
+    assert SERVER_PROFILES["cpu"]["batch_size"] == 512
+    assert load_server_profile(None) == SERVER_PROFILES["default"]
+
+
+def test_load_profile_file(tmp_path):
+    tuned = tmp_path / "tuned.json"
+    tuned.write_text(json.dumps({"settings": {"batch_size": 1024, "threads": 4}, "tokens_per_second": 12.5}))
+    assert load_server_profile(tuned) == {"batch_size": 1024, "threads": 4}
+    plain = tmp_path / "plain.json"
+    plain.write_text(json.dumps({"mlock": True}))
+    assert load_server_profile(str(plain)) == {"mlock": True}
+
+
+def test_load_profile_file_with_unknown_settings_raises(tmp_path):
+    path = tmp_path / "bad.json"
+    path.write_text(json.dumps({"settings": {"gpu_layers": 10}}))
+    with pytest.raises(ValueError):
+        load_server_profile(path)
+
+
+def test_load_missing_profile_raises(tmp_path):
+    with pytest.raises(ValueError, match="No server profile"):
+        load_server_profile(tmp_path / "missing.json")
@@ -0,0 +1,46 @@
+from AICorpusEngineering.pipelines.throttle import AdaptiveThrottle
+
+TOKENS = 100
+
+
+def run_steady(throttle, seconds_per_token, requests: int = 300):
+    """
+    Keeps throttle.limit requests in flight and completes them one at a time, like a server whose
+    time per token at a load, and after a number of completed requests, is seconds_per_token(load, completed)
+    """
+    in_flight = 0
+    for completed in range(requests):
+        while in_flight < throttle.limit:
+            throttle.wait()
+            in_flight += 1
+        per_token = seconds_per_token(in_flight, completed)
+        throttle.record("syntactic-grouper", TOKENS * per_token, {"predicted_n": TOKENS, "predicted_ms": TOKENS * per_token * 1000, "predicted_per_second": 1 / per_token})
+        in_flight -= 1
+
+
+def test_constant_throughput_server_reaches_max_concurrency():
+    # Batching more requests makes each one slower while the total speed stays the same, which is no drift
+    throttle = AdaptiveThrottle(max_concurrency=4, min_cooldown=0)
+    run_steady(throttle, lambda load, completed: 0.01 * load)
+    assert throttle.limit == 4
+    assert throttle.stats["decreases"] == 0
+
+
+def test_slowdown_at_the_same_load_reduces_concurrency():
+    throttle = AdaptiveThrottle(max_concurrency=4, min_cooldown=0)
+    run_steady(throttle, lambda load, completed: 0.01 * load * (3 if completed >= 150 else 1))
+    assert throttle.stats["decreases"] >= 1
+
+
+def test_request_error_reduces_concurrency():
+    throttle = AdaptiveThrottle(max_concurrency=4, min_cooldown=0)
+    run_steady(throttle, lambda load, completed: 0.01 * load, requests=100)
+    throttle.wait()
+    throttle.record_error("syntactic-grouper")
+    assert throttle.limit == 2
+
+
+def test_server_time_is_used_instead_of_the_round_trip():
+    timings = {"predicted_n": 10, "predicted_ms": 100.0}
+    assert AdaptiveThrottle.seconds_per_token(30.0, timings) == 0.01
+    assert AdaptiveThrottle.seconds_per_token(2.0, {"prompt_ms": 500.0, "predicted_n": 0}) == 0.5
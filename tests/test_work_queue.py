@@ -0,0 +1,100 @@
+import json
+import time
+import pytest
+
+from AICorpusEngineering.logger.logger import NDJSONLogger
+from AICorpusEngineering.pipelines.job_planner import JobManifest
+from AICorpusEngineering.pipelines.work_queue import WorkQueue, QueueWorker, enqueue_ablation, ablation_job, export_results
+
+SETTINGS = {"pipeline": "ablation", "max_attempts": 2}
+STUDIES = [{"agent_type": "base_study"}, {"agent_type": "zeroshot"}]
+
+
+def item(sentence, adverb, line_id):
+    return (JobManifest.key(sentence, adverb, "ablation"), {"sentence": sentence, "adverb": adverb}, f"id:{line_id}", {"id": line_id})
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite")
+    queue.configure(SETTINGS)
+    yield queue
+    queue.close()
+
+
+def test_enqueue_keeps_one_job_per_unique_sentence_and_adverb(queue):
+    assert queue.enqueue([item("It is clearly wrong.", "clearly", 1), item("It is  clearly wrong.", "clearly", 2)]) == (1, 2)
+    assert queue.enqueue([item("It is clearly wrong.", "clearly", 2), item("So be it.", "so", 3)]) == (1, 1)
+    assert queue.counts()["pending"] == 2
+
+
+def test_enqueue_ablation_reads_the_gold_standard_lines(queue):
+    lines = [{"id": 7, "sentence": "She_PRON quickly_ADV left_VERB ._PUNCT", "adverb": "quickly"}]
+    assert enqueue_ablation(queue, lines) == (1, 1)
+    [(_, payload)] = queue.lease("worker")
+    assert payload == {"sentence": "She quickly left .", "adverb": "quickly"}
+
+
+def test_configure_rejects_other_settings(queue):
+    with pytest.raises(ValueError):
+        queue.configure(dict(SETTINGS, max_attempts=5))
+
+
+def test_failed_job_is_retried_until_max_attempts(queue):
+    queue.enqueue([item("So be it.", "so", 1)])
+    for attempt in range(SETTINGS["max_attempts"]):
+        [(job_id, _)] = queue.lease("worker")
+        queue.fail(job_id, "worker", "RuntimeError: no result")
+    assert queue.lease("worker") == []
+    assert queue.counts()["failed"] == 1
+    assert queue.retry_failed() == 1
+    assert len(queue.lease("worker")) == 1
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.sqlite", lease_seconds=0.05)
+    queue.configure(SETTINGS)
+    queue.enqueue([item("So be it.", "so", 1)])
+    [(job_id, _)] = queue.lease("killed")
+    assert queue.lease("other") == []
+    time.sleep(0.1)
+    assert [job for job, _ in queue.lease("other")] == [job_id]
+    queue.complete(job_id, "other", {"base_study": "A"})
+    assert queue.is_finished()
+    queue.close()
+
+
+def test_released_job_keeps_its_attempts(queue):
+    queue.enqueue([item("So be it.", "so", 1)])
+    for _ in range(SETTINGS["max_attempts"] + 1):
+        [(job_id, _)] = queue.lease("worker")
+        queue.release("worker", [job_id])
+    assert queue.counts()["pending"] == 1
+
+
+class FakeStudies:
+    """Stands in for AdverbsAblationStudy; the first study fails for the adverbs in failing"""
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+
+    def request_study(self, study, sentence, adverb):
+        return None if adverb in self.failing and study["agent_type"] == "base_study" else {"answer": "A"}
+
+    def parse_study(self, study, data, sentence, adverb):
+        return None if data is None else {"adverb": adverb, "answer": data["answer"]}
+
+
+def test_worker_fails_jobs_whose_first_study_returns_nothing(queue, tmp_path):
+    queue.enqueue([item("So be it.", "so", 1), item("Well, fine.", "Well", 2), item("So be it.", "so", 3)])
+    completed, failed = QueueWorker(queue, ablation_job(FakeStudies(failing={"Well"}), STUDIES), "worker", concurrency=2, poll_seconds=0.01).run()
+    assert (completed, failed) == (1, SETTINGS["max_attempts"])
+    assert queue.counts() == {"pending": 0, "leased": 0, "done": 1, "failed": 1}
+
+    logger = NDJSONLogger(None, None, tmp_path / "export")
+    assert export_results(queue, logger) == (2, 1)
+    with open(logger.data_logs, "r", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert [record["id"] for record in records] == [1, 3]
+    assert records[0]["base_study"] == {"adverb": "so", "answer": "A"}
+    # Exported occurrences are skipped when the export is repeated
+    assert export_results(queue, NDJSONLogger(None, None, tmp_path / "export")) == (0, 1)